@@ -2,6 +2,7 @@ from io import StringIO
 from email.mime.base import MIMEBase
 from email.message import Message
 import base64
+import logging
 import mimetypes
 import os
 from spake2 import SPAKE2_A
@@ -10,8 +11,10 @@ from spake2.parameters.i1024 import Params1024
 from spake2.parameters.i2048 import Params2048
 from spake2.parameters.i3072 import Params3072
 from pakemail import PakeMail, PakeMailService
+from paketransport import MemoryTransport, getMemoryMailbox
 from pakemod import PakeClient,Roles,Parameters
 import pakemod
+import paketrace
 import nacl.secret, nacl.utils
 import sys
 from threading import Thread
@@ -73,7 +76,7 @@ def run_local_pake_test():
     macMessageA = pakeClientA.pkAfpr+pakeClientA.pkBfpr+pakeClientA.transcript
     print("MAC message A:", macMessageA)
     tauA = pakeClientA.computeMAC(aMacKeyA, macMessageA)
-    pakeClientA.createMacMsg(tauA, writeToFile=True)
+    pakeClientA.createMacMsg(tauA)
     print("tau_A :\n", tauA)
 
     expected_tauB = pakeClientA.computeMAC(aMacKeyB, macMessageA)
@@ -84,7 +87,7 @@ def run_local_pake_test():
     macMessageB = pakeClientB.pkAfpr+pakeClientB.pkBfpr+pakeClientB.transcript
     print("MAC message B:", macMessageB)
     tauB = pakeClientB.computeMAC(bMacKeyB, macMessageB)
-    pakeClientB.createMacMsg(tauB, writeToFile=True)
+    pakeClientB.createMacMsg(tauB)
     print("tau_B :\n", tauB)
 
     expected_tauA = pakeClientB.computeMAC(bMacKeyA, macMessageB)
@@ -154,6 +157,33 @@ def run_pake_session_over_gmail():
     executionTime += pakeClientA.executionTime
     print("PAKE client Thread finished after {0} seconds...exiting".format(executionTime))
 
+def run_pake_session_in_memory():
+    print("\t***  Running a PAKE session over an in-process transport ***")
+
+    transport = MemoryTransport(getMemoryMailbox("sandbox"))
+
+    pakeClientA = PakeClient("A", "pass", "test+senderA@gmail.com")
+    pakeClientB = PakeClient("B", "pass", "test+receiverB@gmail.com")
+
+    pakeClientA.registerRemotePakeClient(pakeClientB)
+    pakeClientB.registerRemotePakeClient(pakeClientA)
+
+    start = time.perf_counter()
+
+    pakeClientA.setup(transport=transport)
+    pakeClientB.setup(transport=transport)
+
+    t1 = Thread(target = pakeClientA.runSession)
+    t1.start()
+    
+    t2 = Thread(target = pakeClientB.runSession)
+    t2.start()
+    
+    t1.join()
+    t2.join()
+
+    print("In-process PakeMail session finished after {0} seconds...exiting".format(time.perf_counter() - start))
+
 def run_pake_session_as_initiator():
     print("\t***  Running a PAKE client as initiator ***")
 
@@ -196,6 +226,16 @@ def run_pake_session_as_responder():
     t2.join()
     print("Responder thread finished...exiting")
 
+def run_group_calibration():
+    print("\t***  Timing the SPAKE2 groups on this machine ***")
+
+    securityFloor = input("Please enter the minimum security level in bits [112]:")
+    if securityFloor == "":
+        securityFloor = 112
+
+    # the sessions started from this menu afterwards use the selected group
+    pakemod.useCalibratedParameters(securityFloor=int(securityFloor), verbose=True)
+
 def displayMainMenu():
     choice = ''
     display_title()
@@ -214,11 +254,15 @@ def displayMainMenu():
             run_pake_session_as_responder()
         elif choice == '5':
             pakemod.run_pure_spake2_experiment()
+        elif choice == '6':
+            run_pake_session_in_memory()
+        elif choice == '7':
+            run_group_calibration()
         elif choice == 'q':
             quit()
             print("\nThanks for the visit. Bye.")
         else:
-            print("\nPlease choose a value between 1 and 5.\n")
+            print("\nPlease choose a value between 1 and 7.\n")
 
 def display_title():
     os.system('clear')
@@ -233,6 +277,8 @@ def get_user_choice():
     print("[3] Run a PakeMail session as initiator over Gmail.")
     print("[4] Run a PakeMail session as responder over Gmail.")
     print("[5] Run a pure SPAKE2 session locally.")
+    print("[6] Run a PakeMail session over an in-process transport.")
+    print("[7] Pick the fastest SPAKE2 group for this machine.")
     print("[q] Quit.")
     
     return input("Which scenario would you like to run? ")
@@ -241,7 +287,13 @@ def quit():
     print("\nQuitting...")
 
 if __name__ == "__main__":
-    
+    # PAKEMAIL_LOG_LEVEL=DEBUG also prints keys, transcripts and tags
+    logging.basicConfig(level=os.environ.get("PAKEMAIL_LOG_LEVEL", "INFO"), format="%(message)s")
+
+    # PAKEMAIL_TRACE=<path> appends one JSON line per traced phase
+    if os.environ.get("PAKEMAIL_TRACE"):
+        paketrace.enableTracing(paketrace.JsonLinesExporter(path=os.environ["PAKEMAIL_TRACE"]))
+
     displayMainMenu()
 
     
\ No newline at end of file
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from paketransport import DISCARD, MailboxReader
+
+_asyncExecutor = None
+_asyncExecutorLock = threading.Lock()
+
+def getAsyncExecutor(maxWorkers=None):
+    # blocking smtplib/imaplib calls and the SPAKE2 steps run here, never on the event loop
+    global _asyncExecutor
+    with _asyncExecutorLock:
+        if _asyncExecutor == None:
+            if maxWorkers == None:
+                maxWorkers = min(32, (os.cpu_count() or 1) + 4)
+            _asyncExecutor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="pakemail")
+    return _asyncExecutor
+
+async def runBlocking(function, *args):
+    loop = asyncio.get_running_loop()
+    # the executor thread sees the caller's context, so its trace spans nest under the caller's
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(getAsyncExecutor(), lambda: context.run(function, *args))
+
+class AsyncSubscription:
+
+    def __init__(self, key, match, future):
+        self.key = key
+        self.match = match
+        self.future = future
+
+    def done(self):
+        return self.future.done()
+
+    def accept(self, delivery):
+        self.future.set_result(delivery)
+
+class AsyncMailboxReader(MailboxReader):
+
+    def __init__(self, transport, classify, loop, pollTimeout=1.0):
+        # the waiters are read from the executor thread while polling
+        MailboxReader.__init__(self, transport, classify, pollTimeout)
+
+        self.loop = loop
+        self.readerTask = None
+
+    async def claim(self, delivery, subscription):
+        if not self.reserve(delivery, subscription):
+            return False
+        # acking rewrites the mailbox state file, like every other transport call it stays off the event loop
+        await runBlocking(self.transport.ack, delivery)
+        return True
+
+    def hasWaiters(self):
+        with self.lock:
+            for key in list(self.waiters.keys()):
+                self.waiters[key] = [subscription for subscription in self.waiters[key] if not subscription.done()]
+                if len(self.waiters[key]) == 0:
+                    del self.waiters[key]
+            return len(self.waiters) > 0
+
+    async def expect(self, key, match, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        subscription = AsyncSubscription(key, match, future)
+        with self.lock:
+            self.waiters.setdefault(key, []).append(subscription)
+
+        if self.readerTask == None or self.readerTask.done():
+            self.readerTask = asyncio.ensure_future(self.readMailbox())
+        else:
+            # the running poll only wakes up for new deliveries, so look for one that is already there
+            for delivery in reversed(await runBlocking(self.transport.collect, self.matchKey(key, match))):
+                if await self.claim(delivery, subscription):
+                    break
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def readMailbox(self):
+        # a single poller per mailbox, whatever the number of waiting sessions
+        while self.hasWaiters():
+            deliveries = await runBlocking(self.transport.wait_for_all, self.matchWaiting, self.pollTimeout)
+            for delivery in deliveries:
+                if delivery.ref in self.claimedRefs:
+                    continue
+                subscription = self.findWaiter(delivery.headers, pop=True)
+                if subscription != None and subscription != DISCARD:
+                    await self.claim(delivery, subscription)
+
+_asyncMailboxReaders = dict()
+_asyncMailboxReadersLock = threading.Lock()
+
+def getAsyncMailboxReader(transport, classify):
+    # one reader per mailbox and event loop, whichever client's transport asks first
+    loop = asyncio.get_running_loop()
+    key = (transport.getMailboxKey(), id(loop))
+    with _asyncMailboxReadersLock:
+        reader = _asyncMailboxReaders.get(key)
+        if reader == None or reader.loop is not loop:
+            reader = AsyncMailboxReader(transport, classify, loop)
+            _asyncMailboxReaders[key] = reader
+    return reader
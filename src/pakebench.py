@@ -0,0 +1,303 @@
+import argparse
+import contextlib
+import email
+import gc
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from spake2 import SPAKE2_A
+from spake2 import SPAKE2_B
+from pakemod import PakeClient, Parameters, FingerprintResolver
+from pakemail import PakeMail, parsePakeHeaders
+from pakeimap import extractAttachments
+from pakehistory import SessionHistoryStore
+
+BENCHMARK_VERSION = 1
+
+# every phase is a factory(group) returning (prepare, run, cleanup): prepare() is not timed, run(prepare()) is
+GROUP_PHASES = ["spake2_start", "spake2_finish", "spake2_exchange", "hkdf", "transcript_mac", "mime_build", "mime_parse", "envelope_build", "envelope_parse"]
+# the same whatever the SPAKE2 group
+COMMON_PHASES = ["gpg_lookup", "gpg_lookup_cold", "history_io"]
+
+PERCENTILES = (50, 90, 99)
+
+class PhaseUnavailable(Exception):
+    pass
+
+def percentile(sortedValues, p):
+    # linear interpolation between the closest ranks
+    if len(sortedValues) == 0:
+        return None
+    position = (len(sortedValues) - 1) * p / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(sortedValues) - 1)
+    return sortedValues[lower] + (sortedValues[upper] - sortedValues[lower]) * (position - lower)
+
+def summarize(samples):
+    samples = sorted(samples)
+    mean = sum(samples) / len(samples)
+    variance = sum((sample - mean) ** 2 for sample in samples) / max(1, len(samples) - 1)
+    summary = dict(mean=mean, min=samples[0], max=samples[-1], stdev=math.sqrt(variance))
+    for p in PERCENTILES:
+        summary["p{0}".format(p)] = percentile(samples, p)
+    return summary
+
+def createBenchmarkClient(side, group, remotePakeMessage=None):
+    client = PakeClient(side, "benchmark", "benchmark+{0}@localhost".format(side), parameters=group)
+    client.pkAfpr = "BD5F3D50B81B4D471F95EFAD00809FFA6F62F85C"
+    client.pkBfpr = "D2E67C6882F939704A2366E9F2256109C435AC2D"
+    client.createInitMsg()
+    if remotePakeMessage != None:
+        client.computeKey(remotePakeMessage)
+    return client
+
+def createSpakePair(group):
+    params = Parameters[group].value
+    return SPAKE2_A(b"benchmark", params=params), SPAKE2_B(b"benchmark", params=params)
+
+def spake2StartPhase(group):
+    params = Parameters[group].value
+    # construction only copies the parameters; start() does the exponentiations
+    return None, lambda prepared: SPAKE2_A(b"benchmark", params=params).start(), None
+
+def spake2FinishPhase(group):
+    def prepare():
+        alice, bob = createSpakePair(group)
+        alice.start()
+        return alice, bob.start()
+    return prepare, lambda prepared: prepared[0].finish(prepared[1]), None
+
+def spake2ExchangePhase(group):
+    # both sides' start and finish, what run_pure_spake2_experiment used to time
+    def run(prepared):
+        alice, bob = createSpakePair(group)
+        aliceOut = alice.start()
+        bobOut = bob.start()
+        alice.finish(bobOut)
+        bob.finish(aliceOut)
+    return None, run, None
+
+def hkdfPhase(group):
+    clientB = createBenchmarkClient("B", group)
+    clientA = createBenchmarkClient("A", group, clientB.pakeMessage)
+    return None, lambda prepared: clientA.runKeyDerivation(), None
+
+def transcriptMacPhase(group):
+    clientB = createBenchmarkClient("B", group)
+    clientA = createBenchmarkClient("A", group, clientB.pakeMessage)
+    _, macKeyA, macKeyB = clientA.runKeyDerivation()
+    def run(prepared):
+        clientA.computeTranscript()
+        clientA.computeMAC(macKeyA, clientA.transcript)
+        clientA.computeMAC(macKeyB, clientA.transcript)
+    return None, run, None
+
+def createBenchmarkPakeMail(group, compactEnvelope):
+    pakeMessage = createBenchmarkClient("A", group).pakeMessage
+    pakeMail = PakeMail("A", "benchmark+A@localhost", "benchmark+B@localhost", pakeMessage=pakeMessage, compactEnvelope=compactEnvelope)
+    pakeMail.group = group
+    return pakeMail
+
+def mimeBuildPhase(group, compactEnvelope=False):
+    # as sent on the wire
+    pakeMail = createBenchmarkPakeMail(group, compactEnvelope)
+    return None, lambda prepared: pakeMail.buildMailMessage().as_bytes(), None
+
+def mimeParsePhase(group, compactEnvelope=False):
+    # what a receiver does with a downloaded message before SPAKE2 sees it
+    raw = createBenchmarkPakeMail(group, compactEnvelope).buildMailMessage().as_bytes()
+    def run(prepared):
+        message = email.message_from_bytes(raw)
+        parsePakeHeaders(message)
+        extractAttachments(message)
+    return None, run, None
+
+def envelopeBuildPhase(group):
+    return mimeBuildPhase(group, compactEnvelope=True)
+
+def envelopeParsePhase(group):
+    return mimeParsePhase(group, compactEnvelope=True)
+
+def createFingerprintResolver():
+    resolver = FingerprintResolver()
+    try:
+        resolver.lookup("benchmark@localhost")
+    except (OSError, ValueError, RuntimeError) as e:
+        raise PhaseUnavailable("GPG is not usable here: {0}".format(e))
+    return resolver
+
+def gpgLookupPhase(group):
+    # keyring unchanged, answered from the in-process index
+    resolver = createFingerprintResolver()
+    return None, lambda prepared: resolver.lookup("benchmark@localhost"), None
+
+def gpgLookupColdPhase(group):
+    # the first lookup, or the first after the keyring changed: one gpg subprocess
+    resolver = createFingerprintResolver()
+    return resolver.invalidate, lambda prepared: resolver.lookup("benchmark@localhost"), None
+
+def historyPhase(group):
+    # one replay check and one record, as for every finished session
+    folder = tempfile.mkdtemp(prefix="pakebench")
+    store = SessionHistoryStore(os.path.join(folder, "session_history.db"))
+    def run(sessionID):
+        store.seen(sessionID, "A")
+        store.record(sessionID, "A")
+    def cleanup():
+        store.close()
+        shutil.rmtree(folder, ignore_errors=True)
+    return lambda: str(uuid.uuid4()), run, cleanup
+
+PHASES = {
+    "spake2_start": spake2StartPhase,
+    "spake2_finish": spake2FinishPhase,
+    "spake2_exchange": spake2ExchangePhase,
+    "hkdf": hkdfPhase,
+    "transcript_mac": transcriptMacPhase,
+    "mime_build": mimeBuildPhase,
+    "mime_parse": mimeParsePhase,
+    "envelope_build": envelopeBuildPhase,
+    "envelope_parse": envelopeParsePhase,
+    "gpg_lookup": gpgLookupPhase,
+    "gpg_lookup_cold": gpgLookupColdPhase,
+    "history_io": historyPhase,
+}
+
+def measurePhase(prepare, run, iterations, warmup):
+    # wall time with perf_counter; CPU time of this thread only, so background threads
+    # do not count, and neither do subprocesses such as gpg
+    wallSamples = []
+    cpuSamples = []
+
+    gc.collect()
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(warmup + iterations):
+            prepared = prepare() if prepare != None else None
+
+            wallStart = time.perf_counter()
+            cpuStart = time.thread_time()
+            run(prepared)
+            cpuElapsed = time.thread_time() - cpuStart
+            wallElapsed = time.perf_counter() - wallStart
+
+            if i >= warmup:
+                wallSamples.append(wallElapsed)
+                cpuSamples.append(cpuElapsed)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+    return dict(wall=summarize(wallSamples), cpu=summarize(cpuSamples))
+
+def runPhase(phase, group, iterations, warmup):
+    # the phases' own debug output (transcripts, fingerprints) is not what is measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        prepare, run, cleanup = PHASES[phase](group)
+        try:
+            measurement = measurePhase(prepare, run, iterations, warmup)
+        finally:
+            if cleanup != None:
+                cleanup()
+
+    measurement.update(phase=phase, group=group, iterations=iterations, warmup=warmup)
+    return measurement
+
+def getBenchmarkEnvironment():
+    return dict(python=sys.version.split()[0], implementation=platform.python_implementation(), machine=platform.machine(), system=platform.system(), cpuCount=os.cpu_count())
+
+def run_benchmark(groups=None, phases=None, iterations=50, warmup=5, verbose=True):
+    if groups == None:
+        groups = [parameters.name for parameters in Parameters]
+    if phases == None:
+        phases = GROUP_PHASES + COMMON_PHASES
+
+    results = dict(version=BENCHMARK_VERSION, createdAt=time.time(), environment=getBenchmarkEnvironment(), measurements=[], skipped=[])
+    for phase in phases:
+        phaseGroups = groups if phase in GROUP_PHASES else [None]
+        for group in phaseGroups:
+            try:
+                measurement = runPhase(phase, group, iterations, warmup)
+            except PhaseUnavailable as e:
+                results["skipped"].append(dict(phase=phase, group=group, reason=str(e)))
+                if verbose:
+                    print("{0}: skipped, {1}".format(phase, e))
+                break
+
+            results["measurements"].append(measurement)
+            if verbose:
+                printMeasurement(measurement)
+    return results
+
+def formatDuration(seconds):
+    if seconds < 1e-3:
+        return "{0:.1f}us".format(seconds * 1e6)
+    return "{0:.2f}ms".format(seconds * 1e3)
+
+def printMeasurement(measurement):
+    wall = measurement["wall"]
+    print("{0:<16} {1:<8} wall p50 {2:>9} p90 {3:>9} p99 {4:>9}  cpu p50 {5:>9}".format(measurement["phase"], measurement["group"] or "-", formatDuration(wall["p50"]), formatDuration(wall["p90"]), formatDuration(wall["p99"]), formatDuration(measurement["cpu"]["p50"])))
+
+def saveResults(results, path):
+    with open(path, "w") as resultsFile:
+        json.dump(results, resultsFile, indent=2, sort_keys=True)
+
+def loadResults(path):
+    with open(path, "r") as resultsFile:
+        results = json.load(resultsFile)
+    if results.get("version") != BENCHMARK_VERSION:
+        raise ValueError("unsupported benchmark results version {0}".format(results.get("version")))
+    return results
+
+def compareWithBaseline(results, baseline, tolerance=0.10, statistic="p50", clock="wall"):
+    # phases slower than the baseline by more than the tolerance; medians by default, as they
+    # are the least sensitive to the odd scheduling hiccup
+    baselineMeasurements = dict(((measurement["phase"], measurement["group"]), measurement) for measurement in baseline["measurements"])
+
+    regressions = []
+    for measurement in results["measurements"]:
+        baselineMeasurement = baselineMeasurements.get((measurement["phase"], measurement["group"]))
+        if baselineMeasurement == None:
+            continue
+        current = measurement[clock][statistic]
+        previous = baselineMeasurement[clock][statistic]
+        if previous > 0 and current > previous * (1 + tolerance):
+            regressions.append(dict(phase=measurement["phase"], group=measurement["group"], baseline=previous, current=current, ratio=current / previous))
+    return regressions
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Per-phase PakeMail benchmark")
+    parser.add_argument("--groups", nargs="+", choices=[parameters.name for parameters in Parameters])
+    parser.add_argument("--phases", nargs="+", choices=GROUP_PHASES + COMMON_PHASES)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown against the baseline, 0.10 for 10%%")
+    options = parser.parse_args(arguments)
+
+    results = run_benchmark(groups=options.groups, phases=options.phases, iterations=options.iterations, warmup=options.warmup)
+    if options.json != None:
+        saveResults(results, options.json)
+
+    if options.baseline == None:
+        return 0
+
+    regressions = compareWithBaseline(results, loadResults(options.baseline), tolerance=options.tolerance)
+    for regression in regressions:
+        print("REGRESSION {0} {1}: {2} -> {3} ({4:.2f}x)".format(regression["phase"], regression["group"] or "-", formatDuration(regression["baseline"]), formatDuration(regression["current"]), regression["ratio"]))
+    if len(regressions) == 0:
+        print("No regression against {0}.".format(options.baseline))
+        return 0
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
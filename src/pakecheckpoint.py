@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+class PakeCheckpointStore:
+
+    def __init__(self, path="/tmp/pakemail/checkpoints"):
+        # one small JSON file per pending session; they hold SPAKE2 secrets, so only the owner may read them
+        self.path = path
+        self.lock = threading.Lock()
+
+    def getCheckpointPath(self, sessionID, side):
+        return os.path.join(self.path, "{0}_{1}.json".format(sessionID, side))
+
+    def save(self, checkpoint):
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, mode=0o700)
+
+            checkpointPath = self.getCheckpointPath(checkpoint["sessionID"], checkpoint["side"])
+            tmpPath = "{0}.{1}.tmp".format(checkpointPath, os.getpid())
+            fileDescriptor = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fileDescriptor, "w") as checkpointFile:
+                json.dump(checkpoint, checkpointFile, separators=(",", ":"))
+            os.replace(tmpPath, checkpointPath)
+
+    def load(self, sessionID, side):
+        checkpointPath = self.getCheckpointPath(sessionID, side)
+        try:
+            with open(checkpointPath, "r") as checkpointFile:
+                checkpoint = json.load(checkpointFile)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning("Unreadable checkpoint for session %s, ignoring it.", sessionID)
+            return None
+
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            logger.warning("Checkpoint for session %s has an unsupported version, ignoring it.", sessionID)
+            return None
+
+        return checkpoint
+
+    def remove(self, sessionID, side):
+        try:
+            os.remove(self.getCheckpointPath(sessionID, side))
+        except FileNotFoundError:
+            pass
+
+    def list(self):
+        # (session ID, side) of every stored checkpoint, e.g. after a restart
+        if not os.path.isdir(self.path):
+            return []
+
+        keys = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".json"):
+                continue
+            sessionID, _, side = filename[:-len(".json")].rpartition("_")
+            keys.append((sessionID, side))
+        return keys
@@ -0,0 +1,351 @@
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from spake2 import SPAKE2_A
+from spake2 import SPAKE2_B
+
+logger = logging.getLogger(__name__)
+
+def createSpake(side, password, params):
+    idA_bytes = bytes("A", encoding='utf-8')
+    idB_bytes = bytes("B", encoding='utf-8')
+    if side == "A":
+        return SPAKE2_A(idA=idA_bytes, idB=idB_bytes, password=bytes(password, encoding='utf-8'), params=params)
+    return SPAKE2_B(idA=idA_bytes, idB=idB_bytes, password=bytes(password, encoding='utf-8'), params=params)
+
+def restoreSpake(side, spakeState, params):
+    if side == "A":
+        return SPAKE2_A.from_serialized(spakeState, params=params)
+    return SPAKE2_B.from_serialized(spakeState, params=params)
+
+def getGroupParams(groupName):
+    # imported here so that worker processes resolve the group by name, not by pickling the parameter set
+    from pakemod import Parameters
+    return Parameters[groupName].value
+
+def startSpake(side, password, groupName):
+    pake = createSpake(side, password, getGroupParams(groupName))
+    pakeMessage = pake.start()
+    return pake.serialize(), pakeMessage
+
+def finishSpake(side, spakeState, groupName, remotePakeMessage):
+    pake = restoreSpake(side, spakeState, getGroupParams(groupName))
+    return pake.finish(remotePakeMessage)
+
+class InlineComputeBackend:
+
+    # SPAKE2 start/finish on the calling thread, holding the GIL for the whole computation
+    def precompute(self, side, password, groupName):
+        pake = createSpake(side, password, getGroupParams(groupName))
+        return pake, None, pake.start()
+
+    def start(self, pakeClient):
+        if pakeClient.pake == None:
+            pakeClient.pake = createSpake(pakeClient.side, pakeClient.password, pakeClient.getSpakeParams())
+        return pakeClient.pake.start()
+
+    def finish(self, pakeClient, remotePakeMessage):
+        if pakeClient.pake == None:
+            # restored from a checkpoint or started by another backend
+            pakeClient.pake = restoreSpake(pakeClient.side, pakeClient.spakeState, pakeClient.getSpakeParams())
+        return pakeClient.pake.finish(remotePakeMessage)
+
+    def close(self):
+        pass
+
+class ProcessPoolComputeBackend:
+
+    def __init__(self, maxWorkers=None):
+        # the modular exponentiations of the integer groups run in worker processes, one per core by default
+        if maxWorkers == None:
+            maxWorkers = os.cpu_count() or 1
+        self.maxWorkers = maxWorkers
+        self.executor = ProcessPoolExecutor(max_workers=maxWorkers)
+
+    def precompute(self, side, password, groupName):
+        # only the serialized state stays in this process, the next step may run in any worker
+        spakeState, pakeMessage = self.executor.submit(startSpake, side, password, groupName).result()
+        return None, spakeState, pakeMessage
+
+    def start(self, pakeClient):
+        pakeClient.pake, pakeClient.spakeState, pakeMessage = self.precompute(pakeClient.side, pakeClient.password, pakeClient.getGroupName())
+        return pakeMessage
+
+    def finish(self, pakeClient, remotePakeMessage):
+        spakeState = pakeClient.spakeState
+        if pakeClient.pake != None:
+            spakeState = pakeClient.pake.serialize()
+        return self.executor.submit(finishSpake, pakeClient.side, spakeState, pakeClient.getGroupName(), remotePakeMessage).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+_inlineComputeBackend = InlineComputeBackend()
+_computeBackend = None
+_computeBackendLock = threading.Lock()
+
+def getComputeBackend():
+    if _computeBackend == None:
+        return _inlineComputeBackend
+    return _computeBackend
+
+def setComputeBackend(computeBackend):
+    # process-wide default for clients without their own backend; None goes back to inline
+    global _computeBackend
+    with _computeBackendLock:
+        previous = _computeBackend
+        _computeBackend = computeBackend
+    if previous != None and previous is not computeBackend:
+        previous.close()
+
+def samePassword(password, otherPassword):
+    return hmac.compare_digest(bytes(password, encoding='utf-8'), bytes(otherPassword, encoding='utf-8'))
+
+class PrecomputedStart:
+
+    def __init__(self, pake, spakeState, pakeMessage):
+        self.pake = pake
+        self.spakeState = spakeState
+        self.pakeMessage = pakeMessage
+        self.createdAt = time.monotonic()
+
+class PrecomputedStartPool:
+
+    def __init__(self, size=16, refillThreshold=8, maxAge=600, computeBackend=None):
+        # ready SPAKE2 first flows per (password handle, group, role), produced in the background
+        self.size = size
+        self.refillThreshold = refillThreshold
+
+        # unused states are dropped after maxAge seconds, so secrets do not linger in memory
+        self.maxAge = maxAge
+        self.computeBackend = computeBackend
+
+        # password handle -> password; entries are keyed by handle so the password is never a dict key
+        self.passwords = dict()
+        # (password handle, group name, side) -> deque of PrecomputedStart
+        self.entries = dict()
+        # keys still to be filled up to size once they dropped below the threshold
+        self.refilling = set()
+
+        self.condition = threading.Condition()
+        self.producerThread = None
+        self.stopEvent = threading.Event()
+
+        self.hitCount = 0
+        self.missCount = 0
+
+        # a key whose precomputation fails maxFailures times in a row is dropped, with a growing pause between tries
+        self.failureCounts = dict()
+        self.maxFailures = 3
+        self.failureBackoff = 1.0
+
+    def getComputeBackend(self):
+        if self.computeBackend != None:
+            return self.computeBackend
+        return getComputeBackend()
+
+    def register(self, passwordHandle, password, groupName, side):
+        key = (passwordHandle, groupName, side)
+        with self.condition:
+            registeredPassword = self.passwords.get(passwordHandle)
+            if registeredPassword != None and not samePassword(registeredPassword, password):
+                # the password behind the handle changed; nothing computed for the old one may be used
+                self.forgetHandle(passwordHandle)
+            self.passwords[passwordHandle] = password
+
+            if not key in self.entries:
+                self.entries[key] = deque()
+                self.refilling.add(key)
+            self.condition.notify_all()
+
+        self.startProducer()
+        return key
+
+    def forgetHandle(self, passwordHandle):
+        self.passwords.pop(passwordHandle, None)
+        for key in [key for key in self.entries.keys() if key[0] == passwordHandle]:
+            self.entries[key].clear()
+            del self.entries[key]
+            self.refilling.discard(key)
+
+    def unregister(self, passwordHandle):
+        with self.condition:
+            self.forgetHandle(passwordHandle)
+
+    def take(self, passwordHandle, password, groupName, side):
+        # each precomputed state leaves the pool exactly once; None when the caller has to compute its own
+        key = (passwordHandle, groupName, side)
+        with self.condition:
+            registeredPassword = self.passwords.get(passwordHandle)
+            if registeredPassword != None and not samePassword(registeredPassword, password):
+                # only register() may change the password behind a handle
+                self.missCount += 1
+                return None
+
+            precomputedStart = None
+            if key in self.entries:
+                entries = self.entries[key]
+                while len(entries) > 0 and precomputedStart == None:
+                    precomputedStart = entries.popleft()
+                    if time.monotonic() - precomputedStart.createdAt > self.maxAge:
+                        precomputedStart = None
+
+                if len(entries) < self.refillThreshold:
+                    self.refilling.add(key)
+                    self.condition.notify_all()
+
+            if precomputedStart != None:
+                self.hitCount += 1
+            else:
+                self.missCount += 1
+
+            # later sessions with this key find the pool filled
+            register = not key in self.entries
+
+        if register:
+            self.register(passwordHandle, password, groupName, side)
+
+        return precomputedStart
+
+    def available(self, passwordHandle, groupName, side):
+        with self.condition:
+            return len(self.entries.get((passwordHandle, groupName, side), []))
+
+    def nextKeyToRefill(self):
+        for key in list(self.refilling):
+            entries = self.entries.get(key)
+            if entries == None or len(entries) >= self.size:
+                self.refilling.discard(key)
+            else:
+                return key
+        return None
+
+    def dropExpired(self):
+        now = time.monotonic()
+        for key, entries in self.entries.items():
+            while len(entries) > 0 and now - entries[0].createdAt > self.maxAge:
+                entries.popleft()
+            if len(entries) < self.refillThreshold:
+                self.refilling.add(key)
+
+    def startProducer(self):
+        with self.condition:
+            if self.producerThread != None and self.producerThread.is_alive():
+                return
+            self.stopEvent.clear()
+            self.producerThread = threading.Thread(target=self.runProducer, daemon=True)
+            self.producerThread.start()
+
+    def runProducer(self):
+        while not self.stopEvent.is_set():
+            with self.condition:
+                self.dropExpired()
+                key = self.nextKeyToRefill()
+                if key == None:
+                    self.condition.wait(self.maxAge / 2)
+                    continue
+                password = self.passwords[key[0]]
+
+            try:
+                pake, spakeState, pakeMessage = self.getComputeBackend().precompute(key[2], password, key[1])
+            except Exception as e:
+                # e.g. a broken process pool; the producer must outlive it
+                self.stopEvent.wait(self.recordFailure(key, e))
+                continue
+
+            with self.condition:
+                self.failureCounts.pop(key, None)
+                # the handle may have been dropped or re-registered in the meantime
+                if self.entries.get(key) != None and self.passwords.get(key[0]) is password:
+                    self.entries[key].append(PrecomputedStart(pake, spakeState, pakeMessage))
+
+    def recordFailure(self, key, error):
+        # returns how long the producer pauses before its next try
+        with self.condition:
+            failures = self.failureCounts.get(key, 0) + 1
+            self.failureCounts[key] = failures
+            if failures < self.maxFailures:
+                logger.warning("Precomputing a %s SPAKE2 start for side %s failed, retrying: %s", key[1], key[2], error)
+                return self.failureBackoff * 2 ** (failures - 1)
+
+            # sessions compute their own starts; the next take() registers the key again
+            logger.warning("Precomputing %s SPAKE2 starts for side %s failed %s times, no longer filling them: %s", key[1], key[2], failures, error)
+            self.failureCounts.pop(key)
+            self.refilling.discard(key)
+            entries = self.entries.pop(key, None)
+            if entries != None:
+                entries.clear()
+            return self.failureBackoff
+
+    def close(self):
+        self.stopEvent.set()
+        with self.condition:
+            for passwordHandle in list(self.passwords.keys()):
+                self.forgetHandle(passwordHandle)
+            self.condition.notify_all()
+
+_precomputedStartPool = None
+_precomputedStartPoolLock = threading.Lock()
+
+def getPrecomputedStartPool():
+    global _precomputedStartPool
+    with _precomputedStartPoolLock:
+        if _precomputedStartPool == None:
+            _precomputedStartPool = PrecomputedStartPool()
+    return _precomputedStartPool
+
+def runHandshake(computeBackend, groupName):
+    from pakemod import PakeClient
+
+    pakeClientA = PakeClient("A", "pass", "benchmark+A@localhost", parameters=groupName)
+    pakeClientB = PakeClient("B", "pass", "benchmark+B@localhost", parameters=groupName)
+    pakeClientA.computeBackend = computeBackend
+    pakeClientB.computeBackend = computeBackend
+
+    pakeMsgA = pakeClientA.createInitMsg()
+    pakeMsgB = pakeClientB.createInitMsg()
+    pakeClientA.computeKey(pakeMsgB)
+    pakeClientB.computeKey(pakeMsgA)
+
+    return pakeClientA.key == pakeClientB.key
+
+def measureHandshakeThroughput(computeBackend, groupName, handshakes, concurrency):
+    # concurrent sessions as they would run in one process, e.g. under PakeSessionManager or asyncio
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: runHandshake(computeBackend, groupName), range(handshakes)))
+    elapsed = time.perf_counter() - start
+
+    if not all(results):
+        print("Some handshakes did not agree on the key!")
+    return handshakes / elapsed
+
+def run_compute_benchmark(groupName="p3072", handshakes=64, concurrency=16):
+    print("SPAKE2 handshakes per second with the {0} group, {1} handshakes, {2} concurrent sessions".format(groupName, handshakes, concurrency))
+
+    # keep the inline run short, it does not scale with cores anyway
+    inlineRate = measureHandshakeThroughput(InlineComputeBackend(), groupName, max(1, handshakes // 4), concurrency)
+    print("inline:\t\t\t{0:.1f}".format(inlineRate))
+
+    workerCounts = []
+    workers = 1
+    while workers < (os.cpu_count() or 1):
+        workerCounts.append(workers)
+        workers *= 2
+    workerCounts.append(os.cpu_count() or 1)
+
+    for workers in workerCounts:
+        computeBackend = ProcessPoolComputeBackend(maxWorkers=workers)
+        # spawns the workers before measuring
+        measureHandshakeThroughput(computeBackend, groupName, workers, workers)
+
+        rate = measureHandshakeThroughput(computeBackend, groupName, handshakes, concurrency)
+        print("process pool, {0} workers:\t{1:.1f} ({2:.1f}x)".format(workers, rate, rate / inlineRate))
+        computeBackend.close()
+
+if __name__ == "__main__":
+    run_compute_benchmark()
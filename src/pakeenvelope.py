@@ -0,0 +1,150 @@
+import base64
+import binascii
+import logging
+import struct
+
+# Envelope layout, all integers big endian:
+#   magic "PKM" | version u8 | flags u8 | group u8 | role u8 | phase u8
+#   | session ID length u8 | session ID (UTF-8)
+#   | payload length u16 | payload (SPAKE2 message, or the tag in the KC phase)
+#   | tag length u8 | tag (piggybacked key confirmation tag, three-flow mode)
+logger = logging.getLogger(__name__)
+
+ENVELOPE_MAGIC = b"PKM"
+ENVELOPE_VERSION = 1
+
+FLAG_THREE_FLOWS = 0x01
+# X-PakeMail-Flows value behind FLAG_THREE_FLOWS: the responder's PAKE email also carries its key confirmation tag
+THREE_FLOWS = "3"
+
+PHASE_CODES = {"pake": 0, "kc": 1}
+GROUP_CODES = {None: 0, "ed25519": 1, "p1024": 2, "p2048": 3, "p3072": 4}
+ROLE_CODES = {"A": 1, "B": 2}
+
+PHASE_NAMES = {code: name for name, code in PHASE_CODES.items()}
+GROUP_NAMES = {code: name for name, code in GROUP_CODES.items()}
+ROLE_NAMES = {code: name for name, code in ROLE_CODES.items()}
+
+_header = struct.Struct(">3sBBBBB")
+_u8 = struct.Struct(">B")
+_u16 = struct.Struct(">H")
+
+class EnvelopeError(ValueError):
+    pass
+
+class PakeEnvelope:
+
+    def __init__(self, role, phase, pakeMailID, payload, tag=None, group=None, flags=0):
+        self.role = role
+        self.phase = phase
+        self.pakeMailID = pakeMailID
+        self.payload = payload
+        self.tag = tag
+        self.group = group
+        self.flags = flags
+
+    def isKeyConfirmation(self):
+        return self.phase == "kc"
+
+    def getAttachments(self):
+        # the same filename -> bytes mapping as the MIME attachments of a PakeMail
+        if self.isKeyConfirmation():
+            return {"pakemac{0}".format(self.role): bytes(self.payload)}
+
+        attachments = {"pakemsg{0}".format(self.role): bytes(self.payload)}
+        if self.tag != None:
+            attachments["pakemac{0}".format(self.role)] = bytes(self.tag)
+        return attachments
+
+def flagsFromFlows(flows):
+    if flows == THREE_FLOWS:
+        return FLAG_THREE_FLOWS
+    return 0
+
+def flowsFromFlags(flags):
+    if flags & FLAG_THREE_FLOWS:
+        return THREE_FLOWS
+    return None
+
+def packEnvelope(envelope):
+    pakeMailID = bytes(str(envelope.pakeMailID), encoding="utf-8")
+    tag = envelope.tag if envelope.tag != None else b""
+
+    if len(pakeMailID) > 0xff or len(envelope.payload) > 0xffff or len(tag) > 0xff:
+        raise EnvelopeError("envelope field too long")
+
+    try:
+        header = _header.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, envelope.flags, GROUP_CODES[envelope.group], ROLE_CODES[envelope.role], PHASE_CODES[envelope.phase])
+    except KeyError as e:
+        raise EnvelopeError("unknown envelope value {0}".format(e))
+
+    return b"".join([
+        header,
+        _u8.pack(len(pakeMailID)), pakeMailID,
+        _u16.pack(len(envelope.payload)), bytes(envelope.payload),
+        _u8.pack(len(tag)), bytes(tag),
+    ])
+
+def parseEnvelope(data):
+    # payload and tag are memoryview slices of data, nothing is copied
+    view = memoryview(data)
+    if len(view) < _header.size:
+        raise EnvelopeError("truncated envelope header")
+
+    magic, version, flags, groupCode, roleCode, phaseCode = _header.unpack_from(view, 0)
+    if magic != ENVELOPE_MAGIC:
+        raise EnvelopeError("not a PakeMail envelope")
+    if version != ENVELOPE_VERSION:
+        raise EnvelopeError("unsupported envelope version {0}".format(version))
+    if not groupCode in GROUP_NAMES or not roleCode in ROLE_NAMES or not phaseCode in PHASE_NAMES:
+        raise EnvelopeError("unknown group, role or phase code")
+
+    offset = _header.size
+    pakeMailID, offset = readField(view, offset, _u8)
+    payload, offset = readField(view, offset, _u16)
+    tag, offset = readField(view, offset, _u8)
+    if offset != len(view):
+        raise EnvelopeError("trailing bytes after the envelope")
+
+    try:
+        pakeMailID = str(pakeMailID, encoding="utf-8")
+    except UnicodeDecodeError:
+        raise EnvelopeError("session ID is not UTF-8")
+
+    if len(tag) == 0:
+        tag = None
+
+    return PakeEnvelope(ROLE_NAMES[roleCode], PHASE_NAMES[phaseCode], pakeMailID, payload, tag=tag, group=GROUP_NAMES[groupCode], flags=flags)
+
+def readField(view, offset, lengthStruct):
+    if offset + lengthStruct.size > len(view):
+        raise EnvelopeError("truncated envelope")
+    length, = lengthStruct.unpack_from(view, offset)
+    offset += lengthStruct.size
+    if offset + length > len(view):
+        raise EnvelopeError("truncated envelope")
+    return view[offset:offset + length], offset + length
+
+def encodeEnvelopeHeader(envelope):
+    return base64.b64encode(packEnvelope(envelope)).decode("ascii")
+
+def decodeEnvelopeHeader(value):
+    if value == None:
+        return None
+    # folding may have put whitespace into a long header
+    try:
+        data = base64.b64decode("".join(str(value).split()), validate=True)
+    except (binascii.Error, ValueError):
+        raise EnvelopeError("envelope header is not base64")
+    return parseEnvelope(data)
+
+def getEnvelope(message):
+    # None for emails without the X-PakeMail-Envelope header, or with a broken one
+    value = message['X-PakeMail-Envelope']
+    if value == None:
+        return None
+    try:
+        return decodeEnvelopeHeader(value)
+    except EnvelopeError as e:
+        logger.warning("Ignoring a malformed PakeMail envelope: %s", e)
+        return None
@@ -0,0 +1,114 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SessionHistoryStore:
+
+    def __init__(self, path="/tmp/pakemail/session_history.db", ttl=None, busyTimeout=30.0):
+        self.path = path
+
+        # seconds a session ID is kept for replay detection, None keeps it forever
+        self.ttl = ttl
+        self.busyTimeout = busyTimeout
+
+        # sqlite3 connections cannot be shared between threads
+        self.local = threading.local()
+
+        self.recordCount = 0
+        self.evictEvery = 1000
+
+    def getConnection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection == None:
+            folder = os.path.dirname(self.path)
+            if folder != "" and not os.path.isdir(folder):
+                os.makedirs(folder)
+
+            # autocommit; WAL lets readers in other processes go on while one of them writes
+            connection = sqlite3.connect(self.path, timeout=self.busyTimeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS session_history (side TEXT NOT NULL, session_id TEXT NOT NULL, recorded_at REAL NOT NULL, PRIMARY KEY (side, session_id)) WITHOUT ROWID")
+            connection.execute("CREATE INDEX IF NOT EXISTS session_history_recorded_at ON session_history (recorded_at)")
+            self.local.connection = connection
+        return connection
+
+    def getOldestValidTime(self):
+        if self.ttl == None:
+            return float(0)
+        return time.time() - self.ttl
+
+    def seen(self, sessionID, side):
+        row = self.getConnection().execute("SELECT 1 FROM session_history WHERE side = ? AND session_id = ? AND recorded_at >= ?", (side, str(sessionID), self.getOldestValidTime())).fetchone()
+        return row != None
+
+    def record(self, sessionID, side):
+        self.getConnection().execute("INSERT OR REPLACE INTO session_history (side, session_id, recorded_at) VALUES (?, ?, ?)", (side, str(sessionID), time.time()))
+
+        self.recordCount += 1
+        if self.ttl != None and self.recordCount % self.evictEvery == 0:
+            self.evictExpired()
+
+    def evictExpired(self):
+        if self.ttl == None:
+            return 0
+        cursor = self.getConnection().execute("DELETE FROM session_history WHERE recorded_at < ?", (self.getOldestValidTime(),))
+        return cursor.rowcount
+
+    def count(self, side=None):
+        if side == None:
+            row = self.getConnection().execute("SELECT COUNT(*) FROM session_history").fetchone()
+        else:
+            row = self.getConnection().execute("SELECT COUNT(*) FROM session_history WHERE side = ?", (side,)).fetchone()
+        return row[0]
+
+    def importPickle(self, path, side):
+        # session_history{side}.txt files written by earlier versions: a pickled dict of session ID -> True
+        with open(path, "rb") as handle:
+            sessionHistory = pickle.load(handle)
+
+        recordedAt = os.path.getmtime(path)
+        connection = self.getConnection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany("INSERT OR IGNORE INTO session_history (side, session_id, recorded_at) VALUES (?, ?, ?)", [(side, str(sessionID), recordedAt) for sessionID in sessionHistory.keys()])
+        return len(sessionHistory)
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection != None:
+            connection.close()
+            self.local.connection = None
+
+_sessionHistoryStores = dict()
+_sessionHistoryStoresLock = threading.Lock()
+
+def getSessionHistoryStore(path="/tmp/pakemail/session_history.db"):
+    with _sessionHistoryStoresLock:
+        store = _sessionHistoryStores.get(path)
+        if store == None:
+            store = SessionHistoryStore(path)
+            _sessionHistoryStores[path] = store
+    return store
+
+def importLegacySessionHistory(store, side, path=None):
+    # done once: the pickle file is renamed afterwards so it is not imported again
+    if path == None:
+        path = "/tmp/pakemail/session_history{0}.txt".format(side)
+    if not os.path.isfile(path):
+        return 0
+
+    try:
+        importedCount = store.importPickle(path, side)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        logger.warning("Could not import the session history in %s: %s", path, e)
+        return 0
+
+    os.replace(path, path + ".imported")
+    logger.info("Imported %s session IDs from %s.", importedCount, path)
+    return importedCount
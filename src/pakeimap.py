@@ -0,0 +1,824 @@
+import base64
+import email
+import email.parser
+import hashlib
+import imaplib
+import itertools
+import json
+import logging
+import os
+import quopri
+import select
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pakeenvelope import getEnvelope
+from paketrace import getTracer
+from pakesmtp import SECURITY_SSL, SECURITY_STARTTLS
+
+logger = logging.getLogger(__name__)
+
+class PooledImapConnection:
+
+    def __init__(self, server, username, password, mailbox='inbox', port=None, security=SECURITY_SSL, sslContext=None):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.mailbox = mailbox
+
+        # port None is the default port of the security mode
+        self.port = port
+        self.security = security
+        self.sslContext = sslContext
+
+        self.mail = None
+        self.uidValidity = None
+        self.lastUsed = float(0)
+
+        # imaplib's own tags are upper case, so these never collide with them
+        self.idleTags = itertools.count(1)
+
+        self.lock = threading.Lock()
+        self.waiters = 0
+        self.waitersLock = threading.Lock()
+
+    def acquire(self):
+        # a connection sitting in IDLE gives way as soon as somebody else needs it
+        with self.waitersLock:
+            self.waiters += 1
+        self.lock.acquire()
+        with self.waitersLock:
+            self.waiters -= 1
+
+    def release(self):
+        self.lock.release()
+
+    def isConnected(self):
+        return self.mail != None
+
+    def connect(self):
+        if self.security == SECURITY_SSL:
+            self.mail = imaplib.IMAP4_SSL(self.server, self.port or imaplib.IMAP4_SSL_PORT, ssl_context=self.sslContext)
+        else:
+            self.mail = imaplib.IMAP4(self.server, self.port or imaplib.IMAP4_PORT)
+            if self.security == SECURITY_STARTTLS:
+                self.mail.starttls(ssl_context=self.sslContext)
+        self.mail.login(self.username, self.password)
+        self.mail.select(self.mailbox)
+        _, data = self.mail.response('UIDVALIDITY')
+        self.uidValidity = int(data[0]) if data and data[0] else None
+        self.lastUsed = time.monotonic()
+
+    def disconnect(self):
+        mail = self.mail
+        self.mail = None
+        if mail == None:
+            return
+
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def noop(self):
+        getTracer().count("imap_round_trips")
+        try:
+            status, _ = self.mail.noop()
+        except (imaplib.IMAP4.error, OSError):
+            status = None
+
+        if status != 'OK':
+            self.disconnect()
+            return False
+
+        self.lastUsed = time.monotonic()
+        return True
+
+    def supportsIdle(self):
+        return 'IDLE' in self.mail.capabilities
+
+    def idle(self, timeout, cancelEvent=None, checkInterval=1.0):
+        # returns whether the server announced new messages, or None without IDLE support
+        mail = self.mail
+        if not self.supportsIdle():
+            return None
+
+        tag = "pkidle{0}".format(next(self.idleTags)).encode("ascii")
+        mail.send(tag + b' IDLE\r\n')
+
+        line = mail.readline()
+        if not line.startswith(b'+'):
+            while not line.startswith(tag):
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed while entering IDLE")
+                line = mail.readline()
+            return None
+
+        newMessages = False
+        deadline = time.monotonic() + timeout
+        sock = mail.sock
+        while not newMessages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.waiters > 0 or (cancelEvent != None and cancelEvent.is_set()):
+                break
+
+            if not self.hasBufferedData():
+                if not (hasattr(sock, 'pending') and sock.pending() > 0):
+                    if len(select.select([sock], [], [], min(checkInterval, remaining))[0]) == 0:
+                        continue
+
+            line = mail.readline()
+            if not line or line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if line.startswith(b'* ') and (line.rstrip().endswith(b'EXISTS') or line.rstrip().endswith(b'RECENT')):
+                newMessages = True
+
+        mail.send(b'DONE\r\n')
+        line = mail.readline()
+        while not line.startswith(tag):
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+            if line.startswith(b'* ') and line.rstrip().endswith(b'EXISTS'):
+                newMessages = True
+            line = mail.readline()
+
+        self.lastUsed = time.monotonic()
+        return newMessages
+
+    def hasBufferedData(self):
+        # imaplib reads through a buffered file: the EXISTS line may already sit in it, behind
+        # the continuation or another untagged line, while select() sees nothing on the socket
+        sock = self.mail.sock
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return len(self.mail.file.peek(1)) > 0
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+class ImapConnectionPool:
+
+    def __init__(self, keepaliveInterval=60):
+        self.keepaliveInterval = keepaliveInterval
+
+        self.connections = dict()
+        self.lock = threading.Lock()
+
+        self.keepaliveThread = None
+        self.stopEvent = threading.Event()
+
+    def getPooledConnection(self, server, username, password, mailbox='inbox', port=None, security=SECURITY_SSL, sslContext=None):
+        # a connection holds its selected mailbox and UIDVALIDITY, so other mailboxes of the account get their own
+        key = (server, port, username, mailbox)
+        with self.lock:
+            pooled = self.connections.get(key)
+            if pooled == None:
+                pooled = PooledImapConnection(server, username, password, mailbox=mailbox, port=port, security=security, sslContext=sslContext)
+                self.connections[key] = pooled
+            else:
+                pooled.password = password
+            self.startKeepalive()
+        return pooled
+
+    @contextmanager
+    def connection(self, server, username, password, mailbox='inbox', **settings):
+        # settings: port, security and sslContext of PooledImapConnection
+        pooled = self.getPooledConnection(server, username, password, mailbox=mailbox, **settings)
+
+        pooled.acquire()
+        try:
+            if pooled.isConnected() and (time.monotonic() - pooled.lastUsed) > self.keepaliveInterval:
+                pooled.noop()
+            if not pooled.isConnected():
+                pooled.connect()
+
+            try:
+                yield pooled
+            except (imaplib.IMAP4.abort, OSError):
+                # the session is unusable; the next user reconnects from scratch
+                pooled.disconnect()
+                raise
+
+            pooled.lastUsed = time.monotonic()
+        finally:
+            pooled.release()
+
+    def execute(self, server, username, password, operation, mailbox='inbox', **settings):
+        try:
+            with self.connection(server, username, password, mailbox=mailbox, **settings) as pooled:
+                return operation(pooled)
+        except (imaplib.IMAP4.abort, OSError):
+            # a pooled session may have been dropped by the server since its last use
+            with self.connection(server, username, password, mailbox=mailbox, **settings) as pooled:
+                return operation(pooled)
+
+    def startKeepalive(self):
+        if self.keepaliveThread != None and self.keepaliveThread.is_alive():
+            return
+
+        self.stopEvent.clear()
+        self.keepaliveThread = threading.Thread(target=self.runKeepalive, daemon=True)
+        self.keepaliveThread.start()
+
+    def runKeepalive(self):
+        while not self.stopEvent.wait(self.keepaliveInterval / 2):
+            with self.lock:
+                pooledConnections = list(self.connections.values())
+
+            for pooled in pooledConnections:
+                # connections in use are alive by definition
+                if not pooled.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if pooled.isConnected() and (time.monotonic() - pooled.lastUsed) >= self.keepaliveInterval / 2:
+                        pooled.noop()
+                finally:
+                    pooled.lock.release()
+
+    def closeAll(self):
+        self.stopEvent.set()
+
+        with self.lock:
+            pooledConnections = list(self.connections.values())
+            self.connections = dict()
+
+        for pooled in pooledConnections:
+            with pooled.lock:
+                pooled.disconnect()
+
+PAKE_HEADER_FIELDS = "SUBJECT FROM TO MESSAGE-ID IN-REPLY-TO X-PAKEMAIL-SESSION X-PAKEMAIL-PHASE X-PAKEMAIL-ROLE X-PAKEMAIL-GROUP X-PAKEMAIL-FLOWS X-PAKEMAIL-REJECT X-PAKEMAIL-ENVELOPE"
+
+# an empty HEADER value matches any message that has the field; the subject catches senders without it
+PAKE_SEARCH_CRITERIA = 'OR OR HEADER X-PakeMail-Session "" HEADER X-PakeMail-Envelope "" SUBJECT "PAKE"'
+
+_OPEN = object()
+_CLOSE = object()
+
+def tokenizeImapLine(line, tokens):
+    i = 0
+    length = len(line)
+    while i < length:
+        c = line[i:i+1]
+        if c in (b" ", b"\r", b"\n"):
+            i += 1
+        elif c == b"(":
+            tokens.append(_OPEN)
+            i += 1
+        elif c == b")":
+            tokens.append(_CLOSE)
+            i += 1
+        elif c == b'"':
+            value = bytearray()
+            i += 1
+            while i < length and line[i:i+1] != b'"':
+                if line[i:i+1] == b"\\":
+                    i += 1
+                value += line[i:i+1]
+                i += 1
+            tokens.append(bytes(value))
+            i += 1
+        elif c == b"{" and line.rstrip().endswith(b"}"):
+            # literal announcement, the literal itself follows as a separate item
+            break
+        else:
+            start = i
+            while i < length and line[i:i+1] not in (b" ", b"(", b")", b"\r", b"\n"):
+                if line[i:i+1] == b"[":
+                    end = line.find(b"]", i)
+                    i = length if end < 0 else end
+                i += 1
+            atom = line[start:i]
+            tokens.append(None if atom.upper() == b"NIL" else atom)
+
+def tokenizeImapResponse(data):
+    # data as returned by imaplib: plain lines, and (line, literal) tuples for literals
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            tokenizeImapLine(item[0], tokens)
+            tokens.append(item[1])
+        elif item:
+            tokenizeImapLine(item, tokens)
+    return tokens
+
+def parseImapTokens(tokens, position=0):
+    values = []
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token is _OPEN:
+            value, position = parseImapTokens(tokens, position)
+            values.append(value)
+        elif token is _CLOSE:
+            return values, position
+        else:
+            values.append(token)
+    return values, position
+
+def parseFetchResponse(data):
+    values, _ = parseImapTokens(tokenizeImapResponse(data))
+
+    responses = []
+    for value in values:
+        if not isinstance(value, list):
+            continue
+        items = dict()
+        for i in range(0, len(value) - 1, 2):
+            key = value[i].decode("ascii", "replace").upper() if isinstance(value[i], bytes) else ""
+            items[key.replace(".PEEK", "")] = value[i+1]
+        responses.append(items)
+    return responses
+
+def imapString(value):
+    if value == None:
+        return ""
+    return value.decode("utf-8", "replace")
+
+class ImapBodyPart:
+
+    def __init__(self, number, contentType, encoding, disposition, filename):
+        self.number = number
+        self.contentType = contentType
+        self.encoding = encoding
+        self.disposition = disposition
+        self.filename = filename
+
+    def decode(self, payload):
+        if self.encoding == "base64":
+            return base64.b64decode(payload)
+        if self.encoding == "quoted-printable":
+            return quopri.decodestring(payload)
+        return payload
+
+def parseBodyStructure(structure, prefix=""):
+    parts = []
+
+    if len(structure) > 0 and isinstance(structure[0], list):
+        index = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number = "{0}.{1}".format(prefix, index) if prefix else str(index)
+            parts += parseBodyStructure(child, number)
+            index += 1
+        return parts
+
+    if len(structure) < 7:
+        return parts
+
+    mainType = imapString(structure[0]).lower()
+    subType = imapString(structure[1]).lower()
+    contentType = "{0}/{1}".format(mainType, subType)
+
+    params = dict()
+    if isinstance(structure[2], list):
+        for i in range(0, len(structure[2]) - 1, 2):
+            params[imapString(structure[2][i]).lower()] = imapString(structure[2][i+1])
+
+    encoding = imapString(structure[5]).lower()
+
+    # extension data starts after the type specific fields
+    extensionStart = 7
+    if mainType == "text":
+        extensionStart = 8
+    elif contentType == "message/rfc822":
+        extensionStart = 10
+
+    disposition = ""
+    filename = params.get("name")
+    if len(structure) > extensionStart + 1 and isinstance(structure[extensionStart + 1], list):
+        dispositionField = structure[extensionStart + 1]
+        disposition = imapString(dispositionField[0]).lower()
+        if len(dispositionField) > 1 and isinstance(dispositionField[1], list):
+            dispositionParams = dispositionField[1]
+            for i in range(0, len(dispositionParams) - 1, 2):
+                if imapString(dispositionParams[i]).lower() == "filename":
+                    filename = imapString(dispositionParams[i+1])
+
+    if filename != None:
+        filename = filename.strip()
+
+    parts.append(ImapBodyPart(prefix or "1", contentType, encoding, disposition, filename))
+    return parts
+
+def extractAttachments(message, filenameMatch="pake"):
+    envelope = getEnvelope(message)
+    if envelope != None:
+        return {filename: payload for filename, payload in envelope.getAttachments().items() if filenameMatch in filename}
+
+    attachments = dict()
+    for part in message.walk():
+        content_disposition = str(part.get("Content-Disposition"))
+        matches = ["attachment", filenameMatch]
+        if all(x in content_disposition for x in matches) and part.get_filename():
+            attachments[part.get_filename().strip()] = part.get_payload(decode=True)
+    return attachments
+
+class ScannedMessage:
+
+    def __init__(self, uid, headers, parts):
+        self.uid = uid
+        self.headers = headers
+        self.parts = parts
+
+    def findAttachmentParts(self, filenameMatch="pake"):
+        return [part for part in self.parts if part.filename and filenameMatch in part.filename and part.disposition in ("attachment", "")]
+
+class MailboxStateStore:
+
+    def __init__(self, folder="/tmp/pakemail/mailbox_state"):
+        # one small file per mailbox, so that saving one mailbox never rewrites the others
+        self.folder = folder
+
+    def getPath(self, key):
+        return os.path.join(self.folder, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + ".json")
+
+    def get(self, key):
+        path = self.getPath(key)
+        if not os.path.isfile(path):
+            return dict()
+        try:
+            with open(path, "r") as stateFile:
+                return json.load(stateFile)
+        except (OSError, ValueError):
+            logger.warning("Unreadable mailbox state file for %s, falling back to a full rescan.", key)
+            return dict()
+
+    def put(self, key, state):
+        # callers serialize the writes of a key, there is a single scanner per mailbox
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.getPath(key)
+        tmpPath = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmpPath, "w") as stateFile:
+            json.dump(state, stateFile)
+        os.replace(tmpPath, path)
+
+class MailboxScanner:
+
+    def __init__(self, key, stateStore, maxPending=256, saveInterval=5.0):
+        self.key = key
+        self.stateStore = stateStore
+        self.maxPending = maxPending
+
+        # consumed UIDs are saved in batches; one left over after a crash is offered again and matches no session
+        self.saveInterval = saveInterval
+        self.dirty = False
+        self.lastSave = 0
+
+        self.lock = threading.Lock()
+
+        state = stateStore.get(key)
+        self.uidValidity = state.get("uidValidity")
+        self.lastUid = state.get("lastUid", 0)
+
+        # UIDs already searched but not consumed yet, with their headers once downloaded; beyond maxPending
+        # of them, the longest offered ones wait in evicted without their headers and take turns
+        self.pending = OrderedDict()
+        self.evicted = OrderedDict((uid, True) for uid in state.get("pending", []))
+
+    def saveState(self):
+        state = dict(uidValidity=self.uidValidity, lastUid=self.lastUid, pending=sorted(list(self.pending.keys()) + list(self.evicted.keys())))
+        self.stateStore.put(self.key, state)
+        self.dirty = False
+        self.lastSave = time.monotonic()
+
+    def saveDue(self):
+        return self.dirty and time.monotonic() - self.lastSave >= self.saveInterval
+
+    def scan(self, pooled, criteria=PAKE_SEARCH_CRITERIA):
+        mail = pooled.mail
+
+        with self.lock:
+            changed = False
+
+            if pooled.uidValidity != self.uidValidity:
+                # UIDs from the previous UIDVALIDITY epoch are meaningless, rescan everything
+                self.uidValidity = pooled.uidValidity
+                self.lastUid = 0
+                self.pending = OrderedDict()
+                self.evicted = OrderedDict()
+                changed = True
+
+            status, data = uidCommand(mail, 'search', None, '(UID {0}:* {1})'.format(self.lastUid + 1, criteria))
+            if status != 'OK':
+                return []
+
+            newUids = []
+            for block in data:
+                if block:
+                    newUids += [int(uid) for uid in block.split()]
+
+            # "n:*" always matches the highest UID in the mailbox, even below n
+            newUids = sorted(uid for uid in newUids if uid > self.lastUid)
+            while len(self.evicted) > 0:
+                self.pending[self.evicted.popitem(last=False)[0]] = None
+            for uid in newUids:
+                self.pending[uid] = None
+            if len(newUids) > 0:
+                self.lastUid = newUids[-1]
+                changed = True
+
+            # unconsumed UIDs are never dropped, lastUid is already past them and they would never be searched again
+            while len(self.pending) > self.maxPending:
+                self.evicted[self.pending.popitem(last=False)[0]] = True
+
+            missingUids = [uid for uid, message in self.pending.items() if message == None]
+            if len(missingUids) > 0:
+                fetchedMessages = self.fetchMessages(mail, missingUids)
+                if fetchedMessages != None:
+                    fetchedMessages = dict(fetchedMessages)
+                    for uid in missingUids:
+                        if uid in fetchedMessages:
+                            self.pending[uid] = fetchedMessages[uid]
+                        else:
+                            # expunged or moved away by another client
+                            del self.pending[uid]
+                            changed = True
+
+            if changed or self.saveDue():
+                self.saveState()
+
+            return [message for message in self.pending.values() if message != None]
+
+    def fetchMessages(self, mail, uids):
+        # one round trip for the headers and MIME layout of every candidate, no bodies
+        query = '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({0})])'.format(PAKE_HEADER_FIELDS)
+        status, data = uidCommand(mail, 'fetch', ",".join(str(uid) for uid in uids), query)
+        if status != 'OK':
+            return None
+
+        headerParser = email.parser.BytesHeaderParser()
+        messages = []
+        for items in parseFetchResponse(data):
+            if not "UID" in items:
+                continue
+
+            headerBytes = b""
+            for key, value in items.items():
+                if key.startswith("BODY[HEADER") and isinstance(value, bytes):
+                    headerBytes = value
+
+            parts = []
+            if isinstance(items.get("BODYSTRUCTURE"), list):
+                parts = parseBodyStructure(items["BODYSTRUCTURE"])
+
+            uid = int(items["UID"])
+            messages.append((uid, ScannedMessage(uid, headerParser.parsebytes(headerBytes), parts)))
+
+        return messages
+
+    def fetchAttachments(self, pooled, scannedMessage, filenameMatch="pake"):
+        # everything came with the headers, no second round trip
+        if scannedMessage.headers['X-PakeMail-Envelope'] != None:
+            return extractAttachments(scannedMessage.headers, filenameMatch)
+
+        mail = pooled.mail
+
+        parts = scannedMessage.findAttachmentParts(filenameMatch)
+        if len(parts) > 0:
+            sections = " ".join("BODY.PEEK[{0}]".format(part.number) for part in parts)
+            status, data = uidCommand(mail, 'fetch', str(scannedMessage.uid), '({0})'.format(sections))
+            if status == 'OK':
+                attachments = dict()
+                for items in parseFetchResponse(data):
+                    for part in parts:
+                        payload = items.get("BODY[{0}]".format(part.number))
+                        if isinstance(payload, bytes):
+                            attachments[part.filename] = part.decode(payload)
+                if len(attachments) == len(parts):
+                    return attachments
+
+        # the server reported an unexpected layout, fall back to the whole message
+        status, data = uidCommand(mail, 'fetch', str(scannedMessage.uid), '(BODY.PEEK[])')
+        if status != 'OK':
+            return dict()
+        for items in parseFetchResponse(data):
+            if isinstance(items.get("BODY[]"), bytes):
+                return extractAttachments(email.message_from_bytes(items["BODY[]"]), filenameMatch)
+        return dict()
+
+    def consume(self, uid):
+        with self.lock:
+            if self.pending.pop(uid, False) != False or self.evicted.pop(uid, False) != False:
+                self.dirty = True
+                if self.saveDue():
+                    self.saveState()
+
+RETENTION_KEEP = "keep"
+RETENTION_MOVE = "move"
+RETENTION_DELETE = "delete"
+
+class MailboxRetentionPolicy:
+
+    def __init__(self, markSeen=True, onCompleted=RETENTION_MOVE, onFailed=RETENTION_MOVE, archiveFolder="PakeMail", retainFor=0, batchSize=256):
+        # consumed PAKE emails are flagged \Seen with the next flush, i.e. the next mailbox poll
+        self.markSeen = markSeen
+
+        # what happens to a session's emails once it completed, or failed or timed out
+        self.onCompleted = onCompleted
+        self.onFailed = onFailed
+
+        # "{session}" in the folder name gives every session its own archive folder
+        self.archiveFolder = archiveFolder
+
+        # seconds a finished session's emails stay in the mailbox before being moved or deleted
+        self.retainFor = retainFor
+        # UIDs per STORE/MOVE/EXPUNGE command
+        self.batchSize = batchSize
+
+    def getAction(self, completed):
+        if completed:
+            return self.onCompleted
+        return self.onFailed
+
+    def getArchiveFolder(self, sessionID):
+        return self.archiveFolder.format(session=sessionID)
+
+def formatUidSet(uids):
+    # "3:5,9" instead of "3,4,5,9"
+    ranges = []
+    for uid in sorted(uids):
+        if len(ranges) > 0 and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(first) if first == last else "{0}:{1}".format(first, last) for first, last in ranges)
+
+def quoteMailboxName(name):
+    return '"{0}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+class MailboxJanitor:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # consumed UIDs still to be flagged \Seen
+        self.unseen = set()
+        # session ID -> UIDs consumed for it, until the session is released
+        self.sessionUids = dict()
+        # (due time, action, folder, UIDs) of released sessions
+        self.released = []
+
+        self.createdFolders = set()
+
+    def consume(self, uid, sessionID, policy):
+        with self.lock:
+            if policy.markSeen:
+                self.unseen.add(uid)
+            if sessionID != None:
+                self.sessionUids.setdefault(str(sessionID), set()).add(uid)
+
+    def discard(self, uid, policy):
+        # emails no session will consume, such as replays, go the way of a failed session's
+        with self.lock:
+            if policy.markSeen:
+                self.unseen.add(uid)
+            action = policy.getAction(False)
+            if action != RETENTION_KEEP:
+                self.released.append((time.monotonic() + policy.retainFor, action, policy.getArchiveFolder("discarded"), {uid}))
+
+    def releaseSession(self, sessionID, completed, policy):
+        with self.lock:
+            uids = self.sessionUids.pop(str(sessionID), None)
+            action = policy.getAction(completed)
+            if uids == None or action == RETENTION_KEEP:
+                return 0
+            self.released.append((time.monotonic() + policy.retainFor, action, policy.getArchiveFolder(sessionID), uids))
+            return len(uids)
+
+    def pendingCount(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            return len(self.unseen) + sum(len(uids) for dueTime, action, folder, uids in self.released if force or dueTime <= now)
+
+    def flush(self, pooled, batchSize=256, force=False):
+        # all the pending work in a few batched UID commands; force ignores the retention delay
+        now = time.monotonic()
+        with self.lock:
+            seenUids = self.unseen
+            self.unseen = set()
+            dueSessions = [released for released in self.released if force or released[0] <= now]
+            self.released = [released for released in self.released if not (force or released[0] <= now)]
+
+        # sessions sharing an action and a folder go in the same commands
+        operations = OrderedDict()
+        for dueTime, action, folder, uids in dueSessions:
+            operations.setdefault((action, folder), set()).update(uids)
+
+        try:
+            for batch in splitBatches(seenUids, batchSize):
+                uidCommand(pooled.mail, 'STORE', formatUidSet(batch), '+FLAGS.SILENT', '(\\Seen)')
+            seenUids = set()
+
+            for action, folder in list(operations.keys()):
+                for batch in splitBatches(operations[(action, folder)], batchSize):
+                    if action == RETENTION_MOVE:
+                        self.moveMessages(pooled, batch, folder)
+                    elif action == RETENTION_DELETE:
+                        self.deleteMessages(pooled, batch)
+                del operations[(action, folder)]
+        except (imaplib.IMAP4.abort, OSError):
+            # whatever is left goes again with the next flush, on a new connection
+            with self.lock:
+                self.unseen.update(seenUids)
+                for (action, folder), uids in operations.items():
+                    self.released.append((now, action, folder, uids))
+            raise
+
+        return len(dueSessions)
+
+    def createFolder(self, pooled, folder):
+        if folder in self.createdFolders:
+            return
+        # NO for an existing folder is fine
+        pooled.mail.create(quoteMailboxName(folder))
+        self.createdFolders.add(folder)
+
+    def moveMessages(self, pooled, uids, folder):
+        mail = pooled.mail
+        self.createFolder(pooled, folder)
+
+        uidSet = formatUidSet(uids)
+        if 'MOVE' in mail.capabilities:
+            status, _ = uidCommand(mail, 'MOVE', uidSet, quoteMailboxName(folder))
+            if status == 'OK':
+                return
+
+        status, _ = uidCommand(mail, 'COPY', uidSet, quoteMailboxName(folder))
+        if status != 'OK':
+            logger.warning("Could not archive PAKE emails to %s, leaving them in place.", folder)
+            return
+        self.deleteMessages(pooled, uids)
+
+    def deleteMessages(self, pooled, uids):
+        mail = pooled.mail
+        uidSet = formatUidSet(uids)
+        uidCommand(mail, 'STORE', uidSet, '+FLAGS.SILENT', '(\\Deleted)')
+        if 'UIDPLUS' in mail.capabilities:
+            uidCommand(mail, 'EXPUNGE', uidSet)
+        else:
+            # without UIDPLUS this also expunges anything else flagged \Deleted in the mailbox
+            mail.expunge()
+
+def uidCommand(mail, command, *args):
+    status, data = mail.uid(command, *args)
+
+    tracer = getTracer()
+    if tracer.enabled:
+        tracer.count("imap_round_trips")
+        tracer.count("imap_bytes_received", responseSize(data))
+
+    return status, data
+
+def responseSize(data):
+    # imaplib hands back bytes lines and (prefix, literal) tuples
+    size = 0
+    for item in data or []:
+        if isinstance(item, tuple):
+            size += sum(len(part) for part in item if isinstance(part, bytes))
+        elif isinstance(item, bytes):
+            size += len(item)
+    return size
+
+def splitBatches(uids, batchSize):
+    uids = sorted(uids)
+    return [uids[i:i + batchSize] for i in range(0, len(uids), batchSize)]
+
+_mailboxStateStore = MailboxStateStore()
+_mailboxScanners = dict()
+_mailboxScannersLock = threading.Lock()
+
+def getMailboxScanner(server, username, mailbox='inbox'):
+    key = "{0}/{1}/{2}".format(server, username, mailbox)
+    with _mailboxScannersLock:
+        scanner = _mailboxScanners.get(key)
+        if scanner == None:
+            scanner = MailboxScanner(key, _mailboxStateStore)
+            _mailboxScanners[key] = scanner
+    return scanner
+
+_mailboxJanitors = dict()
+_mailboxJanitorsLock = threading.Lock()
+
+def getMailboxJanitor(server, username, mailbox='inbox'):
+    key = "{0}/{1}/{2}".format(server, username, mailbox)
+    with _mailboxJanitorsLock:
+        janitor = _mailboxJanitors.get(key)
+        if janitor == None:
+            janitor = MailboxJanitor()
+            _mailboxJanitors[key] = janitor
+    return janitor
+
+_imapConnectionPool = None
+_imapConnectionPoolLock = threading.Lock()
+
+def getImapConnectionPool():
+    global _imapConnectionPool
+    with _imapConnectionPoolLock:
+        if _imapConnectionPool == None:
+            _imapConnectionPool = ImapConnectionPool()
+    return _imapConnectionPool
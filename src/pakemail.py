@@ -1,16 +1,20 @@
 from email.mime.base import MIMEBase
-from email.message import Message
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email import encoders
 import base64
 import mimetypes
 import os
-import yaml
-import email, smtplib, ssl
-import getpass, imaplib
-import gnupg
+import getpass
+import logging
+import time
 import uuid
+from paketransport import MailTransport, DISCARD, getSharedMailboxReader
+from pakeenvelope import PakeEnvelope, encodeEnvelopeHeader, getEnvelope, flowsFromFlags, flagsFromFlows
+from pakeasync import runBlocking, getAsyncMailboxReader
+from paketrace import getTracer
+from pakesmtp import SECURITY_SSL
+
+logger = logging.getLogger(__name__)
 
 def get_base64_file(file_path):
     with open(file_path, "rb") as f:
@@ -23,24 +27,73 @@ def get_mimetype(file_path):
 def get_file_name(file_path):
     return os.path.basename(file_path)
 
-def writePakeMsgToFile(msg, path):
-    data = dict(pakemsg=msg, side="A")
-    with open('/tmp/pakemail/data.yml', 'wb') as output_file:
-        yaml.dump(data, output_file)
-    f = open(path, 'wb')
-    f.write(msg)
-    f.close()
-
-def parsePakeMsgFromYaml(path):
-    yaml_dict = dict()
-    with open(path, "r") as yml_file:
-        yaml_dict = yaml.load(yml_file)
-    
-    return yaml_dict
+def parsePakeSubject(subject):
+    # "PAKE email from A with ID: <id>" or "PAKE KC email from A with ID: <id>"
+    if subject == None:
+        return None
+
+    subject = str(subject)
+    if subject.startswith("PAKE KC email from "):
+        isKeyConfirmation = True
+        rest = subject[len("PAKE KC email from "):]
+    elif subject.startswith("PAKE email from "):
+        isKeyConfirmation = False
+        rest = subject[len("PAKE email from "):]
+    else:
+        return None
+
+    if not(" with ID: " in rest):
+        return None
+
+    side, pakeMailID = rest.split(" with ID: ", 1)
+    return isKeyConfirmation, side, pakeMailID
+
+PHASE_PAKE = "pake"
+PHASE_KC = "kc"
+
+def makePakeMessageID(pakeMailID, side, isKeyConfirmation):
+    # deterministic, so that either side knows the Message-ID a reply refers to
+    phase = PHASE_KC if isKeyConfirmation else PHASE_PAKE
+    return "<{0}.{1}.{2}@pakemail>".format(pakeMailID, phase, side)
+
+def parsePakeHeaders(message):
+    # the binary envelope, then X-PakeMail-* headers; the subject only for senders that do not set them, or once they were stripped
+    envelope = getEnvelope(message)
+    if envelope != None:
+        return envelope.isKeyConfirmation(), envelope.role, envelope.pakeMailID
+
+    pakeMailID = message['X-PakeMail-Session']
+    phase = message['X-PakeMail-Phase']
+    side = message['X-PakeMail-Role']
+    if pakeMailID != None and phase in (PHASE_PAKE, PHASE_KC) and side != None:
+        return phase == PHASE_KC, str(side), str(pakeMailID)
+
+    return parsePakeSubject(message['subject'])
+
+def parsePakeGroup(message):
+    envelope = getEnvelope(message)
+    if envelope != None:
+        return envelope.group
+    return message['X-PakeMail-Group']
+
+def parsePakeFlows(message):
+    envelope = getEnvelope(message)
+    if envelope != None:
+        return flowsFromFlags(envelope.flags)
+    return message['X-PakeMail-Flows']
+
+def classifyPakeEmail(message):
+    # waiter keys for the async mailbox reader: (session ID or None for any, sender side, is KC)
+    parsedHeaders = parsePakeHeaders(message)
+    if parsedHeaders == None:
+        return []
+
+    isKeyConfirmation, side, pakeMailID = parsedHeaders
+    return [(pakeMailID, side, isKeyConfirmation), (None, side, isKeyConfirmation)]
 
 class PakeMail:
 
-    def __init__(self, side, senderAddress, receiverAddress, isKeyConfirmationMsg=False):
+    def __init__(self, side, senderAddress, receiverAddress, isKeyConfirmationMsg=False, pakeMessage=None, debugDump=False, compactEnvelope=False):
         self.id = uuid.uuid4()
         self.side = side
 
@@ -50,6 +103,23 @@ class PakeMail:
         self.subject = ""
 
         self.pakeMailID = ""
+
+        # raw SPAKE2 message or MAC tag carried as attachment, any bytes-like object
+        self.pakeMessage = pakeMessage
+        self.isKeyConfirmationMsg = isKeyConfirmationMsg
+
+        # SPAKE2 group of the attached message, so that the responder can use the same one
+        self.group = None
+        # X-PakeMail-Flows; with three flows the responder's PAKE email also carries its tag
+        self.flows = None
+        self.keyConfirmationTag = None
+        # Message-ID of the remote email this one answers
+        self.inReplyTo = None
+
+        # when set, outgoing and incoming attachments are also written to pakeMsgFolderPath
+        self.debugDump = debugDump
+        # when set, the PAKE message travels in the X-PakeMail-Envelope header instead of a MIME attachment
+        self.compactEnvelope = compactEnvelope
         
         self.pakeMsgFolderPath = "/tmp/pakemail/"
         self.pakeMsgFileName = "pakemsg{0}".format(self.side)
@@ -62,37 +132,47 @@ class PakeMail:
         self.recipientAddress = receiverAddress
         
         if isKeyConfirmationMsg:
-            self.message = self.buildMailMessage(forKeyConfirmation=True) #type email.message.Message
             self.subject = "PAKE KC email from {0} with ID: {1}".format(self.side, self.id)
         else:
-            self.message = self.buildMailMessage() #type email.message.Message
             self.subject = "PAKE email from {0} with ID: {1}".format(self.side, self.id)
 
-    def buildMailMessage(self, forKeyConfirmation=False):
+    def buildMailMessage(self, forKeyConfirmation=None):
+        # built once per send, so the subject reflects any ID set in the meantime
+        if forKeyConfirmation == None:
+            forKeyConfirmation = self.isKeyConfirmationMsg
+
+        if self.compactEnvelope:
+            return self.buildEnvelopeMessage(forKeyConfirmation)
 
         message = MIMEMultipart()
         message["From"] = self.senderAddress
         message["To"] = self.recipientAddress
         message["Subject"] = self.subject
+        if self.group != None:
+            message["X-PakeMail-Group"] = self.group
+        if self.flows != None:
+            message["X-PakeMail-Flows"] = self.flows
+
+        message["Message-ID"] = makePakeMessageID(self.id, self.side, forKeyConfirmation)
+        if self.inReplyTo != None:
+            message["In-Reply-To"] = self.inReplyTo
+        message["X-PakeMail-Session"] = str(self.id)
+        message["X-PakeMail-Phase"] = PHASE_KC if forKeyConfirmation else PHASE_PAKE
+        message["X-PakeMail-Role"] = self.side
 
         body = "This is an email with a PAKE message attachment from side {0} with ID: {1}.".format(self.side, self.id)
 
         message.attach(MIMEText(body, "plain"))
 
-        pakeMessageFilePath = ""
         pakeMsgFileName = ""
         if forKeyConfirmation:
-            pakeMessageFilePath = self.pakeMacMsgFilePath
             pakeMsgFileName = self.pakeMacMsgFileName
         else:
-            pakeMessageFilePath = self.pakeMsgFilePath
             pakeMsgFileName = self.pakeMsgFileName
 
-        with open(pakeMessageFilePath, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
-
-        encoders.encode_base64(part)
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(base64.encodebytes(self.pakeMessage).decode("ascii"))
+        part["Content-Transfer-Encoding"] = "base64"
 
         part.add_header(
             "Content-Disposition",
@@ -101,10 +181,72 @@ class PakeMail:
 
         message.attach(part)
 
+        if self.keyConfirmationTag != None and not forKeyConfirmation:
+            tagPart = MIMEBase("application", "octet-stream")
+            tagPart.set_payload(base64.encodebytes(self.keyConfirmationTag).decode("ascii"))
+            tagPart["Content-Transfer-Encoding"] = "base64"
+            tagPart.add_header(
+                "Content-Disposition",
+                f"attachment; filename= {self.pakeMacMsgFileName}",
+            )
+            message.attach(tagPart)
+
+        if self.debugDump:
+            self.dumpPakeMessage(pakeMsgFileName, self.pakeMessage)
+
         self.message = message
 
         return message
 
+    def buildEnvelopeMessage(self, forKeyConfirmation):
+        # a single text part; session, phase, role, group, flows and tag all go in the envelope
+        phase = PHASE_KC if forKeyConfirmation else PHASE_PAKE
+        keyConfirmationTag = None
+        if not forKeyConfirmation:
+            keyConfirmationTag = self.keyConfirmationTag
+        envelope = PakeEnvelope(self.side, phase, self.id, self.pakeMessage, tag=keyConfirmationTag, group=self.group, flags=flagsFromFlows(self.flows))
+
+        message = MIMEText("PAKE envelope from side {0} with ID: {1}.".format(self.side, self.id), "plain")
+        message["From"] = self.senderAddress
+        message["To"] = self.recipientAddress
+        message["Subject"] = self.subject
+        message["Message-ID"] = makePakeMessageID(self.id, self.side, forKeyConfirmation)
+        if self.inReplyTo != None:
+            message["In-Reply-To"] = self.inReplyTo
+        message["X-PakeMail-Envelope"] = encodeEnvelopeHeader(envelope)
+
+        if self.debugDump:
+            self.dumpPakeMessage(self.pakeMacMsgFileName if forKeyConfirmation else self.pakeMsgFileName, self.pakeMessage)
+
+        self.message = message
+
+        return message
+
+    def buildRejectMessage(self, reason):
+        # a PAKE email without a PAKE message, so that the initiator fails at once instead of timing out;
+        # always plain headers, the binary envelope has no field for it
+        message = MIMEText("PAKE session {0} refused by side {1}: {2}.".format(self.id, self.side, reason), "plain")
+        message["From"] = self.senderAddress
+        message["To"] = self.recipientAddress
+        message["Subject"] = self.subject
+        message["Message-ID"] = makePakeMessageID(self.id, self.side, False)
+        if self.inReplyTo != None:
+            message["In-Reply-To"] = self.inReplyTo
+        message["X-PakeMail-Session"] = str(self.id)
+        message["X-PakeMail-Phase"] = PHASE_PAKE
+        message["X-PakeMail-Role"] = self.side
+        message["X-PakeMail-Reject"] = reason
+
+        self.message = message
+
+        return message
+
+    def dumpPakeMessage(self, filename, pakeMessage):
+        if not os.path.isdir(self.pakeMsgFolderPath):
+            os.mkdir(self.pakeMsgFolderPath)
+        with open(os.path.join(self.pakeMsgFolderPath, filename), "wb") as dumpFile:
+            dumpFile.write(pakeMessage)
+
     def setID(self, newID, messageType="pakeMessage"):
         self.id = newID
         if messageType == "pakeMessage":
@@ -137,7 +279,7 @@ class PakeMail:
         docstring
         """
         if self.message == None:
-            print("Email null")
+            logger.warning("Email null")
             return
 
         pakeMessage = None
@@ -149,172 +291,258 @@ class PakeMail:
         else:
             filenameMatch = "pakemsg"
 
+        envelope = getEnvelope(message)
+        if envelope != None:
+            for filename, payload in envelope.getAttachments().items():
+                if filenameMatch in filename:
+                    pakeMessage = payload
+            return pakeMessage
+
         for part in message.walk():
             content_disposition = str(part.get("Content-Disposition"))
             matches = ["attachment", filenameMatch]
             if all(x in content_disposition for x in matches):
                 filename = part.get_filename()
-                print("file name ",filename)
                 if filename:
-                    if not os.path.isdir(self.pakeMsgFolderPath):
-                        os.mkdir(self.pakeMsgFolderPath)
-                    filepath = os.path.join(self.pakeMsgFolderPath, filename)
-                    
                     pakeMessage = part.get_payload(decode=True)
-                    open(filepath, "wb").write(part.get_payload(decode=True))
+                    if self.debugDump:
+                        self.dumpPakeMessage(filename.strip(), pakeMessage)
 
         return pakeMessage
 
 class PakeMailService:
 
-    def __init__(self, pakeMail, askForPassword=True):
+    def __init__(self, pakeMail, askForPassword=True, transport=None):
         self.pakeMail = pakeMail
 
+        # defaults to SMTP/IMAP built from the settings below on first use
+        self.transport = transport
+
+        self.smtpHost = "smtp.gmail.com"
+        self.smtpPort = 465
+        self.smtpSecurity = SECURITY_SSL
+
+        self.imapServer = 'imap.gmail.com'
+        self.imapPort = None
+        self.imapSecurity = SECURITY_SSL
+
+        # e.g. trusting a test server's self-signed certificate; None verifies against the system CAs
+        self.sslContext = None
+        # whether "+tag" addresses of the account share its mailbox; None assumes so only for Gmail
+        self.plusAddressing = None
+
+        self.useIdle = True
+        self.idleInterval = 60
+        self.pollInterval = 1.0
+        self.maxPollInterval = 30.0
+        self.lastWaitTime = float(0)
+        # clients of the same mailbox in this process wait on one shared reader instead of polling it each
+        self.shareMailbox = True
+        # None keeps the transport's default MailboxRetentionPolicy
+        self.retentionPolicy = None
+        # X-PakeMail-Group of the last accepted email, None for senders that do not set it
+        self.remoteGroup = None
+        self.remoteFlows = None
+        self.remoteTag = None
+        # X-PakeMail-Reject of the last accepted email: the remote client refused the session
+        self.remoteRejectReason = None
+
         if askForPassword:
             self.username = input("Please enter your email username/address: ")
             self.password = getpass.getpass("Please enter your email password: ")
 
-    def createPakeMailMessage(self, forKeyConfirmation=False):
-
-        pakeMail = self.pakeMail
-
-        message = MIMEMultipart()
-        message["From"] = pakeMail.senderAddress
-        message["To"] = pakeMail.recipientAddress
-        message["Subject"] = pakeMail.subject
+    def copySettingsFrom(self, pakeMailService):
+        self.transport = pakeMailService.transport
+        self.username = pakeMailService.username
+        self.password = pakeMailService.password
+        self.smtpHost = pakeMailService.smtpHost
+        self.smtpPort = pakeMailService.smtpPort
+        self.smtpSecurity = pakeMailService.smtpSecurity
+        self.imapServer = pakeMailService.imapServer
+        self.imapPort = pakeMailService.imapPort
+        self.imapSecurity = pakeMailService.imapSecurity
+        self.sslContext = pakeMailService.sslContext
+        self.plusAddressing = pakeMailService.plusAddressing
+        self.useIdle = pakeMailService.useIdle
+        self.idleInterval = pakeMailService.idleInterval
+        self.pollInterval = pakeMailService.pollInterval
+        self.maxPollInterval = pakeMailService.maxPollInterval
+        self.shareMailbox = pakeMailService.shareMailbox
+        self.retentionPolicy = pakeMailService.retentionPolicy
+
+    def getTransport(self):
+        if self.transport == None:
+            transport = MailTransport(self.username, self.password, smtpHost=self.smtpHost, smtpPort=self.smtpPort, imapServer=self.imapServer, retentionPolicy=self.retentionPolicy, smtpSecurity=self.smtpSecurity, imapPort=self.imapPort, imapSecurity=self.imapSecurity, sslContext=self.sslContext, plusAddressing=self.plusAddressing)
+            transport.useIdle = self.useIdle
+            transport.idleInterval = self.idleInterval
+            transport.pollInterval = self.pollInterval
+            transport.maxPollInterval = self.maxPollInterval
+            self.transport = transport
+        return self.transport
 
-        body = "This is an email with a PAKE message attachment."
-
-        message.attach(MIMEText(body, "plain"))
-
-        pakeMessageFilePath = ""
-        pakeMsgFileName = ""
-        if forKeyConfirmation:
-            pakeMessageFilePath = pakeMail.pakeMacMsgFilePath
-            pakeMsgFileName = pakeMail.pakeMacMsgFileName
-        else:
-            pakeMessageFilePath = pakeMail.pakeMsgFilePath
-            pakeMsgFileName = pakeMail.pakeMsgFileName
-
-        with open(pakeMessageFilePath, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
-
-        encoders.encode_base64(part)
-
-        part.add_header(
-            "Content-Disposition",
-            f"attachment; filename= {pakeMsgFileName}",
-        )
-
-        message.attach(part)
+    def createPakeMailMessage(self, forKeyConfirmation=False):
+        with getTracer().span("build_message", side=self.pakeMail.side, keyConfirmation=forKeyConfirmation):
+            return self.pakeMail.buildMailMessage(forKeyConfirmation=forKeyConfirmation)
 
-        return message
+    def createPakeRejectMessage(self, reason):
+        with getTracer().span("build_message", side=self.pakeMail.side, keyConfirmation=False):
+            return self.pakeMail.buildRejectMessage(reason)
 
     def sendPakeMailMessage(self, pakeMailMessage):
+        with getTracer().span("send", side=self.pakeMail.side, sessionID=str(self.pakeMail.id)):
+            self.getTransport().send(pakeMailMessage)
 
-        password = self.password
-
-        sender_email = pakeMailMessage["From"]
-        receiver_email = pakeMailMessage["To"]
-
-        text = pakeMailMessage.as_string()
-
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(sender_email, password)
-            server.sendmail(sender_email, receiver_email, text)
+    def sendPakeMailMessages(self, pakeMailMessages):
+        return self.getTransport().send_many(pakeMailMessages)
 
     def getPakeMessageFromEmail(self, message, forKeyConfirmation=False):
         """
         docstring
         """
         if message == None:
-            print("message null")
+            logger.warning("message null")
             return
 
+        pakeMessage = None
+
         filenameMatch = ""
         if forKeyConfirmation:
             filenameMatch = "pakemac"
         else:
             filenameMatch = "pakemsg"
 
+        envelope = getEnvelope(message)
+        if envelope != None:
+            for filename, payload in envelope.getAttachments().items():
+                if filenameMatch in filename:
+                    pakeMessage = payload
+            return pakeMessage
+
         for part in message.walk():
             content_disposition = str(part.get("Content-Disposition"))
             matches = ["attachment", filenameMatch]
             if all(x in content_disposition for x in matches):
                 filename = part.get_filename()
-                print("Downloading file:", filename)
                 if filename:
-                    if not os.path.isdir(self.pakeMail.pakeMsgFolderPath):
-                        os.mkdir(self.pakeMail.pakeMsgFolderPath)
-                    filepath = os.path.join(self.pakeMail.pakeMsgFolderPath, filename)
-                    
                     pakeMessage = part.get_payload(decode=True)
-                    open(filepath, "wb").write(part.get_payload(decode=True))
+                    if self.pakeMail.debugDump:
+                        self.pakeMail.dumpPakeMessage(filename.strip(), pakeMessage)
 
         return pakeMessage
 
+    def getExpectedSessionID(self, forKeyConfirmation=False):
+        # the responder does not know the session ID before the initiator's first email
+        if self.pakeMail.side == "B" and not forKeyConfirmation:
+            return None
+        return str(self.pakeMail.id)
+
+    def matchPakeEmail(self, message, forKeyConfirmation=False):
+        parsedHeaders = parsePakeHeaders(message)
+        if parsedHeaders == None:
+            return False
+
+        isKeyConfirmation, side, pakeMailID = parsedHeaders
+        if isKeyConfirmation != forKeyConfirmation:
+            return False
+
+        if self.pakeMail.parentPakeClient.hasSeenSession(pakeMailID):
+            logger.warning("Invalid session: duplicated ID!")
+            return DISCARD
+
+        if side != self.pakeMail.parentPakeClient.remoteClient.side:
+            return False
+
+        expectedSessionID = self.getExpectedSessionID(forKeyConfirmation)
+        if expectedSessionID != None and pakeMailID != expectedSessionID:
+            return False
+
+        return True
+
     def fetchPakeEmail(self, forKeyConfirmation=False):
-        
-        pakeMessageFromEmail = None
+        return self.waitForPakeEmail(forKeyConfirmation=forKeyConfirmation, timeout=0)
 
-        password = self.password
+    def waitForPakeEmail(self, forKeyConfirmation=False, timeout=None, cancelEvent=None):
+        with getTracer().span("wait", side=self.pakeMail.side, keyConfirmation=forKeyConfirmation, timeout=timeout) as span:
+            start = time.monotonic()
 
-        email_address = self.username
-        server = 'imap.gmail.com'
+            transport = self.getTransport()
+            match = lambda message: self.matchPakeEmail(message, forKeyConfirmation=forKeyConfirmation)
+            if self.shareMailbox:
+                key = (self.getExpectedSessionID(forKeyConfirmation), self.pakeMail.parentPakeClient.remoteClient.side, forKeyConfirmation)
+                delivery = getSharedMailboxReader(transport, classifyPakeEmail).wait_for(key, match, timeout=timeout, cancelEvent=cancelEvent)
+            else:
+                delivery = transport.wait_for(match, timeout=timeout, cancelEvent=cancelEvent)
 
-        mail = imaplib.IMAP4_SSL(server)
-        mail.login(email_address, password)
-        
-        mail.select('inbox')
+            self.lastWaitTime = time.monotonic() - start
+            span.set("delivered", delivery != None)
+
+            if delivery == None:
+                return None
 
-        # status, data = mail.search(None, 'ALL')
-        status, data = mail.search(None, '(SUBJECT "PAKE")')
+            return self.acceptPakeDelivery(delivery, forKeyConfirmation=forKeyConfirmation)
 
+    def acceptPakeDelivery(self, delivery, forKeyConfirmation=False):
+        transport = self.getTransport()
 
-        mail_id_list = []
-        for block in data:
-            mail_id_list += block.split()
+        self.remoteRejectReason = delivery.headers['X-PakeMail-Reject']
+        if self.remoteRejectReason != None:
+            self.remoteRejectReason = str(self.remoteRejectReason)
+            transport.ack(delivery, sessionID=parsePakeHeaders(delivery.headers)[2])
+            return None
 
-        for i in mail_id_list:
-            status, data = mail.fetch(i, '(RFC822)')
+        filenameMatch = ""
+        if forKeyConfirmation:
+            filenameMatch = "pakemac"
+        else:
+            filenameMatch = "pakemsg"
 
-            for response_part in data:
-                if isinstance(response_part, tuple):
-                    message = email.message_from_bytes(response_part[1])
+        pakeMessageFromEmail = delivery.getAttachment(filenameMatch)
+        if pakeMessageFromEmail == None:
+            logger.warning("PAKE email without a %s attachment, ignoring it.", filenameMatch)
+            transport.ack(delivery)
+            return None
+
+        if self.pakeMail.debugDump:
+            self.pakeMail.dumpPakeMessage("{0}{1}".format(filenameMatch, self.pakeMail.parentPakeClient.remoteClient.side), pakeMessageFromEmail)
+
+        self.pakeMail.pakeMailID = parsePakeHeaders(delivery.headers)[2]
+        self.remoteGroup = parsePakeGroup(delivery.headers)
+        self.remoteFlows = parsePakeFlows(delivery.headers)
+        self.remoteTag = None
+        if not forKeyConfirmation:
+            # a three-flow PAKE email from the responder carries its tag as well
+            self.remoteTag = delivery.getAttachment("pakemac")
+        logger.debug("[%s] extracted pake mail ID: %s", self.pakeMail.side, self.pakeMail.pakeMailID)
+
+        if forKeyConfirmation:
+            self.pakeMail.parentPakeClient.recordSession(self.pakeMail.pakeMailID)
 
-                    # mail_from = message['from']
-                    # receiver = message['to']
+        transport.ack(delivery, sessionID=self.pakeMail.pakeMailID)
 
-                    mail_subject = message['subject']
-                    
-                    pattern = ""
-                    if forKeyConfirmation:
-                        pattern = "PAKE KC email from"
-                    else:
-                        pattern = "PAKE email from"
+        return pakeMessageFromEmail
 
-                    if not(pattern in mail_subject):
-                        continue
+    def releaseSession(self, completed):
+        transport = self.getTransport()
+        transport.releaseSession(str(self.pakeMail.id), completed=completed)
+        transport.flushRetention()
 
-                    pakeMailID = mail_subject[mail_subject.find(":")+2:]
-                    sessionHistory = self.pakeMail.parentPakeClient.sessionHistory
+    async def send_pake_mail_message(self, pakeMailMessage):
+        await runBlocking(self.sendPakeMailMessage, pakeMailMessage)
 
-                    if pakeMailID in sessionHistory.keys():
-                        print("Invalid session: duplicated ID!")
-                        continue
+    async def wait_for_pake_email(self, forKeyConfirmation=False, timeout=None):
+        with getTracer().span("wait", side=self.pakeMail.side, keyConfirmation=forKeyConfirmation, timeout=timeout) as span:
+            start = time.monotonic()
 
-                    partnerClientID = self.pakeMail.parentPakeClient.remoteClient.side
-                    if (mail_subject == self.pakeMail.subject) or ("from {0}".format(self.pakeMail.side) in mail_subject) or (not("from {0}".format(partnerClientID) in mail_subject)):
-                        continue
+            key = (self.getExpectedSessionID(forKeyConfirmation), self.pakeMail.parentPakeClient.remoteClient.side, forKeyConfirmation)
 
-                    self.pakeMail.pakeMailID = mail_subject[mail_subject.find(":")+2:]
-                    print("[{0}] extracted pake mail ID: {1}".format(self.pakeMail.side, self.pakeMail.pakeMailID))
+            reader = getAsyncMailboxReader(self.getTransport(), classifyPakeEmail)
+            delivery = await reader.expect(key, lambda message: self.matchPakeEmail(message, forKeyConfirmation=forKeyConfirmation), timeout=timeout)
 
-                    if forKeyConfirmation:
-                        self.pakeMail.parentPakeClient.sessionHistory[self.pakeMail.pakeMailID] = True
+            self.lastWaitTime = time.monotonic() - start
+            span.set("delivered", delivery != None)
 
-                    pakeMessageFromEmail = self.getPakeMessageFromEmail(message, forKeyConfirmation=forKeyConfirmation)
+            if delivery == None:
+                return None
 
-        return pakeMessageFromEmail
\ No newline at end of file
+            # acking and recording the session touch the state file, the mailbox and the history database
+            return await runBlocking(self.acceptPakeDelivery, delivery, forKeyConfirmation)
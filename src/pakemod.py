@@ -1,22 +1,32 @@
 from spake2 import SPAKE2_A
 from spake2 import SPAKE2_B
+from spake2.parameters.ed25519 import ParamsEd25519
 from spake2.parameters.i1024 import Params1024
 from spake2.parameters.i2048 import Params2048
 from spake2.parameters.i3072 import Params3072
 import base64
+import email.utils
 import enum
+import logging
 import os
-import yaml
-from pakemail import PakeMail, PakeMailService
+from pakemail import PakeMail, PakeMailService, makePakeMessageID
+from pakeasync import runBlocking
+from pakecheckpoint import CHECKPOINT_VERSION
+from pakehistory import getSessionHistoryStore, importLegacySessionHistory
+from pakecompute import createSpake, getComputeBackend, getPrecomputedStartPool
+from pakeenvelope import THREE_FLOWS
+from paketrace import getTracer
 from hkdf import hkdf_extract, hkdf_expand
 import hashlib
 import hmac
 import uuid
 import time, timeit
+import threading
 import nacl.utils
-import pickle
 import gnupg
 
+logger = logging.getLogger(__name__)
+
 def getGpgHandler():
     gpgPath=str(os.path.expanduser("~"))+"/.gnupg"
     if not os.path.isdir(gpgPath):
@@ -30,17 +40,84 @@ def getGpgHandler():
     gpg.encoding = 'utf-8'
     return gpg
 
+class FingerprintResolver:
+
+    def __init__(self):
+        # one GPG handle and one email -> fingerprints index for the whole process
+        self.gpg = None
+        self.keys = None
+        self.index = None
+        # results of the substring fallback, kept apart from the exact address index
+        self.substringMatches = None
+        self.keyringVersion = None
+        self.lock = threading.Lock()
+
+    def getGpg(self):
+        if self.gpg == None:
+            self.gpg = getGpgHandler()
+        return self.gpg
+
+    def getKeyringVersion(self):
+        # gpg rewrites these files whenever a key is added, changed or removed
+        version = []
+        for filename in ("pubring.kbx", "pubring.gpg", "trustdb.gpg"):
+            try:
+                keyringStat = os.stat(os.path.join(self.getGpg().gnupghome, filename))
+                version.append((filename, keyringStat.st_mtime_ns, keyringStat.st_size))
+            except FileNotFoundError:
+                pass
+        return tuple(version)
+
+    def refresh(self):
+        keyringVersion = self.getKeyringVersion()
+        if self.index != None and keyringVersion == self.keyringVersion:
+            return
+
+        self.keys = self.getGpg().list_keys()
+        self.index = dict()
+        for key in self.keys:
+            for uid in key['uids']:
+                address = email.utils.parseaddr(uid)[1].lower()
+                if address != "":
+                    self.index.setdefault(address, []).append(key['fingerprint'])
+        self.substringMatches = dict()
+        self.keyringVersion = keyringVersion
+
+    def findFingerprints(self, byEmail):
+        fingerprints = self.index.get(byEmail.lower())
+        if fingerprints == None:
+            fingerprints = self.substringMatches.get(byEmail)
+        if fingerprints == None:
+            # anything that is not a plain address keeps the original, case-sensitive substring match over every UID
+            fingerprints = []
+            for key in self.keys:
+                for uid in key['uids']:
+                    if byEmail in uid:
+                        fingerprints.append(key['fingerprint'])
+            self.substringMatches[byEmail] = fingerprints
+        return list(fingerprints)
+
+    def lookup(self, byEmail=""):
+        return self.lookupMany([byEmail])[byEmail]
+
+    def lookupMany(self, emails):
+        # one keyring check and at most one gpg invocation for all of them
+        with self.lock:
+            self.refresh()
+            return {byEmail: self.findFingerprints(byEmail) for byEmail in emails}
+
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+            self.substringMatches = None
+
+_fingerprintResolver = FingerprintResolver()
+
+def getFingerprintResolver():
+    return _fingerprintResolver
+
 def getKeyFingerprintFromGpg(byEmail=""):
-    gpg = getGpgHandler()
-    key_list = gpg.list_keys()
-    match_list = []
-    for l in key_list:
-        for e in (l['uids']):
-            if byEmail in e:
-                fingerprint = l['fingerprint']
-                match_list.append(fingerprint)
-    
-    return match_list
+    return getFingerprintResolver().lookup(byEmail)
 
 def writePakeMsgToFile(msg, client_side, path):
     f = open(path, 'wb')
@@ -51,11 +128,38 @@ class Roles(enum.Enum):
     A = "A"
     B = "B"
 
+class SessionPhase(enum.Enum):
+    created = "created"
+    awaitingPakeMessage = "awaitingPakeMessage"
+    awaitingKeyConfirmation = "awaitingKeyConfirmation"
+    completed = "completed"
+    failed = "failed"
+
 class Parameters(enum.Enum):
+    ed25519 = ParamsEd25519
     p1024 = Params1024
     p2048 = Params2048
     p3072 = Params3072
 
+# approximate symmetric-equivalent strength in bits
+SECURITY_LEVELS = {
+    Parameters.ed25519: 128,
+    Parameters.p1024: 80,
+    Parameters.p2048: 112,
+    Parameters.p3072: 128,
+}
+
+# a responder following the initiator's group never goes below this, whatever the header says
+DEFAULT_SECURITY_FLOOR = 112
+
+def getParameters(parameters):
+    # a Parameters member, its name as sent in X-PakeMail-Group, or a spake2 parameter set
+    if parameters == None or isinstance(parameters, Parameters):
+        return parameters
+    if isinstance(parameters, str):
+        return Parameters[parameters]
+    return Parameters(parameters)
+
 class PakeClient:
 
     def __init__(self, side, password, email, parameters=None):
@@ -68,7 +172,8 @@ class PakeClient:
         self.email = email
         self.remoteClient = None
 
-        self.sessionHistory = dict()
+        # IDs of finished sessions, shared with every client and process using the same store
+        self.sessionHistory = getSessionHistoryStore()
         
         # only for testing; will be replaced by the call to getPublicKeyFingerprint()
         self.pkAfpr = "BD5F3D50B81B4D471F95EFAD00809FFA6F62F85C"
@@ -87,53 +192,117 @@ class PakeClient:
         self.expectedTauB = None
 
         self.transcript = None
+        self.sessionKey = None
+        self.tagsMatch = None
+
+        self.phase = SessionPhase.created
+
+        # without explicit parameters the library default is used, and the responder follows the initiator's group
+        self.parameters = getParameters(parameters)
+        self.negotiateParameters = parameters == None
+        if self.parameters == None:
+            self.parameters = getDefaultParameters()
+        self.remoteGroup = None
+        self.securityFloor = DEFAULT_SECURITY_FLOOR
 
-        self.parameters = parameters
+        # the initiator offers the three-flow mode, the responder accepts it; both fall back to four flows
+        self.threeFlow = False
+        self.remoteFlows = None
+        self.remoteTag = None
 
         self.executionTime = float(0)
-        self.emailFetchWaitTime = 0
+        self.emailFetchWaitTime = float(0)
 
+        # None waits for the remote side indefinitely
+        self.waitTimeout = None
+        self.cancelEvent = threading.Event()
+
+        # only used to dump PAKE messages to disk for debugging
+        self.debugDump = False
+        # PAKE messages in the X-PakeMail-Envelope header instead of MIME attachments; either is understood on receipt
+        self.compactEnvelope = False
         self.pakeMsgFolderPath = "/tmp/pakemail/"
         self.pakeMsgFileName = "pakemsg{0}".format(self.side)
         self.pakeMsgFilePath = "/tmp/pakemail/{0}".format(self.pakeMsgFileName)
 
         self.pakeMacMsgFileName = "pakemac{0}".format(self.side)
         self.pakeMacMsgFilePath = "/tmp/pakemail/{0}".format(self.pakeMacMsgFileName)
-        
-        idA_bytes = bytes(Roles.A.value, encoding='utf-8')
-        idB_bytes = bytes(Roles.B.value, encoding='utf-8')
-        if side == Roles.A.value:
-            self.pake = SPAKE2_A(idA=idA_bytes, idB=idB_bytes, password=bytes(password, encoding='utf-8'))
-        else:
-            self.pake = SPAKE2_B(idA=idA_bytes, idB=idB_bytes, password=bytes(password, encoding='utf-8'))
 
+        # SPAKE2 runs on the process-wide compute backend unless this client has its own
+        self.computeBackend = None
+        # serialized SPAKE2 state, when the live object is kept elsewhere (checkpoint, worker process)
+        self.spakeState = None
+        # when set, first flows come from the precomputed start pool filled for this handle
+        self.passwordHandle = None
+
+        # no password when restored from a checkpoint, or when only standing in for the remote side
+        self.pake = None
+        if password != None:
+            self.createPake()
+
+    def getSpakeParams(self):
+        if self.parameters == None:
+            return Parameters.ed25519.value
+        return self.parameters.value
+
+    def getGroupName(self):
+        if self.parameters == None:
+            return Parameters.ed25519.name
+        return self.parameters.name
+
+    def createPake(self):
+        self.pake = createSpake(self.side, self.password, self.getSpakeParams())
+        self.spakeState = None
+
+    def getComputeBackend(self):
+        if self.computeBackend != None:
+            return self.computeBackend
+        return getComputeBackend()
+
+    def setup(self, localTest=False, transport=None):
+        with getTracer().span("setup", side=self.side, group=self.getGroupName()):
+            start = time.process_time()
 
-    def setup(self, localTest=False):
-        start = time.process_time()
-
-        sender = self.email
-        receiver = self.remoteClient.email
+            sender = self.email
+            receiver = self.remoteClient.email
 
-        self.readSessionHistoryIntoMemory()
+            self.openSessionHistory()
 
-        self.createInitMsg(writeToFile=True)
+            self.createInitMsg()
 
-        self.pakeMail = PakeMail(self.side, sender, receiver)
+            self.pakeMail = PakeMail(self.side, sender, receiver, pakeMessage=self.pakeMessage, debugDump=self.debugDump, compactEnvelope=self.compactEnvelope)
+            self.pakeMail.group = self.getGroupName()
+            if self.threeFlow and self.side == Roles.A.value:
+                self.pakeMail.flows = THREE_FLOWS
 
-        self.pakeMail.setParentPakeClient(pakeClient=self)
+            self.pakeMail.setParentPakeClient(pakeClient=self)
 
-        self.executionTime += (time.process_time() - start)
+            self.executionTime += (time.process_time() - start)
 
-        # for case 1 in the initial menu, as the values are hardcoded
-        if localTest:
-            self.pakeMailService = PakeMailService(self.pakeMail, askForPassword=False)
-            self.pakeMailService.password = self.password
-        else:
-            self.pakeMailService = PakeMailService(self.pakeMail)
-        self.pakeMailService.username = self.email
+            # for case 1 in the initial menu, as the values are hardcoded
+            if localTest:
+                self.pakeMailService = PakeMailService(self.pakeMail, askForPassword=False, transport=transport)
+                self.pakeMailService.password = self.password
+            elif transport != None:
+                # non-mail transports need no account credentials
+                self.pakeMailService = PakeMailService(self.pakeMail, askForPassword=False, transport=transport)
+                self.pakeMailService.password = None
+            else:
+                self.pakeMailService = PakeMailService(self.pakeMail)
+            self.pakeMailService.username = self.email
     
     def createInitMsg(self, writeToFile=False):
-        self.pakeMessage = self.pake.start()
+        precomputedStart = None
+        if self.passwordHandle != None:
+            precomputedStart = getPrecomputedStartPool().take(self.passwordHandle, self.password, self.getGroupName(), self.side)
+
+        with getTracer().span("spake2_start", side=self.side, group=self.getGroupName(), precomputed=precomputedStart != None):
+            if precomputedStart != None:
+                self.pake = precomputedStart.pake
+                self.spakeState = precomputedStart.spakeState
+                self.pakeMessage = precomputedStart.pakeMessage
+            else:
+                self.pakeMessage = self.getComputeBackend().start(self)
         
         if writeToFile:
             if not os.path.isdir(self.pakeMsgFolderPath):
@@ -145,7 +314,7 @@ class PakeClient:
 
     def createMacMsg(self, mac, writeToFile=False):
         if self.key == None:
-            print("No key available...")
+            logger.warning("No key available...")
             return None
         
         if writeToFile:
@@ -155,59 +324,60 @@ class PakeClient:
             writePakeMsgToFile(mac, self.side, self.pakeMacMsgFilePath)
         
         pakeMessageMail = self.pakeMail
-        self.pakeMail = PakeMail(self.side, pakeMessageMail.senderAddress, pakeMessageMail.recipientAddress, isKeyConfirmationMsg=True)
+        self.pakeMail = PakeMail(self.side, pakeMessageMail.senderAddress, pakeMessageMail.recipientAddress, isKeyConfirmationMsg=True, pakeMessage=mac, debugDump=self.debugDump, compactEnvelope=self.compactEnvelope)
         self.pakeMail.setID(pakeMessageMail.id, messageType="pakeMac")
+        self.pakeMail.inReplyTo = makePakeMessageID(pakeMessageMail.id, self.remoteClient.side, False)
         self.pakeMail.setParentPakeClient(pakeClient=self)
 
         pakeMailService = self.pakeMailService
         self.pakeMailService = PakeMailService(self.pakeMail, askForPassword=False)
-        self.pakeMailService.username = pakeMailService.username
-        self.pakeMailService.password = pakeMailService.password
+        self.pakeMailService.copySettingsFrom(pakeMailService)
 
     def computeKey(self,pake_msg):
         self.remoteClientPakeMessage = pake_msg
-        self.key = self.pake.finish(pake_msg)
+        with getTracer().span("spake2_finish", side=self.side, group=self.getGroupName()):
+            self.key = self.getComputeBackend().finish(self, pake_msg)
 
     def registerRemotePakeClient(self, remoteClient):
-        self.pkAfpr = self.getPublicKeyFingerprint(email=self.email)
-        print("[A] retrieved PK fingerprint: {0}".format(self.pkAfpr))
-
-        self.pkBfpr = self.getPublicKeyFingerprint(email=remoteClient.email)
-        print("[B] retrieved PK fingerprint: {0}".format(self.pkBfpr))
-
-        self.remoteClient = remoteClient
+        fingerprints = self.getPublicKeyFingerprints([self.email, remoteClient.email])
 
-    def writeSessionHistoryToFile(self):
-        file = open("/tmp/pakemail/session_history{0}.txt".format(self.side), "wb") 
+        self.pkAfpr = fingerprints[self.email]
+        logger.info("[A] retrieved PK fingerprint: %s", self.pkAfpr)
 
-        pickle.dump(self.sessionHistory, file) 
+        self.pkBfpr = fingerprints[remoteClient.email]
+        logger.info("[B] retrieved PK fingerprint: %s", self.pkBfpr)
 
-        file.close()
-
-    def readSessionHistoryIntoMemory(self):
+        self.remoteClient = remoteClient
 
-        if not os.path.isfile("/tmp/pakemail/session_history{0}.txt".format(self.side)):
-            return
+    def openSessionHistory(self):
+        # earlier versions kept a pickled dict per side
+        importLegacySessionHistory(self.sessionHistory, self.side)
 
-        with open("/tmp/pakemail/session_history{0}.txt".format(self.side), 'rb+') as handle: 
-            data = handle.read() 
+    def hasSeenSession(self, pakeMailID):
+        return self.sessionHistory.seen(pakeMailID, self.side)
 
-        self.sessionHistory = pickle.loads(data)
+    def recordSession(self, pakeMailID):
+        self.sessionHistory.record(pakeMailID, self.side)
 
     def getPublicKeyFingerprint(self, email=""):
-        fpr = getKeyFingerprintFromGpg(byEmail=email)
-        if len(fpr) == 0 or len(fpr) > 1:
-            print("Either no key pair available or there's more than one... returning a fixed value for testing purposes.")
-            return "BD5F3D50B81B4D471F95EFAD00809FFA6F62F85C"
-        else:
-            return str(fpr[0])
+        return self.getPublicKeyFingerprints([email])[email]
+
+    def getPublicKeyFingerprints(self, emails):
+        fingerprints = dict()
+        for address, fpr in getFingerprintResolver().lookupMany(emails).items():
+            if len(fpr) == 0 or len(fpr) > 1:
+                logger.warning("Either no key pair available or there's more than one... returning a fixed value for testing purposes.")
+                fingerprints[address] = "BD5F3D50B81B4D471F95EFAD00809FFA6F62F85C"
+            else:
+                fingerprints[address] = str(fpr[0])
+        return fingerprints
 
     def computeTranscript(self):
         if self.side == Roles.A.value:
             self.transcript = self.pkAfpr+self.pkBfpr+"A"+"B"+str(self.pakeMessage)+str(self.remoteClientPakeMessage)
         else:
             self.transcript = self.pkBfpr+self.pkAfpr+"A"+"B"+str(self.remoteClientPakeMessage)+str(self.pakeMessage)
-        print("[{0}] transcript: {1}".format(self.side, self.transcript))
+        logger.debug("[%s] transcript: %s", self.side, self.transcript)
 
     def runKeyDerivation(self):
         sessionKey = hkdf_expand(self.key, b"session key", 32)
@@ -221,143 +391,446 @@ class PakeClient:
 
     def sendPakeMessage(self, forKeyConfirmation=False):
         if self.remoteClient == None:
-            print("No remote PAKE client set up.")
+            logger.warning("No remote PAKE client set up.")
             return None
 
         self.pakeMailService.sendPakeMailMessage(self.pakeMailService.createPakeMailMessage(forKeyConfirmation=forKeyConfirmation))
 
-    def runSession(self):
-        start = time.process_time()
+    def sendRejection(self, reason):
+        # the responder's answer to a first flow it cannot take; the initiator fails at once instead of timing out
+        if self.remoteClient == None:
+            logger.warning("No remote PAKE client set up.")
+            return None
 
+        self.pakeMail.setID(self.pakeMail.pakeMailID, "pakeMessage")
+        self.pakeMail.inReplyTo = makePakeMessageID(self.pakeMail.pakeMailID, Roles.A.value, False)
+        self.pakeMailService.sendPakeMailMessage(self.pakeMailService.createPakeRejectMessage(reason))
+
+    def cancelSession(self):
+        self.cancelEvent.set()
+
+    def waitForRemotePakeMessage(self, forKeyConfirmation=False):
+        pakeMessageFromRemote = self.pakeMailService.waitForPakeEmail(forKeyConfirmation=forKeyConfirmation, timeout=self.waitTimeout, cancelEvent=self.cancelEvent)
+        self.emailFetchWaitTime += self.pakeMailService.lastWaitTime
+        if not forKeyConfirmation:
+            self.remoteGroup = self.pakeMailService.remoteGroup
+            self.remoteFlows = self.pakeMailService.remoteFlows
+            self.remoteTag = self.pakeMailService.remoteTag
+
+        if pakeMessageFromRemote == None:
+            if self.pakeMailService.remoteRejectReason != None:
+                logger.warning("[%s] the remote PAKE client refused the session: %s", self.side, self.pakeMailService.remoteRejectReason)
+            elif self.cancelEvent.is_set():
+                logger.warning("[%s] session cancelled while waiting for the remote PAKE client.", self.side)
+            else:
+                logger.warning("[%s] no message from the remote PAKE client after %s seconds.", self.side, self.pakeMailService.lastWaitTime)
+
+        return pakeMessageFromRemote
+
+    def createCheckpoint(self):
+        # what a pending session needs to carry on once the reply arrives, without the live SPAKE2 object
+        if self.phase == SessionPhase.awaitingPakeMessage:
+            spakeState = self.spakeState
+            if self.pake != None:
+                spakeState = self.pake.serialize()
+            spakeState = spakeState.decode("ascii")
+        elif self.phase == SessionPhase.awaitingKeyConfirmation:
+            # SPAKE2 is finished by now, only the derived values are left
+            spakeState = None
+        else:
+            logger.warning("[%s] only sessions waiting for the remote PAKE client can be checkpointed.", self.side)
+            return None
+
+        return {
+            "version": CHECKPOINT_VERSION,
+            "side": self.side,
+            "email": self.email,
+            "remoteEmail": self.remoteClient.email,
+            "sessionID": str(self.pakeMail.id),
+            "pakeMailID": str(self.pakeMail.pakeMailID),
+            "phase": self.phase.value,
+            "group": self.parameters.name if self.parameters != None else None,
+            "negotiateParameters": self.negotiateParameters,
+            "securityFloor": self.securityFloor,
+            "threeFlow": self.threeFlow,
+            "compactEnvelope": self.compactEnvelope,
+            "remoteFlows": self.remoteFlows,
+            "pkAfpr": self.pkAfpr,
+            "pkBfpr": self.pkBfpr,
+            "spakeState": spakeState,
+            "pakeMessage": encodeCheckpointBytes(self.pakeMessage),
+            "remoteClientPakeMessage": encodeCheckpointBytes(self.remoteClientPakeMessage),
+            "key": encodeCheckpointBytes(self.key),
+            "sessionKey": encodeCheckpointBytes(self.sessionKey),
+            "tauA": encodeCheckpointBytes(self.tauA),
+            "tauB": encodeCheckpointBytes(self.tauB),
+            "expectedTauA": encodeCheckpointBytes(self.expectedTauA),
+            "expectedTauB": encodeCheckpointBytes(self.expectedTauB),
+            "executionTime": self.executionTime,
+            "emailFetchWaitTime": self.emailFetchWaitTime,
+        }
+
+    def startSession(self):
+        # only the initiator speaks first; the responder waits for its PAKE message
         if self.side == Roles.A.value:
             # Send pake message to the responder PAKE client
             self.sendPakeMessage()
+        self.phase = SessionPhase.awaitingPakeMessage
+
+    def adoptRemoteGroup(self):
+        remoteGroup = self.remoteGroup
+        if remoteGroup == None or remoteGroup == self.getGroupName():
+            return True
+
+        # only a responder without explicit parameters, and still holding the password, can switch groups
+        if self.side == Roles.B.value and self.negotiateParameters and self.password != None and remoteGroup in Parameters.__members__:
+            if SECURITY_LEVELS[Parameters[remoteGroup]] < self.securityFloor:
+                logger.warning("[%s] refusing the %s group of the initiator: below the %s-bit security floor.", self.side, remoteGroup, self.securityFloor)
+                return False
+            logger.info("[%s] switching to the %s group of the initiator.", self.side, remoteGroup)
+            self.parameters = Parameters[remoteGroup]
+            self.createPake()
+            self.pakeMail.pakeMessage = self.createInitMsg()
+            self.pakeMail.group = remoteGroup
+            return True
+
+        logger.warning("[%s] the remote PAKE client uses the %s group instead of %s.", self.side, remoteGroup, self.getGroupName())
+        return False
+
+    def deriveKeyConfirmation(self, pakeMessageFromRemote):
+        # Compute the intermediate secret key
+        self.computeKey(pakeMessageFromRemote)
+        logger.debug("The intermediate key of %s is: %s", self.side, self.key)
 
-            # Periodically fetch for reply PAKE messages until one found
-            pakeMessageFromRemote = None
-            while (pakeMessageFromRemote == None):
-                self.emailFetchWaitTime += 3
-                time.sleep(3)
-                print("Initiator fetching PAKE message...")
-                pakeMessageFromRemote = self.pakeMailService.fetchPakeEmail()
-        else:
-            # Periodically fetch for reply PAKE messages until one found
-            pakeMessageFromRemote = None
-            while (pakeMessageFromRemote == None):
-                self.emailFetchWaitTime += 3
-                time.sleep(3)
-                print("Responder fetching PAKE message...")
-                pakeMessageFromRemote = self.pakeMailService.fetchPakeEmail()
+        # Key confirmation starts here
+        with getTracer().span("key_confirmation", side=self.side):
+            k, macKeyA, macKeyB = self.runKeyDerivation()
+            self.sessionKey = k
+            self.computeTranscript()
+            macMessage = self.transcript
+
+            if self.side == Roles.A.value:
+                self.tauA = self.computeMAC(macKeyA, macMessage)
+                self.expectedTauB = self.computeMAC(macKeyB, macMessage)
+                return self.tauA
+            else:
+                self.tauB = self.computeMAC(macKeyB, macMessage)
+                self.expectedTauA = self.computeMAC(macKeyA, macMessage)
+                return self.tauB
+
+    def handleRemotePakeMessage(self, pakeMessageFromRemote, pakeMailID=None, remoteGroup=None, remoteFlows=None, remoteTag=None):
+        if pakeMailID != None:
+            self.pakeMail.pakeMailID = pakeMailID
+        if remoteGroup != None:
+            self.remoteGroup = remoteGroup
+        if remoteFlows != None:
+            self.remoteFlows = remoteFlows
+        if remoteTag != None:
+            self.remoteTag = remoteTag
+
+        if not self.adoptRemoteGroup():
+            if self.side == Roles.B.value:
+                self.sendRejection("group {0} refused".format(self.remoteGroup))
+            self.phase = SessionPhase.failed
+            return
 
+        if self.side == Roles.B.value:
             self.pakeMail.setID(self.pakeMail.pakeMailID, "pakeMac")
             self.pakeMail.setID(self.pakeMail.pakeMailID, "pakeMessage")
+            self.pakeMail.inReplyTo = makePakeMessageID(self.pakeMail.pakeMailID, Roles.A.value, False)
+
+            if self.threeFlow and self.remoteFlows == THREE_FLOWS:
+                # the tag travels with the PAKE message, saving one email delivery
+                tau = self.deriveKeyConfirmation(pakeMessageFromRemote)
+                self.pakeMail.keyConfirmationTag = tau
+                self.pakeMail.flows = THREE_FLOWS
+                self.sendPakeMessage()
+
+                self.createMacMsg(tau)
+                self.phase = SessionPhase.awaitingKeyConfirmation
+                return
 
             # Send pake message to the initiator PAKE client
             self.sendPakeMessage()
-            
-        # Compute the intermediate secret key
-        self.computeKey(pakeMessageFromRemote)
-        print("\nThe intermediate key of {0} is:\n{1}\n".format(self.side, self.key))
 
-        # Key confirmation starts here
-        k, macKeyA, macKeyB = self.runKeyDerivation()
-        self.computeTranscript()
-        macMessage = self.transcript
-        
+        tau = self.deriveKeyConfirmation(pakeMessageFromRemote)
+        self.createMacMsg(tau)
+
+        if self.side == Roles.A.value and self.remoteTag != None and not (self.threeFlow and self.remoteFlows == THREE_FLOWS):
+            # a mode we did not offer: the session goes on with four flows
+            logger.warning("[%s] ignoring a key confirmation tag sent without the three-flow mode.", self.side)
+            self.remoteTag = None
+
+        if self.side == Roles.A.value and self.remoteTag != None:
+            # three flows: the responder's tag came along, and ours is only sent if it checks out
+            self.handleRemoteKeyConfirmation(self.remoteTag, pakeMailID=self.pakeMail.pakeMailID)
+            if self.phase == SessionPhase.completed:
+                self.sendPakeMessage(forKeyConfirmation=True)
+            return
+
+        self.sendPakeMessage(forKeyConfirmation=True)
+        self.phase = SessionPhase.awaitingKeyConfirmation
+
+    def handleRemoteKeyConfirmation(self, pakeMessageFromRemote, pakeMailID=None):
+        if pakeMailID != None:
+            self.pakeMail.pakeMailID = pakeMailID
+            self.recordSession(pakeMailID)
+
+        logger.debug("%s received tau: %s", self.side, pakeMessageFromRemote)
+
         if self.side == Roles.A.value:
-            self.tauA = self.computeMAC(macKeyA, macMessage)
-            self.createMacMsg(self.tauA, writeToFile=True)
-            self.expectedTauB = self.computeMAC(macKeyB, macMessage)
+            logger.debug("%s comparing tags %s %s", self.side, self.expectedTauB, pakeMessageFromRemote)
+            self.tagsMatch = hmac.compare_digest(self.expectedTauB, pakeMessageFromRemote)
+            logger.info("Tags match on A side: %s", self.tagsMatch)
         else:
-            self.tauB = self.computeMAC(macKeyB, macMessage)
-            self.createMacMsg(self.tauB, writeToFile=True)
-            self.expectedTauA = self.computeMAC(macKeyA, macMessage)
+            logger.debug("%s comparing tags %s %s", self.side, self.expectedTauA, pakeMessageFromRemote)
+            self.tagsMatch = hmac.compare_digest(self.expectedTauA, pakeMessageFromRemote)
+            logger.info("Tags match on B side: %s", self.tagsMatch)
 
-        self.sendPakeMessage(forKeyConfirmation=True)
-        
-        # Periodically fetch for reply PAKE KC messages until one found
-        pakeMessageFromRemote = None
-        while (pakeMessageFromRemote == None):
-            self.emailFetchWaitTime += 3
-            time.sleep(3)
-            print("{0} fetching KC message...".format(self.side))
-            pakeMessageFromRemote = self.pakeMailService.fetchPakeEmail(forKeyConfirmation=True)
+        logger.debug("Final secret key on %s side is: %s", self.side, self.sessionKey)
+
+        if self.tagsMatch:
+            self.phase = SessionPhase.completed
+        else:
+            self.phase = SessionPhase.failed
 
-        print("{0} received tau:\n{1}".format(self.side, pakeMessageFromRemote))
+    def releaseSession(self):
+        # the transport archives or deletes this session's emails according to its retention policy
+        if self.pakeMailService != None:
+            self.pakeMailService.releaseSession(self.phase == SessionPhase.completed)
+
+    def runSession(self):
+        with getTracer().span("session", side=self.side, group=self.getGroupName()) as span:
+            key = self.runSessionSteps()
+            self.releaseSession()
+            self.traceOutcome(span)
+        return key
+
+    def traceOutcome(self, span):
+        span.set("sessionID", str(self.pakeMail.pakeMailID) if self.pakeMail != None else None)
+        span.set("outcome", self.phase.value)
+        span.set("emailFetchWaitTime", self.emailFetchWaitTime)
+
+    def runSessionSteps(self):
+        start = time.process_time()
 
+        self.startSession()
+
+        # Wait for the remote PAKE message
         if self.side == Roles.A.value:
-            print("{0} comparing tags\n{1}\n{2}: ".format(self.side, self.expectedTauB, pakeMessageFromRemote))
-            print("Tags match on A side: ", self.expectedTauB == pakeMessageFromRemote)
+            logger.info("Initiator waiting for PAKE message...")
         else:
-            print("{0} comparing tags\n{1}\n{2}: ".format(self.side, self.expectedTauA, pakeMessageFromRemote))
-            print("Tags match on B side: ", self.expectedTauA == pakeMessageFromRemote)
+            logger.info("Responder waiting for PAKE message...")
+        pakeMessageFromRemote = self.waitForRemotePakeMessage()
+        if pakeMessageFromRemote == None:
+            self.phase = SessionPhase.failed
+            return None
 
-        print("Final secret key on {0} side is: ".format(self.side), k)
+        self.handleRemotePakeMessage(pakeMessageFromRemote)
+        if self.phase == SessionPhase.failed:
+            return None
+        if self.phase == SessionPhase.completed:
+            self.executionTime += (time.process_time() - start)
+            return self.key
+        
+        # Wait for the reply PAKE KC message
+        logger.info("%s waiting for KC message...", self.side)
+        pakeMessageFromRemote = self.waitForRemotePakeMessage(forKeyConfirmation=True)
+        if pakeMessageFromRemote == None:
+            self.phase = SessionPhase.failed
+            return None
 
-        self.writeSessionHistoryToFile()
+        self.handleRemoteKeyConfirmation(pakeMessageFromRemote)
 
         self.executionTime += (time.process_time() - start)
 
         return self.key
-        
-def run_pure_spake2_experiment(verbose=False):
-    executionTime = float(0)
-    start = time.process_time()
-
-    password=b"pass"
-
-    parameters = ["Params1024", "Params2048", "Params3072", ""]
-
-    round_count = 50
-    for param in parameters:
-        total_execution_time = float(0)
-
-        if (param=="Params1024"):
-            selected_param=Params1024
-        if (param=="Params2048"):
-            selected_param=Params2048
-        if (param=="Params3072"):
-            selected_param=Params3072
-        if param=="":
-            selected_param=""
-        
-        if selected_param == "":
-            print("Selected security level: Curve25519")
-        else:
-            print("Selected security level:", param)
 
-        for _ in range(1, round_count):
-            executionTime = float(0)
-            start = time.process_time()
-
-            if selected_param == "":
-                alice = SPAKE2_A(password)
-                bob = SPAKE2_B(password)
+    async def wait_for_remote_pake_message(self, forKeyConfirmation=False):
+        pakeMessageFromRemote = await self.pakeMailService.wait_for_pake_email(forKeyConfirmation=forKeyConfirmation, timeout=self.waitTimeout)
+        self.emailFetchWaitTime += self.pakeMailService.lastWaitTime
+        if not forKeyConfirmation:
+            self.remoteGroup = self.pakeMailService.remoteGroup
+            self.remoteFlows = self.pakeMailService.remoteFlows
+            self.remoteTag = self.pakeMailService.remoteTag
+
+        if pakeMessageFromRemote == None:
+            if self.pakeMailService.remoteRejectReason != None:
+                logger.warning("[%s] the remote PAKE client refused the session: %s", self.side, self.pakeMailService.remoteRejectReason)
             else:
-                alice = SPAKE2_A(password,params=selected_param)
-                bob = SPAKE2_B(password,params=selected_param)
-                
-            alice_out = alice.start()
-            bob_out = bob.start()
-
-            if verbose:
-                print("\nAlice sends:\t",base64.b64encode(alice_out))
-                print("Bob sends:\t",base64.b64encode(bob_out))
-
-            keyA = alice.finish(bob_out)
-            keyB = bob.finish(alice_out)
-
-            if verbose:
-                print("\nKey (Alice):\t",base64.b64encode(keyA))
-                print("Key (Bob):\t",base64.b64encode(keyB))
-                print("Derived keys equal?",base64.b64encode(keyA)==base64.b64encode(keyB))
-
-            executionTime = (time.process_time() - start)
-            total_execution_time += executionTime
-            print("Individual experiment execution time: ", executionTime)
-        
-        print("Average execution time: ", total_execution_time/round_count)
-        print("-------------------------------------------")
+                logger.warning("[%s] no message from the remote PAKE client after %s seconds.", self.side, self.pakeMailService.lastWaitTime)
+
+        return pakeMessageFromRemote
+
+    async def run_session(self):
+        with getTracer().span("session", side=self.side, group=self.getGroupName()) as span:
+            key = await self.run_session_steps()
+            await runBlocking(self.releaseSession)
+            self.traceOutcome(span)
+        return key
+
+    async def run_session_steps(self):
+        # same steps as runSession; sends and SPAKE2 computations go to the executor, waits share one mailbox reader
+        start = time.process_time()
+
+        await runBlocking(self.startSession)
+
+        pakeMessageFromRemote = await self.wait_for_remote_pake_message()
+        if pakeMessageFromRemote == None:
+            self.phase = SessionPhase.failed
+            return None
+
+        await runBlocking(self.handleRemotePakeMessage, pakeMessageFromRemote)
+        if self.phase == SessionPhase.failed:
+            return None
+        if self.phase == SessionPhase.completed:
+            self.executionTime += (time.process_time() - start)
+            return self.key
+
+        pakeMessageFromRemote = await self.wait_for_remote_pake_message(forKeyConfirmation=True)
+        if pakeMessageFromRemote == None:
+            self.phase = SessionPhase.failed
+            return None
+
+        await runBlocking(self.handleRemoteKeyConfirmation, pakeMessageFromRemote)
+
+        self.executionTime += (time.process_time() - start)
+
+        return self.key
+
+def encodeCheckpointBytes(value):
+    if value == None:
+        return None
+    return base64.b64encode(value).decode("ascii")
+
+def decodeCheckpointBytes(value):
+    if value == None:
+        return None
+    return base64.b64decode(value)
+
+def restorePakeClient(checkpoint, transport=None, pakeMailService=None):
+    # the PAKE password is not needed any more, the serialized SPAKE2 state replaces it
+    side = checkpoint["side"]
+    remoteSide = Roles.B.value if side == Roles.A.value else Roles.A.value
+
+    pakeClient = PakeClient(side, None, checkpoint["email"], parameters=checkpoint["group"])
+    if checkpoint["group"] == None:
+        # saved before process-wide default parameters existed: the library default
+        pakeClient.parameters = None
+    pakeClient.negotiateParameters = checkpoint["negotiateParameters"]
+    pakeClient.securityFloor = checkpoint.get("securityFloor", DEFAULT_SECURITY_FLOOR)
+    pakeClient.threeFlow = checkpoint["threeFlow"]
+    pakeClient.compactEnvelope = checkpoint.get("compactEnvelope", False)
+    pakeClient.remoteFlows = checkpoint["remoteFlows"]
+    pakeClient.remoteClient = PakeClient(remoteSide, None, checkpoint["remoteEmail"])
+
+    pakeClient.phase = SessionPhase(checkpoint["phase"])
+    pakeClient.pkAfpr = checkpoint["pkAfpr"]
+    pakeClient.pkBfpr = checkpoint["pkBfpr"]
+
+    pakeClient.pakeMessage = decodeCheckpointBytes(checkpoint["pakeMessage"])
+    pakeClient.remoteClientPakeMessage = decodeCheckpointBytes(checkpoint["remoteClientPakeMessage"])
+    pakeClient.key = decodeCheckpointBytes(checkpoint["key"])
+    pakeClient.sessionKey = decodeCheckpointBytes(checkpoint["sessionKey"])
+    pakeClient.tauA = decodeCheckpointBytes(checkpoint["tauA"])
+    pakeClient.tauB = decodeCheckpointBytes(checkpoint["tauB"])
+    pakeClient.expectedTauA = decodeCheckpointBytes(checkpoint["expectedTauA"])
+    pakeClient.expectedTauB = decodeCheckpointBytes(checkpoint["expectedTauB"])
+
+    pakeClient.executionTime = checkpoint["executionTime"]
+    pakeClient.emailFetchWaitTime = checkpoint["emailFetchWaitTime"]
+
+    # the compute backend turns this back into a SPAKE2 object when the reply arrives
+    if checkpoint["spakeState"] != None:
+        pakeClient.spakeState = bytes(checkpoint["spakeState"], encoding="ascii")
+
+    pakeClient.openSessionHistory()
+
+    if pakeClient.phase == SessionPhase.awaitingKeyConfirmation:
+        tau = pakeClient.tauA if side == Roles.A.value else pakeClient.tauB
+        pakeClient.pakeMail = PakeMail(side, pakeClient.email, pakeClient.remoteClient.email, isKeyConfirmationMsg=True, pakeMessage=tau, compactEnvelope=pakeClient.compactEnvelope)
+        pakeClient.pakeMail.setID(checkpoint["sessionID"], messageType="pakeMac")
+        pakeClient.pakeMail.inReplyTo = makePakeMessageID(checkpoint["sessionID"], remoteSide, False)
+    else:
+        pakeClient.pakeMail = PakeMail(side, pakeClient.email, pakeClient.remoteClient.email, pakeMessage=pakeClient.pakeMessage, compactEnvelope=pakeClient.compactEnvelope)
+        pakeClient.pakeMail.setID(checkpoint["sessionID"])
+        pakeClient.pakeMail.group = pakeClient.getGroupName()
+    pakeClient.pakeMail.pakeMailID = checkpoint["pakeMailID"]
+    pakeClient.pakeMail.setParentPakeClient(pakeClient=pakeClient)
+
+    if pakeMailService != None:
+        pakeClient.pakeMailService = PakeMailService(pakeClient.pakeMail, askForPassword=False)
+        pakeClient.pakeMailService.copySettingsFrom(pakeMailService)
+    elif transport != None:
+        pakeClient.pakeMailService = PakeMailService(pakeClient.pakeMail, askForPassword=False, transport=transport)
+        pakeClient.pakeMailService.username = pakeClient.email
+        pakeClient.pakeMailService.password = None
+    else:
+        pakeClient.pakeMailService = PakeMailService(pakeClient.pakeMail)
+
+    return pakeClient
+
+def timeParameters(parameters, rounds=5):
+    # one full exchange (both sides' start and finish) per round, wall-clock time
+    password = b"calibration"
+    elapsed = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        alice = SPAKE2_A(password, params=parameters.value)
+        bob = SPAKE2_B(password, params=parameters.value)
+        alice_out = alice.start()
+        bob_out = bob.start()
+        alice.finish(bob_out)
+        bob.finish(alice_out)
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+def calibrateParameters(securityFloor=DEFAULT_SECURITY_FLOOR, rounds=5, verbose=True):
+    # the fastest group on this machine among those meeting the security floor
+    candidates = [parameters for parameters in Parameters if SECURITY_LEVELS[parameters] >= securityFloor]
+    if len(candidates) == 0:
+        print("No SPAKE2 group offers {0} bits of security.".format(securityFloor))
+        return None
+
+    timings = dict()
+    for parameters in candidates:
+        timings[parameters] = timeParameters(parameters, rounds=rounds)
+        if verbose:
+            print("{0} ({1} bits): {2:.2f} ms per exchange".format(parameters.name, SECURITY_LEVELS[parameters], timings[parameters] * 1000))
+
+    selected = min(candidates, key=lambda parameters: timings[parameters])
+    if verbose:
+        print("Selected SPAKE2 group: {0}".format(selected.name))
+    return selected
+
+_calibratedParameters = dict()
+
+def getCalibratedParameters(securityFloor=DEFAULT_SECURITY_FLOOR, verbose=False):
+    # calibrated once per process and security floor
+    if not securityFloor in _calibratedParameters:
+        _calibratedParameters[securityFloor] = calibrateParameters(securityFloor=securityFloor, verbose=verbose)
+    return _calibratedParameters[securityFloor]
+
+_defaultParameters = None
+
+def getDefaultParameters():
+    return _defaultParameters
+
+def setDefaultParameters(parameters):
+    # group of clients created without parameters; None goes back to the library default
+    global _defaultParameters
+    _defaultParameters = getParameters(parameters)
+
+def useCalibratedParameters(securityFloor=DEFAULT_SECURITY_FLOOR, verbose=False):
+    # the calibration runs once, when the process starts using it
+    parameters = getCalibratedParameters(securityFloor=securityFloor, verbose=verbose)
+    setDefaultParameters(parameters)
+    return parameters
+
+def run_pure_spake2_experiment():
+    # the SPAKE2 library alone, per phase and group; pakebench has the full suite
+    from pakebench import run_benchmark
+    return run_benchmark(phases=["spake2_start", "spake2_finish", "spake2_exchange"], verbose=True)
 
 if __name__ == "__main__":
     run_pure_spake2_experiment()
\ No newline at end of file
@@ -0,0 +1,995 @@
+import argparse
+import datetime
+import email
+import email.parser
+import email.utils
+import heapq
+import ipaddress
+import itertools
+import json
+import math
+import os
+import random
+import select
+import socket
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pakeimap import tokenizeImapLine, parseImapTokens, getImapConnectionPool
+from pakesmtp import SECURITY_SSL, SECURITY_PLAIN, closeSmtpSenders
+from paketransport import canonicalAccount
+
+# A local stand-in for the mail provider: an SMTP sink and a minimal IMAP4rev1 server over one
+# in-memory store, with optional TLS, and a load generator driving PakeClient pairs through them.
+# Only what PakeMail's own SMTP/IMAP code needs is implemented.
+
+MAX_LINE = 65536
+
+# each distribution draws from the random module unless given its own generator, e.g. a seeded one
+def fixedDelay(seconds):
+    return lambda rng=random: seconds
+
+def uniformDelay(low, high):
+    return lambda rng=random: rng.uniform(low, high)
+
+def exponentialDelay(mean):
+    return lambda rng=random: rng.expovariate(1.0 / mean)
+
+def lognormalDelay(median, sigma):
+    # long tailed, like real delivery times
+    return lambda rng=random: rng.lognormvariate(math.log(median), sigma)
+
+DELAY_DISTRIBUTIONS = {"fixed": fixedDelay, "uniform": uniformDelay, "exp": exponentialDelay, "lognormal": lognormalDelay}
+
+def parseDelay(spec):
+    # "fixed:0.5", "uniform:0.1,2", "exp:1", "lognormal:1,0.8"; None or "0" deliver at once
+    if spec == None or spec == "0":
+        return None
+    name, _, arguments = spec.partition(":")
+    if not name in DELAY_DISTRIBUTIONS:
+        raise ValueError("unknown delay distribution {0}".format(name))
+    values = [float(value) for value in arguments.split(",") if value]
+    return DELAY_DISTRIBUTIONS[name](*values)
+
+class StoredMessage:
+
+    def __init__(self, uid, data, flags=()):
+        self.uid = uid
+        self.data = data
+        self.flags = set(flags)
+
+        self.message = None
+        self.headers = None
+
+    def getMessage(self):
+        if self.message == None:
+            self.message = email.message_from_bytes(self.data)
+        return self.message
+
+    def getHeaders(self):
+        if self.headers == None:
+            self.headers = email.parser.BytesHeaderParser().parsebytes(self.data)
+        return self.headers
+
+    def getHeaderBlock(self):
+        for separator in (b"\r\n\r\n", b"\n\n"):
+            end = self.data.find(separator)
+            if end >= 0:
+                return self.data[:end + len(separator)]
+        return self.data
+
+    def getText(self):
+        return self.data[len(self.getHeaderBlock()):]
+
+class LocalMailbox:
+
+    def __init__(self):
+        self.uidValidity = random.randint(1, 2 ** 31 - 1)
+        self.nextUid = 1
+        # uid -> StoredMessage, in sequence number order
+        self.messages = OrderedDict()
+
+    def append(self, data, flags=()):
+        uid = self.nextUid
+        self.nextUid += 1
+        self.messages[uid] = StoredMessage(uid, data, flags)
+        return uid
+
+    def expunge(self, uids):
+        # sequence numbers of the removed messages, highest first as EXPUNGE responses must go
+        sequenceNumbers = []
+        for sequenceNumber, uid in enumerate(list(self.messages.keys()), 1):
+            if uid in uids:
+                sequenceNumbers.append(sequenceNumber)
+        for uid in uids:
+            self.messages.pop(uid, None)
+        return sorted(sequenceNumbers, reverse=True)
+
+class MailStore:
+
+    def __init__(self, deliveryDelay=None):
+        # (account, folder) -> LocalMailbox; one condition guards them all
+        self.mailboxes = dict()
+        self.condition = threading.Condition()
+
+        # deliveryDelay() gives the seconds between SMTP submission and arrival in the mailbox
+        self.deliveryDelay = deliveryDelay
+        self.scheduled = []
+        self.sequence = itertools.count()
+        self.deliveryThread = None
+        self.stopped = False
+
+        self.submittedCount = 0
+        self.deliveredCount = 0
+
+    def getMailbox(self, account, folder="inbox", create=True):
+        if folder.lower() == "inbox":
+            folder = "inbox"
+        key = (canonicalAccount(account), folder)
+        with self.condition:
+            mailbox = self.mailboxes.get(key)
+            if mailbox == None and create:
+                mailbox = LocalMailbox()
+                self.mailboxes[key] = mailbox
+        return mailbox
+
+    def submit(self, recipients, data):
+        delay = 0
+        if self.deliveryDelay != None:
+            delay = max(0, self.deliveryDelay())
+
+        with self.condition:
+            self.submittedCount += 1
+            if delay == 0:
+                self.deliver(recipients, data)
+                return
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.sequence), recipients, data))
+            if self.deliveryThread == None:
+                self.deliveryThread = threading.Thread(target=self.runDeliveries, daemon=True)
+                self.deliveryThread.start()
+            self.condition.notify_all()
+
+    def deliver(self, recipients, data):
+        with self.condition:
+            # "+" tagged addresses land in the base account's inbox, as with Gmail
+            for account in set(canonicalAccount(recipient) for recipient in recipients):
+                self.getMailbox(account).append(data)
+            self.deliveredCount += 1
+            self.condition.notify_all()
+
+    def runDeliveries(self):
+        with self.condition:
+            while not self.stopped:
+                if len(self.scheduled) == 0:
+                    self.condition.wait()
+                    continue
+                waitTime = self.scheduled[0][0] - time.monotonic()
+                if waitTime > 0:
+                    self.condition.wait(waitTime)
+                    continue
+                _, _, recipients, data = heapq.heappop(self.scheduled)
+                self.deliver(recipients, data)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+class ServerStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def add(self, connections=0, commands=0, bytesIn=0, bytesOut=0):
+        with self.lock:
+            self.connections += connections
+            self.commands += commands
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+
+    def snapshot(self):
+        with self.lock:
+            return dict(connections=self.connections, commands=self.commands, bytesIn=self.bytesIn, bytesOut=self.bytesOut)
+
+class LocalMailHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        # responses go out in several small writes, which Nagle's algorithm would hold back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.server.sslContext != None:
+            self.request = self.server.sslContext.wrap_socket(self.request, server_side=True)
+        socketserver.StreamRequestHandler.setup(self)
+        self.server.stats.add(connections=1)
+
+    def readLine(self):
+        line = self.rfile.readline(MAX_LINE)
+        self.server.stats.add(bytesIn=len(line))
+        return line
+
+    def write(self, data):
+        self.wfile.write(data)
+        self.server.stats.add(bytesOut=len(data))
+
+    def clientReady(self, timeout):
+        # TLS may hold decrypted bytes that select() does not see
+        if hasattr(self.connection, "pending") and self.connection.pending() > 0:
+            return True
+        return len(select.select([self.connection], [], [], timeout)[0]) > 0
+
+def parseSmtpAddress(argument):
+    # "FROM:<a@b> BODY=8BITMIME" -> "a@b"
+    _, _, address = argument.partition(":")
+    start = address.find("<")
+    end = address.find(">")
+    if start >= 0 and end > start:
+        return address[start + 1:end]
+    return address.strip().split(" ")[0]
+
+class LocalSmtpHandler(LocalMailHandler):
+
+    def handle(self):
+        # accepts any credentials and any recipient; every message ends up in the store
+        self.write(b"220 localhost PakeMail SMTP sink\r\n")
+        mailFrom = None
+        recipients = []
+
+        while True:
+            line = self.readLine()
+            if not line:
+                return
+            command, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+            command = command.upper()
+            self.server.stats.add(commands=1)
+
+            if command == "EHLO":
+                self.write(b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif command == "HELO":
+                self.write(b"250 localhost\r\n")
+            elif command == "AUTH":
+                if not self.authenticate(argument):
+                    return
+            elif command == "MAIL":
+                mailFrom = parseSmtpAddress(argument)
+                recipients = []
+                self.write(b"250 2.1.0 OK\r\n")
+            elif command == "RCPT":
+                recipients.append(parseSmtpAddress(argument))
+                self.write(b"250 2.1.5 OK\r\n")
+            elif command == "DATA":
+                if mailFrom == None or len(recipients) == 0:
+                    self.write(b"503 5.5.1 MAIL and RCPT first\r\n")
+                    continue
+                self.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data = self.readData()
+                if data == None:
+                    return
+                self.server.store.submit(recipients, data)
+                self.write(b"250 2.0.0 queued\r\n")
+                mailFrom = None
+                recipients = []
+            elif command == "RSET":
+                mailFrom = None
+                recipients = []
+                self.write(b"250 2.0.0 OK\r\n")
+            elif command == "NOOP":
+                self.write(b"250 2.0.0 OK\r\n")
+            elif command == "QUIT":
+                self.write(b"221 2.0.0 bye\r\n")
+                return
+            else:
+                self.write(b"502 5.5.2 command not implemented\r\n")
+
+    def authenticate(self, argument):
+        mechanism, _, initialResponse = argument.partition(" ")
+        mechanism = mechanism.upper()
+        if mechanism == "PLAIN":
+            if not initialResponse and not self.challenge(b""):
+                return False
+        elif mechanism == "LOGIN":
+            if not initialResponse and not self.challenge(b"VXNlcm5hbWU6"):
+                return False
+            if not self.challenge(b"UGFzc3dvcmQ6"):
+                return False
+        else:
+            self.write(b"504 5.5.4 unrecognized authentication type\r\n")
+            return True
+        self.write(b"235 2.7.0 Authentication successful\r\n")
+        return True
+
+    def challenge(self, prompt):
+        self.write(b"334 " + prompt + b"\r\n")
+        return len(self.readLine()) > 0
+
+    def readData(self):
+        lines = []
+        while True:
+            line = self.readLine()
+            if not line:
+                return None
+            if line in (b".\r\n", b".\n"):
+                return b"".join(lines)
+            # undo dot stuffing
+            if line.startswith(b"."):
+                line = line[1:]
+            lines.append(line)
+
+class ImapCommandError(Exception):
+
+    def __init__(self, status, text):
+        Exception.__init__(self, text)
+        self.status = status
+        self.text = text
+
+def imapQuote(value):
+    if value == None:
+        return b"NIL"
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return b'"' + value.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+def imapLiteral(data):
+    return b"{" + str(len(data)).encode("ascii") + b"}\r\n" + data
+
+def imapText(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+def parseSequenceSet(value, largest):
+    # "1:3,7,9:*" -> list of (low, high); "*" is the largest number in use
+    ranges = []
+    for item in imapText(value).split(","):
+        bounds = [largest if bound == "*" else int(bound) for bound in item.split(":")]
+        ranges.append((min(bounds), max(bounds)))
+    return ranges
+
+def inSequenceSet(number, ranges):
+    for low, high in ranges:
+        if low <= number <= high:
+            return True
+    return False
+
+def partBody(part):
+    # the body as it was transferred, e.g. still base64 encoded
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, str):
+        return payload.encode("ascii", "surrogateescape")
+    return b""
+
+def findPart(message, section):
+    part = message
+    for number in section.split("."):
+        number = int(number)
+        if part.is_multipart():
+            children = part.get_payload()
+            if number < 1 or number > len(children):
+                return None
+            part = children[number - 1]
+        elif number != 1:
+            return None
+    return part
+
+def bodyStructureParameters(parameters):
+    if len(parameters) == 0:
+        return b"NIL"
+    fields = []
+    for key, value in parameters:
+        fields.append(imapQuote(key.upper()) + b" " + imapQuote(email.utils.collapse_rfc2231_value(value)))
+    return b"(" + b" ".join(fields) + b")"
+
+def bodyStructure(part):
+    if part.is_multipart():
+        children = b"".join(bodyStructure(child) for child in part.get_payload())
+        return b"(" + children + b" " + imapQuote(part.get_content_subtype().upper()) + b")"
+
+    mainType = part.get_content_maintype().upper()
+    body = partBody(part)
+    fields = [
+        imapQuote(mainType),
+        imapQuote(part.get_content_subtype().upper()),
+        bodyStructureParameters((part.get_params() or [])[1:]),
+        b"NIL",
+        b"NIL",
+        imapQuote((part.get("Content-Transfer-Encoding") or "7BIT").upper()),
+        str(len(body)).encode("ascii"),
+    ]
+    if mainType == "TEXT":
+        fields.append(str(body.count(b"\n")).encode("ascii"))
+
+    # extension data: MD5, disposition and language
+    disposition = b"NIL"
+    if part.get_content_disposition() != None:
+        dispositionParameters = (part.get_params(header="content-disposition") or [])[1:]
+        disposition = b"(" + imapQuote(part.get_content_disposition().upper()) + b" " + bodyStructureParameters(dispositionParameters) + b")"
+    fields += [b"NIL", disposition, b"NIL"]
+
+    return b"(" + b" ".join(fields) + b")"
+
+def headerFields(headerBlock, names):
+    # the named header lines, folded continuation lines included
+    names = set(name.lower() for name in names)
+    lines = []
+    keep = False
+    for line in headerBlock.splitlines(True):
+        if line.strip() == b"":
+            break
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.split(b":", 1)[0].strip().decode("ascii", "replace").lower() in names
+        if keep:
+            lines.append(line)
+    return b"".join(lines) + b"\r\n"
+
+FLAG_SEEN = b"\\Seen"
+FLAG_DELETED = b"\\Deleted"
+
+SEARCH_FLAGS = {"SEEN": (FLAG_SEEN, True), "UNSEEN": (FLAG_SEEN, False), "DELETED": (FLAG_DELETED, True), "UNDELETED": (FLAG_DELETED, False)}
+
+def parseSearchKey(values, position, largestUid, largestSequence):
+    # one search key as predicate(sequenceNumber, message)
+    token = values[position]
+    position += 1
+
+    if isinstance(token, list):
+        predicates = parseSearchKeys(token, largestUid, largestSequence)
+        return (lambda sequenceNumber, message: all(predicate(sequenceNumber, message) for predicate in predicates)), position
+
+    key = imapText(token).upper()
+    if key == "ALL":
+        return (lambda sequenceNumber, message: True), position
+    if key in SEARCH_FLAGS:
+        flag, present = SEARCH_FLAGS[key]
+        return (lambda sequenceNumber, message: (flag in message.flags) == present), position
+    if key == "UID":
+        ranges = parseSequenceSet(values[position], largestUid)
+        return (lambda sequenceNumber, message: inSequenceSet(message.uid, ranges)), position + 1
+    if key == "NOT":
+        predicate, position = parseSearchKey(values, position, largestUid, largestSequence)
+        return (lambda sequenceNumber, message: not predicate(sequenceNumber, message)), position
+    if key == "OR":
+        first, position = parseSearchKey(values, position, largestUid, largestSequence)
+        second, position = parseSearchKey(values, position, largestUid, largestSequence)
+        return (lambda sequenceNumber, message: first(sequenceNumber, message) or second(sequenceNumber, message)), position
+    if key == "HEADER":
+        field, value = imapText(values[position]), imapText(values[position + 1] or b"")
+        return headerPredicate(field, value), position + 2
+    if key in ("SUBJECT", "FROM", "TO"):
+        return headerPredicate(key, imapText(values[position] or b"")), position + 1
+    if key[:1].isdigit() or key[:1] == "*":
+        ranges = parseSequenceSet(token, largestSequence)
+        return (lambda sequenceNumber, message: inSequenceSet(sequenceNumber, ranges)), position
+
+    raise ImapCommandError("BAD", "unsupported search key {0}".format(key))
+
+def parseSearchKeys(values, largestUid, largestSequence):
+    predicates = []
+    position = 0
+    while position < len(values):
+        predicate, position = parseSearchKey(values, position, largestUid, largestSequence)
+        predicates.append(predicate)
+    return predicates
+
+def headerPredicate(field, value):
+    # an empty value matches any message that has the field
+    value = value.lower()
+    def predicate(sequenceNumber, message):
+        for headerValue in message.getHeaders().get_all(field, []):
+            if value in str(headerValue).lower():
+                return True
+        return False
+    return predicate
+
+IMAP_CAPABILITIES = b"IMAP4rev1 IDLE UIDPLUS MOVE"
+
+class LocalImapHandler(LocalMailHandler):
+
+    def handle(self):
+        self.account = None
+        self.mailbox = None
+        self.knownCount = 0
+
+        self.write(b"* OK [CAPABILITY " + IMAP_CAPABILITIES + b"] PakeMail local IMAP server ready\r\n")
+        while True:
+            line = self.readLine()
+            if not line:
+                return
+
+            tokens = []
+            tokenizeImapLine(line, tokens)
+            values, _ = parseImapTokens(tokens)
+            if len(values) < 2 or not isinstance(values[0], bytes) or not isinstance(values[1], bytes):
+                self.write(b"* BAD malformed command\r\n")
+                continue
+            if line.rstrip().endswith(b"}"):
+                self.write(values[0] + b" BAD literals are not supported\r\n")
+                continue
+
+            tag = values[0]
+            command = imapText(values[1]).upper()
+            arguments = values[2:]
+            byUid = False
+            if command == "UID" and len(arguments) > 0:
+                byUid = True
+                command = imapText(arguments[0]).upper()
+                arguments = arguments[1:]
+            self.server.stats.add(commands=1)
+
+            handler = getattr(self, "command" + command.capitalize(), None)
+            if handler == None:
+                self.write(tag + b" BAD unknown command\r\n")
+                continue
+
+            try:
+                completion = handler(arguments, byUid)
+            except ImapCommandError as e:
+                self.write(tag + b" " + e.status.encode("ascii") + b" " + e.text.encode("utf-8") + b"\r\n")
+                continue
+            except (IndexError, ValueError, TypeError):
+                self.write(tag + b" BAD invalid arguments\r\n")
+                continue
+
+            self.write(tag + b" OK " + completion.encode("utf-8") + b"\r\n")
+            if command == "LOGOUT":
+                return
+
+    def requireAccount(self):
+        if self.account == None:
+            raise ImapCommandError("NO", "not logged in")
+
+    def requireMailbox(self):
+        self.requireAccount()
+        if self.mailbox == None:
+            raise ImapCommandError("NO", "no mailbox selected")
+
+    def selectMessages(self, sequenceSet, byUid):
+        # (sequence number, message) pairs; the caller holds the store condition
+        messages = list(self.mailbox.messages.values())
+        if len(messages) == 0:
+            return []
+        if byUid:
+            ranges = parseSequenceSet(sequenceSet, messages[-1].uid)
+            return [(i, message) for i, message in enumerate(messages, 1) if inSequenceSet(message.uid, ranges)]
+        ranges = parseSequenceSet(sequenceSet, len(messages))
+        return [(i, message) for i, message in enumerate(messages, 1) if inSequenceSet(i, ranges)]
+
+    def reportExists(self):
+        with self.server.store.condition:
+            count = len(self.mailbox.messages)
+        if count != self.knownCount:
+            if count > self.knownCount:
+                self.write("* {0} EXISTS\r\n".format(count).encode("ascii"))
+            self.knownCount = count
+            return True
+        return False
+
+    def commandCapability(self, arguments, byUid):
+        self.write(b"* CAPABILITY " + IMAP_CAPABILITIES + b"\r\n")
+        return "CAPABILITY completed"
+
+    def commandNoop(self, arguments, byUid):
+        if self.mailbox != None:
+            self.reportExists()
+        return "NOOP completed"
+
+    def commandLogin(self, arguments, byUid):
+        # any password will do
+        self.account = canonicalAccount(imapText(arguments[0]))
+        return "LOGIN completed"
+
+    def commandLogout(self, arguments, byUid):
+        self.write(b"* BYE logging out\r\n")
+        return "LOGOUT completed"
+
+    def commandSelect(self, arguments, byUid):
+        self.requireAccount()
+        mailbox = self.server.store.getMailbox(self.account, imapText(arguments[0]), create=imapText(arguments[0]).lower() == "inbox")
+        if mailbox == None:
+            raise ImapCommandError("NO", "no such mailbox")
+
+        self.mailbox = mailbox
+        with self.server.store.condition:
+            self.knownCount = len(mailbox.messages)
+            uidNext = mailbox.nextUid
+        self.write("* FLAGS (\\Seen \\Deleted)\r\n* {0} EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY {1}] UIDs valid\r\n* OK [UIDNEXT {2}] next UID\r\n".format(self.knownCount, mailbox.uidValidity, uidNext).encode("ascii"))
+        return "[READ-WRITE] SELECT completed"
+
+    def commandExamine(self, arguments, byUid):
+        return self.commandSelect(arguments, byUid)
+
+    def commandCreate(self, arguments, byUid):
+        self.requireAccount()
+        store = self.server.store
+        with store.condition:
+            if store.getMailbox(self.account, imapText(arguments[0]), create=False) != None:
+                raise ImapCommandError("NO", "mailbox exists")
+            store.getMailbox(self.account, imapText(arguments[0]))
+        return "CREATE completed"
+
+    def commandSearch(self, arguments, byUid):
+        self.requireMailbox()
+        with self.server.store.condition:
+            messages = list(self.mailbox.messages.values())
+            largestUid = messages[-1].uid if len(messages) > 0 else 0
+            predicates = parseSearchKeys(arguments, largestUid, len(messages))
+            found = []
+            for i, message in enumerate(messages, 1):
+                if all(predicate(i, message) for predicate in predicates):
+                    found.append(message.uid if byUid else i)
+        self.write(b"* SEARCH" + b"".join(b" " + str(number).encode("ascii") for number in found) + b"\r\n")
+        return "SEARCH completed"
+
+    def commandFetch(self, arguments, byUid):
+        self.requireMailbox()
+        items = arguments[1]
+        if not isinstance(items, list):
+            items = [items]
+        names = [imapText(item).upper() for item in items]
+        if byUid and not "UID" in names:
+            items = [b"UID"] + items
+
+        response = []
+        with self.server.store.condition:
+            for sequenceNumber, message in self.selectMessages(arguments[0], byUid):
+                fields = []
+                for item in items:
+                    fields.append(self.fetchItem(message, imapText(item)))
+                response.append("* {0} FETCH (".format(sequenceNumber).encode("ascii") + b" ".join(fields) + b")\r\n")
+        self.write(b"".join(response))
+        return "FETCH completed"
+
+    def fetchItem(self, message, item):
+        name = item.upper()
+        if name == "UID":
+            return "UID {0}".format(message.uid).encode("ascii")
+        if name == "FLAGS":
+            return b"FLAGS (" + b" ".join(sorted(message.flags)) + b")"
+        if name == "RFC822.SIZE":
+            return "RFC822.SIZE {0}".format(len(message.data)).encode("ascii")
+        if name in ("BODYSTRUCTURE", "BODY"):
+            return name.encode("ascii") + b" " + bodyStructure(message.getMessage())
+        if name.startswith("BODY[") or name.startswith("BODY.PEEK["):
+            section = item[item.index("[") + 1:item.rindex("]")]
+            if not name.startswith("BODY.PEEK["):
+                message.flags.add(FLAG_SEEN)
+            return "BODY[{0}] ".format(section).encode("utf-8") + imapLiteral(self.fetchSection(message, section))
+        raise ImapCommandError("BAD", "unsupported fetch item {0}".format(item))
+
+    def fetchSection(self, message, section):
+        upperSection = section.upper()
+        if upperSection == "":
+            return message.data
+        if upperSection == "HEADER":
+            return message.getHeaderBlock()
+        if upperSection == "TEXT":
+            return message.getText()
+        if upperSection.startswith("HEADER.FIELDS"):
+            names = section[section.index("(") + 1:section.rindex(")")].split()
+            return headerFields(message.getHeaderBlock(), names)
+        part = findPart(message.getMessage(), section)
+        if part == None:
+            return b""
+        return partBody(part)
+
+    def commandStore(self, arguments, byUid):
+        self.requireMailbox()
+        operation = imapText(arguments[1]).upper()
+        flags = arguments[2]
+        if not isinstance(flags, list):
+            flags = [flags]
+
+        response = []
+        with self.server.store.condition:
+            for sequenceNumber, message in self.selectMessages(arguments[0], byUid):
+                if operation.startswith("+"):
+                    message.flags.update(flags)
+                elif operation.startswith("-"):
+                    message.flags.difference_update(flags)
+                else:
+                    message.flags = set(flags)
+                if not operation.endswith(".SILENT"):
+                    response.append("* {0} FETCH (UID {1} FLAGS (".format(sequenceNumber, message.uid).encode("ascii") + b" ".join(sorted(message.flags)) + b"))\r\n")
+        self.write(b"".join(response))
+        return "STORE completed"
+
+    def copyMessages(self, arguments, byUid, move):
+        self.requireMailbox()
+        store = self.server.store
+        with store.condition:
+            target = store.getMailbox(self.account, imapText(arguments[1]), create=False)
+            if target == None:
+                raise ImapCommandError("NO", "[TRYCREATE] no such mailbox")
+            selected = self.selectMessages(arguments[0], byUid)
+            for _, message in selected:
+                target.append(message.data, flags=message.flags)
+            expunged = []
+            if move:
+                expunged = self.mailbox.expunge(set(message.uid for _, message in selected))
+                self.knownCount = len(self.mailbox.messages)
+        self.write(b"".join("* {0} EXPUNGE\r\n".format(sequenceNumber).encode("ascii") for sequenceNumber in expunged))
+
+    def commandCopy(self, arguments, byUid):
+        self.copyMessages(arguments, byUid, move=False)
+        return "COPY completed"
+
+    def commandMove(self, arguments, byUid):
+        self.copyMessages(arguments, byUid, move=True)
+        return "MOVE completed"
+
+    def commandExpunge(self, arguments, byUid):
+        self.requireMailbox()
+        with self.server.store.condition:
+            uids = set(message.uid for message in self.mailbox.messages.values() if FLAG_DELETED in message.flags)
+            if byUid:
+                uids = set(message.uid for _, message in self.selectMessages(arguments[0], True) if message.uid in uids)
+            expunged = self.mailbox.expunge(uids)
+            self.knownCount = len(self.mailbox.messages)
+        self.write(b"".join("* {0} EXPUNGE\r\n".format(sequenceNumber).encode("ascii") for sequenceNumber in expunged))
+        return "EXPUNGE completed"
+
+    def commandIdle(self, arguments, byUid):
+        self.requireMailbox()
+        self.write(b"+ idling\r\n")
+        while True:
+            self.reportExists()
+            if self.clientReady(0.05):
+                line = self.readLine()
+                if not line or line.strip().upper() == b"DONE":
+                    break
+        return "IDLE terminated"
+
+class LocalMailServerBase(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # a load test opens all its connections at once; the default backlog of 5 drops SYNs
+    request_queue_size = 256
+
+    def __init__(self, address, handlerClass, store, sslContext=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, handlerClass)
+        self.store = store
+        self.sslContext = sslContext
+        self.stats = ServerStats()
+        self.thread = None
+
+    def getPort(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class LocalSmtpServer(LocalMailServerBase):
+
+    def __init__(self, address, store, sslContext=None):
+        LocalMailServerBase.__init__(self, address, LocalSmtpHandler, store, sslContext=sslContext)
+
+class LocalImapServer(LocalMailServerBase):
+
+    def __init__(self, address, store, sslContext=None):
+        LocalMailServerBase.__init__(self, address, LocalImapHandler, store, sslContext=sslContext)
+
+def createSelfSignedCertificate(directory, host="127.0.0.1", days=1):
+    # cryptography is only needed for TLS runs of the local servers
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "PakeMail local server")])
+
+    alternativeNames = [x509.DNSName("localhost")]
+    try:
+        alternativeNames.append(x509.IPAddress(ipaddress.ip_address(host)))
+    except ValueError:
+        alternativeNames.append(x509.DNSName(host))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(minutes=5)).not_valid_after(now + datetime.timedelta(days=days)) \
+        .add_extension(x509.SubjectAlternativeName(alternativeNames), critical=False) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+        .sign(key, hashes.SHA256())
+
+    certificatePath = os.path.join(directory, "pakemail-local.crt")
+    keyPath = os.path.join(directory, "pakemail-local.key")
+    with open(certificatePath, "wb") as certificateFile:
+        certificateFile.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(os.open(keyPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as keyFile:
+        keyFile.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return certificatePath, keyPath
+
+class LocalMailServer:
+
+    def __init__(self, host="127.0.0.1", tls=False, deliveryDelay=None, certificateDirectory=None):
+        self.host = host
+        self.tls = tls
+        self.store = MailStore(deliveryDelay=deliveryDelay)
+
+        serverContext = None
+        # what clients need to trust the self-signed certificate
+        self.clientContext = None
+        if tls:
+            if certificateDirectory == None:
+                certificateDirectory = tempfile.mkdtemp(prefix="pakemail-tls-")
+            certificatePath, keyPath = createSelfSignedCertificate(certificateDirectory, host=host)
+            serverContext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            serverContext.load_cert_chain(certificatePath, keyPath)
+            self.clientContext = ssl.create_default_context(cafile=certificatePath)
+
+        self.smtpServer = LocalSmtpServer((host, 0), self.store, sslContext=serverContext)
+        self.imapServer = LocalImapServer((host, 0), self.store, sslContext=serverContext)
+
+    def start(self):
+        self.smtpServer.start()
+        self.imapServer.start()
+        return self
+
+    def stop(self):
+        self.smtpServer.stop()
+        self.imapServer.stop()
+        self.store.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+        return False
+
+    def getSecurity(self):
+        if self.tls:
+            return SECURITY_SSL
+        return SECURITY_PLAIN
+
+    def configureService(self, pakeMailService, username, password="local"):
+        # points a PakeMailService at these servers instead of Gmail
+        pakeMailService.transport = None
+        pakeMailService.username = username
+        pakeMailService.password = password
+        pakeMailService.smtpHost = self.host
+        pakeMailService.smtpPort = self.smtpServer.getPort()
+        pakeMailService.smtpSecurity = self.getSecurity()
+        pakeMailService.imapServer = self.host
+        pakeMailService.imapPort = self.imapServer.getPort()
+        pakeMailService.imapSecurity = self.getSecurity()
+        pakeMailService.sslContext = self.clientContext
+        # like Gmail, the store delivers "+tag" addresses to the plain account
+        pakeMailService.plusAddressing = True
+
+    def getStats(self):
+        return dict(smtp=self.smtpServer.stats.snapshot(), imap=self.imapServer.stats.snapshot())
+
+LOAD_TEST_FINGERPRINTS = {"A": "BD5F3D50B81B4D471F95EFAD00809FFA6F62F85C", "B": "D2E67C6882F939704A2366E9F2256109C435AC2D"}
+
+def createLoadClient(side, email, remoteEmail, server, group=None, compactEnvelope=False, threeFlow=False, waitTimeout=None):
+    from pakemod import PakeClient
+
+    remoteSide = "B" if side == "A" else "A"
+    pakeClient = PakeClient(side, "load test", email, parameters=group)
+    pakeClient.remoteClient = PakeClient(remoteSide, None, remoteEmail)
+    # no GPG lookups; as in registerRemotePakeClient, pkAfpr is the client's own fingerprint
+    pakeClient.pkAfpr = LOAD_TEST_FINGERPRINTS[side]
+    pakeClient.pkBfpr = LOAD_TEST_FINGERPRINTS[remoteSide]
+    pakeClient.compactEnvelope = compactEnvelope
+    pakeClient.threeFlow = threeFlow
+    pakeClient.waitTimeout = waitTimeout
+
+    pakeClient.setup(localTest=True)
+    server.configureService(pakeClient.pakeMailService, email)
+    return pakeClient
+
+def runLoadPair(initiator, responder):
+    start = time.perf_counter()
+    responderThread = threading.Thread(target=responder.runSession)
+    responderThread.start()
+    initiator.runSession()
+    responderThread.join()
+    return time.perf_counter() - start
+
+def run_load_test(pairs=8, deliveryDelay=None, tls=False, group=None, compactEnvelope=False, threeFlow=False, waitTimeout=120, verbose=True):
+    # every pair is one full session between two accounts, over real SMTP and IMAP connections
+    from pakebench import summarize
+    from pakemod import SessionPhase
+
+    server = LocalMailServer(tls=tls, deliveryDelay=deliveryDelay).start()
+    try:
+        clientPairs = []
+        for i in range(pairs):
+            initiatorEmail = "initiator{0}@pakemail.test".format(i)
+            responderEmail = "responder{0}@pakemail.test".format(i)
+            initiator = createLoadClient("A", initiatorEmail, responderEmail, server, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow, waitTimeout=waitTimeout)
+            responder = createLoadClient("B", responderEmail, initiatorEmail, server, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow, waitTimeout=waitTimeout)
+            clientPairs.append((initiator, responder))
+
+        latencies = [None] * pairs
+        def runPair(i):
+            latencies[i] = runLoadPair(*clientPairs[i])
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=runPair, args=(i,)) for i in range(pairs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        completedLatencies = []
+        for (initiator, responder), latency in zip(clientPairs, latencies):
+            if initiator.phase == SessionPhase.completed and responder.phase == SessionPhase.completed:
+                completedLatencies.append(latency)
+        stats = server.getStats()
+    finally:
+        # the pooled sessions would otherwise keep talking to a stopped server
+        closeSmtpSenders()
+        getImapConnectionPool().closeAll()
+        server.stop()
+
+    completed = len(completedLatencies)
+    bytesTransferred = sum(serverStats["bytesIn"] + serverStats["bytesOut"] for serverStats in stats.values())
+    connections = sum(serverStats["connections"] for serverStats in stats.values())
+    results = dict(
+        pairs=pairs,
+        completed=completed,
+        failed=pairs - completed,
+        tls=tls,
+        group=group,
+        compactEnvelope=compactEnvelope,
+        threeFlow=threeFlow,
+        wallTime=elapsed,
+        sessionsPerSecond=completed / elapsed,
+        latency=summarize(completedLatencies) if completed > 0 else None,
+        connectionsPerSession=connections / pairs,
+        bytesPerSession=bytesTransferred / pairs,
+        servers=stats,
+    )
+
+    if verbose:
+        print("{0} of {1} sessions completed in {2:.2f} s: {3:.2f} sessions/s, {4:.0f} sessions/min".format(completed, pairs, elapsed, results["sessionsPerSecond"], results["sessionsPerSecond"] * 60))
+        if completed > 0:
+            print("handshake latency: p50 {0:.3f} s, p99 {1:.3f} s, max {2:.3f} s".format(results["latency"]["p50"], results["latency"]["p99"], results["latency"]["max"]))
+        print("per session: {0:.1f} connections, {1:.0f} bytes".format(results["connectionsPerSession"], results["bytesPerSession"]))
+        for name, serverStats in sorted(stats.items()):
+            print("{0}: {1} connections, {2} commands, {3} bytes in, {4} bytes out".format(name, serverStats["connections"], serverStats["commands"], serverStats["bytesIn"], serverStats["bytesOut"]))
+
+    return results
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="PakeMail sessions over local SMTP and IMAP servers")
+    parser.add_argument("--pairs", type=int, default=8, help="concurrent initiator/responder pairs")
+    parser.add_argument("--delay", help="delivery delay distribution, e.g. fixed:0.5, uniform:0.1,2, exp:1 or lognormal:1,0.8")
+    parser.add_argument("--tls", action="store_true", help="serve over TLS with a self-signed certificate")
+    parser.add_argument("--group", help="SPAKE2 group, ed25519 by default")
+    parser.add_argument("--compact", action="store_true", help="send compact envelopes")
+    parser.add_argument("--three-flow", action="store_true", help="use the three-flow mode")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds a client waits for each email")
+    parser.add_argument("--json", help="write the results to this file")
+    options = parser.parse_args(arguments)
+
+    results = run_load_test(pairs=options.pairs, deliveryDelay=parseDelay(options.delay), tls=options.tls, group=options.group, compactEnvelope=options.compact, threeFlow=options.three_flow, waitTimeout=options.timeout)
+    results["deliveryDelay"] = options.delay
+    if options.json != None:
+        with open(options.json, "w") as resultsFile:
+            json.dump(results, resultsFile, indent=2, sort_keys=True)
+
+    if results["failed"] > 0:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
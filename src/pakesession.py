@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from pakemail import parsePakeHeaders, parsePakeGroup, parsePakeFlows
+from pakemod import Roles, SessionPhase, restorePakeClient
+from paketransport import DISCARD
+from pakehistory import getSessionHistoryStore
+
+logger = logging.getLogger(__name__)
+
+def getRemoteSide(side):
+    if side == Roles.A.value:
+        return Roles.B.value
+    return Roles.A.value
+
+class PakeSessionManager:
+
+    def __init__(self, transport, responderFactory=None, sessionTimeout=None, checkpointStore=None, sessionHistory=None):
+        # one reader for the whole mailbox; sessions only move forward when their messages arrive
+        self.transport = transport
+
+        # responderFactory(pakeMailID, headers) returns a set up responder PakeClient, or None to ignore the request
+        self.responderFactory = responderFactory
+        self.sessionTimeout = sessionTimeout
+
+        # (session ID, side) -> PakeClient
+        self.sessions = dict()
+        self.deadlines = dict()
+        self.earlyKeyConfirmations = dict()
+
+        # with a checkpoint store, waiting sessions live on disk instead of in memory
+        self.checkpointStore = checkpointStore
+        self.suspended = set()
+
+        if sessionHistory == None:
+            sessionHistory = getSessionHistoryStore()
+        self.sessionHistory = sessionHistory
+        self.onSessionFinished = None
+        self.completedCount = 0
+        self.failedCount = 0
+
+        self.lock = threading.RLock()
+
+    def addSession(self, pakeClient, start=True):
+        key = (str(pakeClient.pakeMail.id), pakeClient.side)
+
+        with self.lock:
+            self.sessions[key] = pakeClient
+            if self.sessionTimeout != None:
+                self.deadlines[key] = time.monotonic() + self.sessionTimeout
+
+        if start:
+            pakeClient.startSession()
+            self.suspendSession(key)
+
+        return key
+
+    def pendingCount(self):
+        with self.lock:
+            return len(self.sessions) + len(self.suspended)
+
+    def suspendSession(self, key):
+        if self.checkpointStore == None:
+            return False
+
+        with self.lock:
+            pakeClient = self.sessions.get(key)
+            if pakeClient == None:
+                return False
+            checkpoint = pakeClient.createCheckpoint()
+            if checkpoint == None:
+                return False
+
+            self.checkpointStore.save(checkpoint)
+            del self.sessions[key]
+            self.suspended.add(key)
+        return True
+
+    def resumeSession(self, key):
+        with self.lock:
+            if not key in self.suspended:
+                return self.sessions.get(key)
+
+            checkpoint = self.checkpointStore.load(key[0], key[1])
+            self.suspended.discard(key)
+            if checkpoint == None:
+                return None
+
+            pakeClient = restorePakeClient(checkpoint, transport=self.transport)
+            self.sessions[key] = pakeClient
+            self.checkpointStore.remove(key[0], key[1])
+        return pakeClient
+
+    def loadSuspendedSessions(self):
+        # picks up the sessions a previous run left waiting
+        if self.checkpointStore == None:
+            return 0
+
+        keys = self.checkpointStore.list()
+        with self.lock:
+            for key in keys:
+                if not key in self.sessions:
+                    self.suspended.add(key)
+                    if self.sessionTimeout != None:
+                        self.deadlines[key] = time.monotonic() + self.sessionTimeout
+        return len(keys)
+
+    def matchIncoming(self, headers):
+        parsedHeaders = parsePakeHeaders(headers)
+        if parsedHeaders == None:
+            return False
+
+        isKeyConfirmation, senderSide, pakeMailID = parsedHeaders
+        key = (pakeMailID, getRemoteSide(senderSide))
+
+        with self.lock:
+            if key in self.sessions or key in self.suspended:
+                return True
+
+            if self.sessionHistory.seen(pakeMailID, key[1]):
+                return DISCARD
+
+            # an unknown session can only be opened by an initiator's first PAKE message
+            return (not isKeyConfirmation) and senderSide == Roles.A.value and self.responderFactory != None
+
+    def dispatch(self, delivery):
+        isKeyConfirmation, senderSide, pakeMailID = parsePakeHeaders(delivery.headers)
+        key = (pakeMailID, getRemoteSide(senderSide))
+
+        with self.lock:
+            pakeClient = self.sessions.get(key)
+
+        if pakeClient == None and key in self.suspended:
+            pakeClient = self.resumeSession(key)
+
+        if pakeClient == None:
+            if self.responderFactory != None:
+                pakeClient = self.responderFactory(pakeMailID, delivery.headers)
+            if pakeClient == None:
+                # nobody takes the request; its email goes the way of a failed session
+                self.transport.ack(delivery, sessionID=pakeMailID)
+                self.transport.releaseSession(pakeMailID, completed=False)
+                return
+            with self.lock:
+                self.sessions[key] = pakeClient
+                if self.sessionTimeout != None:
+                    self.deadlines[key] = time.monotonic() + self.sessionTimeout
+            pakeClient.startSession()
+
+        try:
+            if isKeyConfirmation:
+                tag = delivery.getAttachment("pakemac")
+                if pakeClient.phase == SessionPhase.awaitingKeyConfirmation:
+                    pakeClient.handleRemoteKeyConfirmation(tag, pakeMailID=pakeMailID)
+                else:
+                    # the KC email overtook the PAKE email it depends on
+                    self.earlyKeyConfirmations[key] = tag
+            elif pakeClient.phase == SessionPhase.awaitingPakeMessage:
+                pakeClient.handleRemotePakeMessage(delivery.getAttachment("pakemsg"), pakeMailID=pakeMailID, remoteGroup=parsePakeGroup(delivery.headers), remoteFlows=parsePakeFlows(delivery.headers), remoteTag=delivery.getAttachment("pakemac"))
+                tag = self.earlyKeyConfirmations.pop(key, None)
+                if tag != None and pakeClient.phase == SessionPhase.awaitingKeyConfirmation:
+                    pakeClient.handleRemoteKeyConfirmation(tag, pakeMailID=pakeMailID)
+        except Exception as e:
+            logger.warning("[%s] session %s failed: %s", pakeClient.side, pakeMailID, e)
+            pakeClient.phase = SessionPhase.failed
+
+        self.transport.ack(delivery, sessionID=pakeMailID)
+
+        if pakeClient.phase in (SessionPhase.completed, SessionPhase.failed):
+            self.finishSession(key, pakeClient)
+        else:
+            self.suspendSession(key)
+
+    def finishSession(self, key, pakeClient):
+        with self.lock:
+            self.sessions.pop(key, None)
+            if key in self.suspended:
+                self.suspended.discard(key)
+                self.checkpointStore.remove(key[0], key[1])
+            self.deadlines.pop(key, None)
+            self.earlyKeyConfirmations.pop(key, None)
+            self.sessionHistory.record(key[0], key[1])
+
+            if pakeClient.phase == SessionPhase.completed:
+                self.completedCount += 1
+            else:
+                self.failedCount += 1
+
+        self.transport.releaseSession(key[0], completed=pakeClient.phase == SessionPhase.completed)
+
+        if self.onSessionFinished != None:
+            self.onSessionFinished(pakeClient)
+
+    def expireSessions(self):
+        now = time.monotonic()
+        with self.lock:
+            expiredKeys = [key for key, deadline in self.deadlines.items() if deadline <= now]
+
+        for key in expiredKeys:
+            pakeClient = self.resumeSession(key)
+            if pakeClient == None:
+                with self.lock:
+                    self.deadlines.pop(key, None)
+                continue
+            logger.warning("[%s] session %s timed out.", pakeClient.side, key[0])
+            pakeClient.phase = SessionPhase.failed
+            self.finishSession(key, pakeClient)
+
+    def processIncoming(self, timeout=None, cancelEvent=None):
+        deliveries = self.transport.wait_for_all(self.matchIncoming, timeout=timeout, cancelEvent=cancelEvent)
+        for delivery in deliveries:
+            self.dispatch(delivery)
+
+        self.expireSessions()
+        return len(deliveries)
+
+    def run(self, timeout=None, cancelEvent=None, stopWhenIdle=True, checkInterval=1.0):
+        deadline = None
+        if timeout != None:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            if stopWhenIdle and self.pendingCount() == 0:
+                break
+            if cancelEvent != None and cancelEvent.is_set():
+                break
+
+            waitTime = checkInterval
+            if deadline != None:
+                waitTime = min(waitTime, deadline - time.monotonic())
+                if waitTime <= 0:
+                    break
+
+            self.processIncoming(timeout=waitTime, cancelEvent=cancelEvent)
+
+        # the last sessions' emails are archived now rather than with a later poll
+        self.transport.flushRetention()
+        return self.pendingCount()
@@ -0,0 +1,539 @@
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from pakebench import summarize
+from pakehistory import SessionHistoryStore
+from pakeimap import extractAttachments
+from pakemail import parsePakeHeaders, parsePakeGroup, parsePakeFlows
+from pakemod import PakeClient, Roles, SessionPhase
+from pakeserver import LOAD_TEST_FINGERPRINTS, parseDelay, lognormalDelay
+from paketransport import PakeTransport, PakeDelivery
+
+# Discrete-event simulation of PakeMail sessions: delivery latency, mailbox polling or IDLE and wait
+# timeouts play out on a virtual clock instead of time.sleep, so that a day of sessions takes seconds.
+# The clients' reactions come from the real PakeClient state machine, either for every session
+# (exact=True) or recorded once from it and replayed.
+
+START = "start"
+PAKE = "pake"
+KEY_CONFIRMATION = "kc"
+
+# a few seconds typically, minutes now and then
+DEFAULT_DELIVERY_DELAY = lognormalDelay(5.0, 1.0)
+
+def greylistDelay(deliveryDelay, probability, retryDelay):
+    # a greylisting server turns the first attempt away, and the sending server retries some minutes later
+    def delay(rng=random):
+        seconds = deliveryDelay(rng)
+        if rng.random() < probability:
+            seconds += rng.uniform(retryDelay, 2 * retryDelay)
+        return seconds
+    return delay
+
+class VirtualClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+        self.processedCount = 0
+
+    def schedule(self, when, callback, *args):
+        # the sequence number keeps events at the same time in the order they were scheduled
+        heapq.heappush(self.events, (when, next(self.sequence), callback, args))
+
+    def run(self):
+        events = self.events
+        while len(events) > 0:
+            when, _, callback, args = heapq.heappop(events)
+            self.now = when
+            callback(*args)
+            self.processedCount += 1
+        return self.now
+
+class PollStrategy:
+
+    def __init__(self, interval=1.0, maxInterval=30.0, backoff=2.0, jitter=True):
+        # the defaults are those of MailTransport: exponential backoff with jitter, starting over for every wait
+        self.interval = interval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.jitter = jitter
+
+    def notice(self, waitStart, deliveryTime, deadline, rng):
+        # one search right away, then one per poll; returns when the message is seen (None past the deadline) and the commands spent
+        noticeTime = waitStart
+        commands = 1
+        pollDelay = self.interval
+        while noticeTime < deliveryTime:
+            if self.jitter:
+                step = rng.uniform(pollDelay / 2, pollDelay)
+            else:
+                step = pollDelay
+            if noticeTime + step > deadline:
+                return None, commands
+            noticeTime += step
+            commands += 1
+            pollDelay = min(pollDelay * self.backoff, self.maxInterval)
+        return noticeTime, commands
+
+class IdleStrategy:
+
+    def __init__(self, idleInterval=60.0, notifyLatency=0.05):
+        # MailTransport renews IDLE every idleInterval seconds and searches the mailbox after each wake-up
+        self.idleInterval = idleInterval
+        self.notifyLatency = notifyLatency
+
+    def notice(self, waitStart, deliveryTime, deadline, rng):
+        if deliveryTime <= waitStart:
+            return waitStart, 1
+
+        noticeTime = deliveryTime + self.notifyLatency
+        # every IDLE period is one IDLE/DONE exchange and one search
+        renewals = int((min(noticeTime, deadline) - waitStart) // self.idleInterval)
+        if noticeTime > deadline:
+            return None, 1 + 2 * renewals
+        return noticeTime, 1 + 2 * (renewals + 1)
+
+DEFAULT_STRATEGIES = OrderedDict([
+    ("poll-backoff", PollStrategy(1.0, 30.0)),
+    ("poll-5s", PollStrategy(5.0, 5.0, backoff=1.0)),
+    ("poll-30s", PollStrategy(30.0, 30.0, backoff=1.0)),
+    ("idle", IdleStrategy(60.0)),
+])
+
+class SimulatedComputeBackend:
+
+    # stands in for SPAKE2: both sides derive the same key from the two flows, without the exponentiations
+    def start(self, pakeClient):
+        return os.urandom(33)
+
+    def finish(self, pakeClient, remotePakeMessage):
+        if pakeClient.side == Roles.A.value:
+            return hashlib.sha256(pakeClient.pakeMessage + remotePakeMessage).digest()
+        return hashlib.sha256(remotePakeMessage + pakeClient.pakeMessage).digest()
+
+    def close(self):
+        pass
+
+class SimulatedTransport(PakeTransport):
+
+    # holds the emails a client sends until the simulation takes them
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, message):
+        self.outbox.append(message)
+
+    def collect(self, match, newestOnly=False):
+        return []
+
+class ClientEndpoint:
+
+    # one side of a simulated session, played by a real PakeClient
+    def __init__(self, pakeClient, transport):
+        self.pakeClient = pakeClient
+        self.transport = transport
+
+    def start(self):
+        self.pakeClient.startSession()
+        return self.takeOutbox()
+
+    def receive(self, phase, message):
+        isKeyConfirmation, senderSide, pakeMailID = parsePakeHeaders(message)
+        delivery = PakeDelivery(None, message, extractAttachments(message))
+        pakeClient = self.pakeClient
+        try:
+            if phase == KEY_CONFIRMATION:
+                pakeClient.handleRemoteKeyConfirmation(delivery.getAttachment("pakemac"), pakeMailID=pakeMailID)
+            else:
+                pakeClient.handleRemotePakeMessage(delivery.getAttachment("pakemsg"), pakeMailID=pakeMailID, remoteGroup=parsePakeGroup(message), remoteFlows=parsePakeFlows(message), remoteTag=delivery.getAttachment("pakemac"))
+        except Exception:
+            pakeClient.phase = SessionPhase.failed
+        return self.takeOutbox()
+
+    def takeOutbox(self):
+        messages = self.transport.outbox
+        self.transport.outbox = []
+        sent = []
+        for message in messages:
+            isKeyConfirmation, senderSide, pakeMailID = parsePakeHeaders(message)
+            sent.append((KEY_CONFIRMATION if isKeyConfirmation else PAKE, message))
+        return sent
+
+    def getPhase(self):
+        return self.pakeClient.phase
+
+class RecordingEndpoint:
+
+    # notes every reaction of the endpoint it wraps, as (side, phase before, event) -> (emails sent, phase after)
+    def __init__(self, endpoint, side, script):
+        self.endpoint = endpoint
+        self.side = side
+        self.script = script
+
+    def start(self):
+        return self.record(START, self.endpoint.start)
+
+    def receive(self, phase, message):
+        return self.record(phase, lambda: self.endpoint.receive(phase, message))
+
+    def record(self, event, react):
+        phase = self.endpoint.getPhase()
+        sent = react()
+        self.script[(self.side, phase, event)] = (tuple((sentPhase, None) for sentPhase, message in sent), self.endpoint.getPhase())
+        return sent
+
+    def getPhase(self):
+        return self.endpoint.getPhase()
+
+class ScriptedEndpoint:
+
+    # replays a recorded script; a reaction missing from it is a protocol change the recording did not cover
+    def __init__(self, script, side):
+        self.script = script
+        self.side = side
+        self.phase = SessionPhase.created
+
+    def start(self):
+        return self.react(START)
+
+    def receive(self, phase, message):
+        return self.react(phase)
+
+    def react(self, event):
+        sent, self.phase = self.script[(self.side, self.phase, event)]
+        return sent
+
+    def getPhase(self):
+        return self.phase
+
+class SimulatedSide:
+
+    def __init__(self, side, endpoint):
+        self.side = side
+        self.endpoint = endpoint
+        self.remote = None
+
+        # delivery times and messages not consumed yet
+        self.inbox = {PAKE: [], KEY_CONFIRMATION: []}
+
+        self.waitingFor = None
+        self.waitStart = None
+        self.waitID = 0
+        self.noticeScheduled = False
+
+        self.finishedAt = None
+        self.outcome = None
+        self.commands = 0
+
+class SimulatedSession:
+
+    def __init__(self, index, startTime, endpoints):
+        self.index = index
+        self.startTime = startTime
+        self.sides = dict((side, SimulatedSide(side, endpoint)) for side, endpoint in endpoints.items())
+        for simulatedSide in self.sides.values():
+            simulatedSide.remote = self.sides[getRemoteSide(simulatedSide.side)]
+
+def getRemoteSide(side):
+    if side == Roles.A.value:
+        return Roles.B.value
+    return Roles.A.value
+
+class Simulation:
+
+    def __init__(self, endpointFactory, strategy, deliveryDelay=None, waitTimeout=None, arrivalRate=1.0, responderDelay=None, computeTime=0.0, fetchCommands=2, seed=0):
+        # endpointFactory(index) returns the endpoints of session index, keyed by side
+        self.endpointFactory = endpointFactory
+        self.strategy = strategy
+        self.deliveryDelay = deliveryDelay
+        self.waitTimeout = waitTimeout
+        self.arrivalRate = arrivalRate
+        self.responderDelay = responderDelay
+        self.computeTime = computeTime
+        self.fetchCommands = fetchCommands
+
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+
+        self.sessionCount = 0
+        self.startedCount = 0
+        self.firstStart = None
+        self.lastFinish = 0.0
+
+        self.latencies = []
+        self.noticeDelays = []
+        self.outcomes = dict()
+        self.commands = 0
+        self.emailCount = 0
+
+    def run(self, sessions):
+        self.sessionCount = sessions
+        if sessions > 0:
+            self.clock.schedule(0.0, self.arrive)
+        self.clock.run()
+        return self.getResults()
+
+    def arrive(self):
+        now = self.clock.now
+        if self.firstStart == None:
+            self.firstStart = now
+
+        session = SimulatedSession(self.startedCount, now, self.endpointFactory(self.startedCount))
+        self.startedCount += 1
+        self.clock.schedule(now, self.react, session, session.sides[Roles.A.value], START, None)
+        responderStart = now
+        if self.responderDelay != None:
+            responderStart += self.responderDelay(self.rng)
+        self.clock.schedule(responderStart, self.react, session, session.sides[Roles.B.value], START, None)
+
+        # Poisson arrivals; sessions are created as they arrive to keep memory flat
+        if self.startedCount < self.sessionCount:
+            if self.arrivalRate == None:
+                self.clock.schedule(now, self.arrive)
+            else:
+                self.clock.schedule(now + self.rng.expovariate(self.arrivalRate), self.arrive)
+
+    def react(self, session, simulatedSide, event, message):
+        if event == START:
+            sent = simulatedSide.endpoint.start()
+        else:
+            sent = simulatedSide.endpoint.receive(event, message)
+
+        now = self.clock.now + self.computeTime
+        for phase, sentMessage in sent:
+            self.send(session, simulatedSide.remote, phase, sentMessage, now)
+
+        phase = simulatedSide.endpoint.getPhase()
+        if phase == SessionPhase.awaitingPakeMessage:
+            self.beginWait(session, simulatedSide, PAKE, now)
+        elif phase == SessionPhase.awaitingKeyConfirmation:
+            self.beginWait(session, simulatedSide, KEY_CONFIRMATION, now)
+        elif phase == SessionPhase.completed:
+            self.finishSide(session, simulatedSide, now, "completed")
+        else:
+            self.finishSide(session, simulatedSide, now, "failed")
+
+    def send(self, session, remoteSide, phase, message, now):
+        deliveryTime = now
+        if self.deliveryDelay != None:
+            deliveryTime += self.deliveryDelay(self.rng)
+        remoteSide.inbox[phase].append((deliveryTime, message))
+        self.emailCount += 1
+
+        if remoteSide.waitingFor == phase and not remoteSide.noticeScheduled:
+            self.scheduleNotice(session, remoteSide)
+
+    def beginWait(self, session, simulatedSide, phase, now):
+        simulatedSide.waitingFor = phase
+        simulatedSide.waitStart = now
+        simulatedSide.waitID += 1
+        simulatedSide.noticeScheduled = False
+
+        if len(simulatedSide.inbox[phase]) > 0:
+            self.scheduleNotice(session, simulatedSide)
+        if not simulatedSide.noticeScheduled and self.waitTimeout != None:
+            self.clock.schedule(now + self.waitTimeout, self.timeout, session, simulatedSide, simulatedSide.waitID)
+
+    def getDeadline(self, simulatedSide):
+        if self.waitTimeout == None:
+            return math.inf
+        return simulatedSide.waitStart + self.waitTimeout
+
+    def scheduleNotice(self, session, simulatedSide):
+        entry = min(simulatedSide.inbox[simulatedSide.waitingFor], key=lambda item: item[0])
+        noticeTime, commands = self.strategy.notice(simulatedSide.waitStart, entry[0], self.getDeadline(simulatedSide), self.rng)
+        if noticeTime == None:
+            # the timeout comes first
+            return
+        simulatedSide.noticeScheduled = True
+        self.clock.schedule(noticeTime, self.notice, session, simulatedSide, simulatedSide.waitID, entry, commands)
+
+    def notice(self, session, simulatedSide, waitID, entry, commands):
+        if simulatedSide.waitID != waitID or simulatedSide.waitingFor == None:
+            return
+        phase = simulatedSide.waitingFor
+        simulatedSide.inbox[phase].remove(entry)
+        simulatedSide.waitingFor = None
+        simulatedSide.commands += commands + self.fetchCommands
+        self.noticeDelays.append(self.clock.now - max(entry[0], simulatedSide.waitStart))
+        self.react(session, simulatedSide, phase, entry[1])
+
+    def timeout(self, session, simulatedSide, waitID):
+        if simulatedSide.waitID != waitID or simulatedSide.waitingFor == None or simulatedSide.noticeScheduled:
+            return
+        _, commands = self.strategy.notice(simulatedSide.waitStart, math.inf, self.getDeadline(simulatedSide), self.rng)
+        simulatedSide.waitingFor = None
+        simulatedSide.commands += commands
+        self.finishSide(session, simulatedSide, self.clock.now, "timeout")
+
+    def finishSide(self, session, simulatedSide, now, outcome):
+        simulatedSide.finishedAt = now
+        simulatedSide.outcome = outcome
+
+        sides = session.sides.values()
+        if any(side.outcome == None for side in sides):
+            return
+
+        finishedAt = max(side.finishedAt for side in sides)
+        self.lastFinish = max(self.lastFinish, finishedAt)
+        self.commands += sum(side.commands for side in sides)
+
+        outcomes = set(side.outcome for side in sides)
+        if outcomes == {"completed"}:
+            sessionOutcome = "completed"
+            self.latencies.append(finishedAt - session.startTime)
+        elif "failed" in outcomes:
+            sessionOutcome = "failed"
+        else:
+            sessionOutcome = "timeout"
+        self.outcomes[sessionOutcome] = self.outcomes.get(sessionOutcome, 0) + 1
+
+    def getResults(self):
+        finishedCount = sum(self.outcomes.values())
+        # sessions where one side gave up while the other waits without a timeout never finish
+        stalledCount = self.startedCount - finishedCount
+        duration = self.lastFinish - (self.firstStart or 0.0)
+        return dict(
+            sessions=self.startedCount,
+            completed=self.outcomes.get("completed", 0),
+            failed=self.outcomes.get("failed", 0),
+            timedOut=self.outcomes.get("timeout", 0),
+            stalled=stalledCount,
+            latency=summarize(self.latencies) if len(self.latencies) > 0 else None,
+            noticeDelay=summarize(self.noticeDelays) if len(self.noticeDelays) > 0 else None,
+            emailsPerSession=self.emailCount / max(1, self.startedCount),
+            imapCommandsPerSession=self.commands / max(1, finishedCount),
+            imapCommandsPerSecond=self.commands / duration if duration > 0 else None,
+            simulatedTime=duration,
+            events=self.clock.processedCount,
+        )
+
+def createSimulatedClient(side, email, remoteEmail, group=None, compactEnvelope=False, threeFlow=False):
+    client = PakeClient(side, "simulation", email, parameters=group)
+    client.remoteClient = PakeClient(getRemoteSide(side), None, remoteEmail)
+    client.pkAfpr = LOAD_TEST_FINGERPRINTS[side]
+    client.pkBfpr = LOAD_TEST_FINGERPRINTS[getRemoteSide(side)]
+    client.computeBackend = SimulatedComputeBackend()
+    client.compactEnvelope = compactEnvelope
+    client.threeFlow = threeFlow
+    # simulated sessions stay out of the shared session history
+    client.sessionHistory = SessionHistoryStore(":memory:")
+
+    transport = SimulatedTransport()
+    client.setup(transport=transport)
+    return ClientEndpoint(client, transport)
+
+def createClientEndpoints(index, group=None, compactEnvelope=False, threeFlow=False):
+    initiatorEmail = "initiator{0}@pakemail.test".format(index)
+    responderEmail = "responder{0}@pakemail.test".format(index)
+    return {
+        Roles.A.value: createSimulatedClient(Roles.A.value, initiatorEmail, responderEmail, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow),
+        Roles.B.value: createSimulatedClient(Roles.B.value, responderEmail, initiatorEmail, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow),
+    }
+
+def recordProtocolScript(group=None, compactEnvelope=False, threeFlow=False):
+    # one session between real clients with instant delivery; every reaction it takes goes into the script
+    script = dict()
+    def endpointFactory(index):
+        endpoints = createClientEndpoints(index, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow)
+        return dict((side, RecordingEndpoint(endpoint, side, script)) for side, endpoint in endpoints.items())
+
+    results = Simulation(endpointFactory, PollStrategy()).run(1)
+    if results["completed"] != 1:
+        raise RuntimeError("the recorded session did not complete")
+    return script
+
+def run_simulation(sessions=100000, strategy=None, deliveryDelay=DEFAULT_DELIVERY_DELAY, waitTimeout=None, arrivalRate=1.0, responderDelay=None, computeTime=0.0, group=None, compactEnvelope=False, threeFlow=False, exact=False, seed=0, verbose=True):
+    if strategy == None:
+        strategy = DEFAULT_STRATEGIES["poll-backoff"]
+
+    if exact:
+        endpointFactory = lambda index: createClientEndpoints(index, group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow)
+    else:
+        script = recordProtocolScript(group=group, compactEnvelope=compactEnvelope, threeFlow=threeFlow)
+        endpointFactory = lambda index: dict((side, ScriptedEndpoint(script, side)) for side in (Roles.A.value, Roles.B.value))
+
+    # with the compact envelope the flow arrives with the header fetch
+    fetchCommands = 1 if compactEnvelope else 2
+
+    start = time.perf_counter()
+    simulation = Simulation(endpointFactory, strategy, deliveryDelay=deliveryDelay, waitTimeout=waitTimeout, arrivalRate=arrivalRate, responderDelay=responderDelay, computeTime=computeTime, fetchCommands=fetchCommands, seed=seed)
+    results = simulation.run(sessions)
+    results["wallTime"] = time.perf_counter() - start
+    results["exact"] = exact
+    results["compactEnvelope"] = compactEnvelope
+    results["threeFlow"] = threeFlow
+
+    if verbose:
+        printResults(results)
+    return results
+
+def printResults(results, name=None):
+    if name != None:
+        print("{0}:".format(name))
+    print("  {0} sessions simulated in {1:.2f} s ({2} events): {3} completed, {4} failed, {5} timed out, {6} stalled".format(results["sessions"], results["wallTime"], results["events"], results["completed"], results["failed"], results["timedOut"], results["stalled"]))
+    if results["latency"] != None:
+        print("  end-to-end latency: p50 {0:.1f} s, p90 {1:.1f} s, p99 {2:.1f} s, max {3:.1f} s".format(results["latency"]["p50"], results["latency"]["p90"], results["latency"]["p99"], results["latency"]["max"]))
+    if results["noticeDelay"] != None:
+        print("  delivery to pickup: p50 {0:.2f} s, p99 {1:.2f} s".format(results["noticeDelay"]["p50"], results["noticeDelay"]["p99"]))
+    commandsPerSecond = results["imapCommandsPerSecond"]
+    print("  mailbox load: {0:.1f} IMAP commands per session, {1} per second; {2:.1f} emails per session".format(results["imapCommandsPerSession"], "{0:.1f}".format(commandsPerSecond) if commandsPerSecond != None else "-", results["emailsPerSession"]))
+
+def run_comparison(strategies=None, verbose=True, **settings):
+    # the same seed for every strategy: all of them see the same arrivals
+    if strategies == None:
+        strategies = DEFAULT_STRATEGIES
+
+    comparison = OrderedDict()
+    for name, strategy in strategies.items():
+        comparison[name] = run_simulation(strategy=strategy, verbose=False, **settings)
+        if verbose:
+            printResults(comparison[name], name=name)
+    return comparison
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Simulated PakeMail sessions on a virtual clock")
+    parser.add_argument("--sessions", type=int, default=100000, help="sessions per strategy")
+    parser.add_argument("--strategies", default=",".join(DEFAULT_STRATEGIES), help="comma-separated strategies out of {0}".format(", ".join(DEFAULT_STRATEGIES)))
+    parser.add_argument("--delay", default="lognormal:5,1", help="delivery delay distribution, e.g. fixed:0.5, uniform:0.1,2, exp:1 or lognormal:5,1")
+    parser.add_argument("--greylist", help="probability and retry delay of greylisting, e.g. 0.05,300")
+    parser.add_argument("--responder-delay", help="distribution of the responder's start after the initiator's")
+    parser.add_argument("--rate", type=float, default=1.0, help="new sessions per simulated second")
+    parser.add_argument("--timeout", type=float, help="seconds a client waits for each email")
+    parser.add_argument("--compute-time", type=float, default=0.0, help="simulated seconds each reaction of a client takes")
+    parser.add_argument("--compact", action="store_true", help="send compact envelopes")
+    parser.add_argument("--three-flow", action="store_true", help="use the three-flow mode")
+    parser.add_argument("--exact", action="store_true", help="run real clients in every session instead of replaying a recorded one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    options = parser.parse_args(arguments)
+
+    deliveryDelay = parseDelay(options.delay)
+    if options.greylist != None:
+        probability, retryDelay = [float(value) for value in options.greylist.split(",")]
+        deliveryDelay = greylistDelay(deliveryDelay or (lambda rng=random: 0.0), probability, retryDelay)
+
+    strategies = OrderedDict()
+    for name in options.strategies.split(","):
+        if not name in DEFAULT_STRATEGIES:
+            parser.error("unknown strategy {0}".format(name))
+        strategies[name] = DEFAULT_STRATEGIES[name]
+
+    comparison = run_comparison(strategies=strategies, sessions=options.sessions, deliveryDelay=deliveryDelay, waitTimeout=options.timeout, arrivalRate=options.rate, responderDelay=parseDelay(options.responder_delay), computeTime=options.compute_time, compactEnvelope=options.compact, threeFlow=options.three_flow, exact=options.exact, seed=options.seed)
+    if options.json != None:
+        with open(options.json, "w") as resultsFile:
+            json.dump(comparison, resultsFile, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import smtplib
+import ssl
+import threading
+import time
+from collections import deque
+from paketrace import getTracer
+
+# how a connection to a mail server is secured: TLS from the first byte, STARTTLS upgrade, or not at all
+SECURITY_SSL = "ssl"
+SECURITY_STARTTLS = "starttls"
+SECURITY_PLAIN = "plain"
+
+class SmtpOutcomeUnknown(smtplib.SMTPException):
+    # the session broke after the message went out, the server may or may not have taken it
+    pass
+
+class SmtpSender:
+
+    def __init__(self, host, port, username, password, idleTimeout=120, security=SECURITY_SSL, sslContext=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+
+        # sslContext None verifies against the system CAs
+        self.security = security
+        self.sslContext = sslContext
+
+        # providers drop idle SMTP sessions after a few minutes
+        self.idleTimeout = idleTimeout
+
+        self.server = None
+        self.lastUsed = float(0)
+
+        self.queue = deque()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        context = self.sslContext
+        if context == None and self.security != SECURITY_PLAIN:
+            context = ssl.create_default_context()
+
+        if self.security == SECURITY_SSL:
+            self.server = smtplib.SMTP_SSL(self.host, self.port, context=context)
+        else:
+            self.server = smtplib.SMTP(self.host, self.port)
+            if self.security == SECURITY_STARTTLS:
+                self.server.starttls(context=context)
+        self.server.login(self.username, self.password)
+        self.lastUsed = time.monotonic()
+
+    def disconnect(self):
+        server = self.server
+        self.server = None
+        if server == None:
+            return
+
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def ensureConnected(self):
+        if self.server != None and (time.monotonic() - self.lastUsed) > self.idleTimeout:
+            try:
+                code, _ = self.server.noop()
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code != 250:
+                self.disconnect()
+
+        if self.server == None:
+            self.connect()
+
+    def resetTransaction(self):
+        try:
+            self.server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def startTransaction(self, sender_email, receiver_email):
+        self.server.ehlo_or_helo_if_needed()
+        code, response = self.server.mail(sender_email)
+        if code != 250:
+            self.resetTransaction()
+            raise smtplib.SMTPSenderRefused(code, response, sender_email)
+        code, response = self.server.rcpt(receiver_email)
+        if code not in (250, 251):
+            self.resetTransaction()
+            raise smtplib.SMTPRecipientsRefused({receiver_email: (code, response)})
+
+    def submit(self, message):
+        sender_email = message["From"]
+        receiver_email = message["To"]
+
+        text = message.as_string()
+
+        try:
+            self.startTransaction(sender_email, receiver_email)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # the server closed the session behind our back; nothing was accepted yet, retry once on a fresh one
+            self.disconnect()
+            self.connect()
+            self.startTransaction(sender_email, receiver_email)
+
+        # once DATA is under way the server may have taken the message, sending it again could deliver it twice
+        try:
+            code, response = self.server.data(text)
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            self.disconnect()
+            raise SmtpOutcomeUnknown("connection lost during DATA: {0}".format(e)) from e
+        if code != 250:
+            self.resetTransaction()
+            raise smtplib.SMTPDataError(code, response)
+
+        getTracer().count("smtp_round_trips")
+        getTracer().count("bytes_sent", len(text))
+        self.lastUsed = time.monotonic()
+
+    def send(self, message):
+        with self.lock:
+            self.ensureConnected()
+            self.submit(message)
+
+    def enqueue(self, message):
+        with self.lock:
+            self.queue.append(message)
+
+    def flush(self):
+        # sends what enqueue() collected
+        with self.lock:
+            return self.submitBatch(self.queue)
+
+    def submitBatch(self, batch):
+        # the caller holds the lock; a message that fails goes back to the front of the batch, unless it may have been delivered
+        sentCount = 0
+        if len(batch) == 0:
+            return sentCount
+
+        self.ensureConnected()
+        while len(batch) > 0:
+            message = batch.popleft()
+            try:
+                self.submit(message)
+            except SmtpOutcomeUnknown:
+                raise
+            except BaseException:
+                batch.appendleft(message)
+                raise
+            sentCount += 1
+        return sentCount
+
+    def send_many(self, messages):
+        # a batch of its own: concurrent callers neither send nor count each other's messages, and failures reach this caller
+        with self.lock:
+            return self.submitBatch(deque(messages))
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+_smtpSenders = dict()
+_smtpSendersLock = threading.Lock()
+
+def getSmtpSender(host, port, username, password, security=SECURITY_SSL, sslContext=None):
+    key = (host, port, username)
+    with _smtpSendersLock:
+        sender = _smtpSenders.get(key)
+        if sender == None:
+            sender = SmtpSender(host, port, username, password, security=security, sslContext=sslContext)
+            _smtpSenders[key] = sender
+        else:
+            sender.password = password
+    return sender
+
+def closeSmtpSenders():
+    with _smtpSendersLock:
+        senders = list(_smtpSenders.values())
+        _smtpSenders.clear()
+
+    for sender in senders:
+        sender.close()
@@ -0,0 +1,270 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import resource
+import struct
+import sys
+import tempfile
+import time
+import nacl.bindings
+import nacl.exceptions
+import nacl.secret
+from hkdf import hkdf_extract, hkdf_expand
+
+# Chunked authenticated encryption of files and streams with the session key of a PakeMail session.
+#
+# Format: header = magic, version, chunk size (4 bytes), random salt (16 bytes); then one SecretBox
+# ciphertext (tag + chunk) per chunk of plaintext, the last one possibly shorter and never omitted.
+# The key is derived from the session key with the whole header as salt, so the header is
+# authenticated along with the first chunk. Each chunk's nonce is the salt, a 7-byte chunk counter
+# and a final flag: reordered, dropped or appended chunks, and truncation after any chunk, fail to decrypt.
+
+MAGIC = b"PKMS"
+STREAM_VERSION = 1
+HEADER_FORMAT = ">4sBI16s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 1 << 26
+MAX_CHUNK_COUNT = 1 << 56
+
+TAG_SIZE = nacl.secret.SecretBox.MACBYTES
+
+class StreamError(ValueError):
+    pass
+
+def readFully(source, size):
+    # raw files and sockets may return less than asked before the end of the stream
+    data = source.read(size)
+    if data == None:
+        data = b""
+    while len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def chunkNonce(salt, index, final):
+    if index >= MAX_CHUNK_COUNT:
+        raise StreamError("too many chunks")
+    return salt + index.to_bytes(7, "big") + (b"\x01" if final else b"\x00")
+
+class StreamCipher:
+
+    def __init__(self, sessionKey, chunkSize=DEFAULT_CHUNK_SIZE, workers=None):
+        if len(sessionKey) != 32:
+            raise ValueError("the session key must be 32 bytes")
+        if chunkSize <= 0 or chunkSize > MAX_CHUNK_SIZE:
+            raise ValueError("chunk size must be between 1 and {0} bytes".format(MAX_CHUNK_SIZE))
+        self.sessionKey = sessionKey
+        self.chunkSize = chunkSize
+
+        # libsodium releases the GIL, so chunks are sealed in parallel; at most 2 * workers chunks are held in memory
+        if workers == None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+
+    def deriveStreamKey(self, header):
+        # a fresh key per stream, bound to its header
+        return hkdf_expand(hkdf_extract(header, self.sessionKey), b"PakeMail stream", 32)
+
+    def encrypt(self, source, sink):
+        salt = os.urandom(16)
+        header = struct.pack(HEADER_FORMAT, MAGIC, STREAM_VERSION, self.chunkSize, salt)
+        streamKey = self.deriveStreamKey(header)
+        sink.write(header)
+
+        # SecretBox's own primitive; going through SecretBox.encrypt copies every chunk twice more
+        def sealChunk(index, chunk, final):
+            return nacl.bindings.crypto_secretbox_easy(chunk, chunkNonce(salt, index, final), streamKey)
+
+        # one chunk of read-ahead tells whether the current chunk is the last one
+        def chunks():
+            chunk = readFully(source, self.chunkSize)
+            index = 0
+            while True:
+                nextChunk = readFully(source, self.chunkSize) if len(chunk) == self.chunkSize else b""
+                final = len(nextChunk) == 0
+                yield index, chunk, final
+                if final:
+                    return
+                chunk = nextChunk
+                index += 1
+
+        return len(header) + self.run(sealChunk, chunks(), sink)
+
+    def decrypt(self, source, sink):
+        header = readFully(source, HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise StreamError("truncated stream header")
+        magic, version, chunkSize, salt = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise StreamError("not a PakeMail stream")
+        if version != STREAM_VERSION:
+            raise StreamError("unsupported stream version {0}".format(version))
+        if chunkSize <= 0 or chunkSize > MAX_CHUNK_SIZE:
+            raise StreamError("invalid chunk size {0}".format(chunkSize))
+        streamKey = self.deriveStreamKey(header)
+        sealedSize = chunkSize + TAG_SIZE
+
+        def openChunk(index, sealedChunk, final):
+            try:
+                return nacl.bindings.crypto_secretbox_open_easy(sealedChunk, chunkNonce(salt, index, final), streamKey)
+            except nacl.exceptions.CryptoError:
+                raise StreamError("chunk {0} failed authentication".format(index))
+
+        def chunks():
+            sealedChunk = readFully(source, sealedSize)
+            if len(sealedChunk) < TAG_SIZE:
+                raise StreamError("the stream ends without its final chunk")
+            index = 0
+            while True:
+                nextChunk = readFully(source, sealedSize) if len(sealedChunk) == sealedSize else b""
+                # a stream cut at a chunk boundary is caught by the final flag of its new last chunk
+                final = len(nextChunk) == 0
+                yield index, sealedChunk, final
+                if final:
+                    return
+                if len(nextChunk) < TAG_SIZE:
+                    raise StreamError("the stream ends without its final chunk")
+                sealedChunk = nextChunk
+                index += 1
+
+        return self.run(openChunk, chunks(), sink)
+
+    def run(self, transform, chunks, sink):
+        # results are written in chunk order; reading stops while 2 * workers chunks are pending
+        written = 0
+        if self.workers <= 1:
+            for index, chunk, final in chunks:
+                output = transform(index, chunk, final)
+                sink.write(output)
+                written += len(output)
+            return written
+
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for index, chunk, final in chunks:
+                    pending.append(executor.submit(transform, index, chunk, final))
+                    if len(pending) >= 2 * self.workers:
+                        output = pending.popleft().result()
+                        sink.write(output)
+                        written += len(output)
+                while len(pending) > 0:
+                    output = pending.popleft().result()
+                    sink.write(output)
+                    written += len(output)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return written
+
+    def encryptFile(self, inputPath, outputPath):
+        with open(inputPath, "rb") as source, open(outputPath, "wb") as sink:
+            return self.encrypt(source, sink)
+
+    def decryptFile(self, inputPath, outputPath):
+        # nothing appears at outputPath unless the whole stream checks out
+        tmpPath = outputPath + ".tmp"
+        try:
+            with open(inputPath, "rb") as source, open(tmpPath, "wb") as sink:
+                written = self.decrypt(source, sink)
+            os.replace(tmpPath, outputPath)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        return written
+
+def getStreamCipher(pakeClient, chunkSize=DEFAULT_CHUNK_SIZE, workers=None):
+    # both sides of a completed session get the same cipher
+    if pakeClient.sessionKey == None:
+        raise ValueError("the session has no key yet")
+    return StreamCipher(pakeClient.sessionKey, chunkSize=chunkSize, workers=workers)
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as dataFile:
+        for block in iter(lambda: dataFile.read(DEFAULT_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def getMaxRss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_stream_benchmark(size=256 << 20, chunkSizes=(64 << 10, DEFAULT_CHUNK_SIZE, 4 << 20), workerCounts=None, directory=None, verbose=True):
+    # file to file, so the figures include buffered reads and writes
+    if workerCounts == None:
+        workerCounts = sorted(set([1, 2, os.cpu_count() or 1]))
+    sessionKey = os.urandom(32)
+
+    results = dict(size=size, cpuCount=os.cpu_count(), runs=[])
+    with tempfile.TemporaryDirectory(dir=directory) as folder:
+        plainPath = os.path.join(folder, "plain")
+        sealedPath = os.path.join(folder, "sealed")
+        openedPath = os.path.join(folder, "opened")
+        with open(plainPath, "wb") as plainFile:
+            remaining = size
+            while remaining > 0:
+                block = os.urandom(min(remaining, DEFAULT_CHUNK_SIZE))
+                plainFile.write(block)
+                remaining -= len(block)
+        plainDigest = fileDigest(plainPath)
+
+        for chunkSize in chunkSizes:
+            for workers in workerCounts:
+                cipher = StreamCipher(sessionKey, chunkSize=chunkSize, workers=workers)
+                start = time.perf_counter()
+                sealedSize = cipher.encryptFile(plainPath, sealedPath)
+                encryptTime = time.perf_counter() - start
+
+                start = time.perf_counter()
+                cipher.decryptFile(sealedPath, openedPath)
+                decryptTime = time.perf_counter() - start
+
+                run = dict(
+                    chunkSize=chunkSize,
+                    workers=workers,
+                    encryptMBps=size / encryptTime / 1e6,
+                    decryptMBps=size / decryptTime / 1e6,
+                    overhead=sealedSize - size,
+                    verified=fileDigest(openedPath) == plainDigest,
+                    maxRssKB=getMaxRss(),
+                )
+                results["runs"].append(run)
+                if verbose:
+                    print("chunk {0:>8} B, {1:>2} workers: encrypt {2:8.1f} MB/s, decrypt {3:8.1f} MB/s, overhead {4} B, max RSS {5} kB{6}".format(chunkSize, workers, run["encryptMBps"], run["decryptMBps"], run["overhead"], run["maxRssKB"], "" if run["verified"] else ", MISMATCH"))
+    return results
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Throughput of PakeMail stream encryption")
+    parser.add_argument("--size", type=int, default=256, help="file size in MiB")
+    parser.add_argument("--chunk-sizes", default="64,1024,4096", help="comma-separated chunk sizes in KiB")
+    parser.add_argument("--workers", help="comma-separated worker counts, 1, 2 and the CPU count by default")
+    parser.add_argument("--directory", help="where to put the temporary files")
+    parser.add_argument("--json", help="write the results to this file")
+    options = parser.parse_args(arguments)
+
+    workerCounts = None
+    if options.workers != None:
+        workerCounts = [int(value) for value in options.workers.split(",")]
+    chunkSizes = [int(value) << 10 for value in options.chunk_sizes.split(",")]
+
+    results = run_stream_benchmark(size=options.size << 20, chunkSizes=chunkSizes, workerCounts=workerCounts, directory=options.directory)
+    if options.json != None:
+        with open(options.json, "w") as resultsFile:
+            json.dump(results, resultsFile, indent=2, sort_keys=True)
+
+    if not all(run["verified"] for run in results["runs"]):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
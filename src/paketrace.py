@@ -0,0 +1,240 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+_currentSpan = contextvars.ContextVar("pakemailCurrentSpan", default=None)
+_spanIDs = itertools.count(1)
+
+class NoopSpan:
+
+    # handed out while tracing is off: no clock reads, no allocation
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+_noopSpan = NoopSpan()
+
+class Span:
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+        self.spanID = next(_spanIDs)
+        self.parent = None
+        self.traceID = None
+
+        self.startedAt = None
+        self.wallStart = None
+        self.cpuStart = None
+        self.wallTime = None
+        self.cpuTime = None
+        self.token = None
+
+    def __enter__(self):
+        # the current span of this thread or asyncio task becomes the parent
+        self.parent = _currentSpan.get()
+        if self.parent != None:
+            self.traceID = self.parent.traceID
+        else:
+            self.traceID = uuid.uuid4().hex
+        self.token = _currentSpan.set(self)
+
+        self.startedAt = time.time()
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.thread_time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # CPU time of the current thread: work handed to other threads or processes is not in it
+        self.cpuTime = time.thread_time() - self.cpuStart
+        self.wallTime = time.perf_counter() - self.wallStart
+        if excType != None:
+            self.attributes["error"] = excType.__name__
+
+        _currentSpan.reset(self.token)
+        self.tracer.finishSpan(self)
+        return False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def toRecord(self):
+        return dict(
+            name=self.name,
+            traceID=self.traceID,
+            spanID=self.spanID,
+            parentID=self.parent.spanID if self.parent != None else None,
+            startedAt=self.startedAt,
+            wallTime=self.wallTime,
+            cpuTime=self.cpuTime,
+            attributes=self.attributes,
+        )
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.exporters = []
+        self.lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return _noopSpan
+        return Span(self, name, attributes)
+
+    def currentSpan(self):
+        if not self.enabled:
+            return _noopSpan
+        span = _currentSpan.get()
+        if span == None:
+            return _noopSpan
+        return span
+
+    def count(self, name, amount=1):
+        # process-wide counter, also added to the current span if there is one
+        if not self.enabled:
+            return
+        span = _currentSpan.get()
+        if span != None:
+            span.add(name, amount)
+        for exporter in self.exporters:
+            exporter.exportCount(name, amount)
+
+    def finishSpan(self, span):
+        record = span.toRecord()
+        for exporter in self.exporters:
+            exporter.exportSpan(record)
+
+    def addExporter(self, exporter):
+        with self.lock:
+            self.exporters = self.exporters + [exporter]
+
+    def removeExporter(self, exporter):
+        with self.lock:
+            self.exporters = [other for other in self.exporters if other is not exporter]
+
+class JsonLinesExporter:
+
+    def __init__(self, path=None, stream=None):
+        # one JSON object per finished span, appended to path or written to stream
+        self.path = path
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def exportSpan(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            if self.stream != None:
+                self.stream.write(line)
+                self.stream.flush()
+            else:
+                with open(self.path, "a") as traceFile:
+                    traceFile.write(line)
+
+    def exportCount(self, name, amount):
+        # counters already show up in the attributes of the enclosing span
+        pass
+
+    def close(self):
+        pass
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class PrometheusExporter:
+
+    def __init__(self, prefix="pakemail", buckets=DURATION_BUCKETS):
+        # aggregates spans into histograms and counters, rendered in the Prometheus text format
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+
+        # span name -> [bucket counts, count, wall time sum, CPU time sum]
+        self.histograms = dict()
+        self.counters = dict()
+
+    def exportSpan(self, record):
+        with self.lock:
+            histogram = self.histograms.get(record["name"])
+            if histogram == None:
+                histogram = [[0] * len(self.buckets), 0, 0.0, 0.0]
+                self.histograms[record["name"]] = histogram
+            for i, bound in enumerate(self.buckets):
+                if record["wallTime"] <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += record["wallTime"]
+            histogram[3] += record["cpuTime"]
+
+    def exportCount(self, name, amount):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def render(self):
+        lines = []
+        with self.lock:
+            durationName = "{0}_span_duration_seconds".format(self.prefix)
+            lines.append("# HELP {0} Wall time of PakeMail spans.".format(durationName))
+            lines.append("# TYPE {0} histogram".format(durationName))
+            for name, (bucketCounts, count, wallTime, cpuTime) in sorted(self.histograms.items()):
+                for bound, bucketCount in zip(self.buckets, bucketCounts):
+                    lines.append('{0}_bucket{{span="{1}",le="{2}"}} {3}'.format(durationName, name, bound, bucketCount))
+                lines.append('{0}_bucket{{span="{1}",le="+Inf"}} {2}'.format(durationName, name, count))
+                lines.append('{0}_sum{{span="{1}"}} {2}'.format(durationName, name, wallTime))
+                lines.append('{0}_count{{span="{1}"}} {2}'.format(durationName, name, count))
+
+            cpuName = "{0}_span_cpu_seconds_total".format(self.prefix)
+            lines.append("# HELP {0} CPU time of PakeMail spans, on the thread that ran them.".format(cpuName))
+            lines.append("# TYPE {0} counter".format(cpuName))
+            for name, (bucketCounts, count, wallTime, cpuTime) in sorted(self.histograms.items()):
+                lines.append('{0}{{span="{1}"}} {2}'.format(cpuName, name, cpuTime))
+
+            for name, value in sorted(self.counters.items()):
+                counterName = "{0}_{1}_total".format(self.prefix, name)
+                lines.append("# TYPE {0} counter".format(counterName))
+                lines.append("{0} {1}".format(counterName, value))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # e.g. into the textfile collector directory of node_exporter
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as metricsFile:
+            metricsFile.write(self.render())
+        os.replace(tmpPath, path)
+
+    def close(self):
+        pass
+
+_tracer = Tracer()
+
+def getTracer():
+    return _tracer
+
+def enableTracing(*exporters):
+    for exporter in exporters:
+        _tracer.addExporter(exporter)
+    _tracer.enabled = True
+
+def disableTracing():
+    _tracer.enabled = False
+    with _tracer.lock:
+        exporters = _tracer.exporters
+        _tracer.exporters = []
+    for exporter in exporters:
+        exporter.close()
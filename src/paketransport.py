@@ -0,0 +1,603 @@
+import email
+import email.parser
+import logging
+import mailbox
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from pakeimap import getImapConnectionPool, getMailboxScanner, getMailboxJanitor, extractAttachments, MailboxRetentionPolicy, PAKE_SEARCH_CRITERIA
+from pakesmtp import getSmtpSender, SECURITY_SSL
+from paketrace import getTracer
+
+logger = logging.getLogger(__name__)
+
+# returned by a match function for messages that must never be offered again, e.g. replays
+DISCARD = "discard"
+
+class PakeDelivery:
+
+    def __init__(self, ref, headers, attachments):
+        self.ref = ref
+        self.headers = headers
+        self.attachments = attachments
+
+    def getAttachment(self, filenameMatch):
+        for filename, payload in self.attachments.items():
+            if filenameMatch in filename:
+                return payload
+        return None
+
+class PakeTransport:
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def send_many(self, messages):
+        for message in messages:
+            self.send(message)
+        return len(messages)
+
+    def collect(self, match, newestOnly=False):
+        # match(headers) is True for wanted messages, False to skip them and DISCARD to drop them
+        raise NotImplementedError
+
+    def waitForChange(self, waitTime, cancelEvent=None):
+        if cancelEvent != None:
+            cancelEvent.wait(waitTime)
+        else:
+            time.sleep(waitTime)
+
+    def wait_for_all(self, match, timeout=None, cancelEvent=None, newestOnly=False):
+        deadline = None
+        if timeout != None:
+            deadline = time.monotonic() + timeout
+
+        deliveries = self.collect(match, newestOnly=newestOnly)
+        while len(deliveries) == 0:
+            if cancelEvent != None and cancelEvent.is_set():
+                break
+
+            waitTime = None
+            if deadline != None:
+                waitTime = remainingTime(deadline)
+                if waitTime <= 0:
+                    break
+
+            self.waitForChange(waitTime, cancelEvent=cancelEvent)
+            deliveries = self.collect(match, newestOnly=newestOnly)
+
+        return deliveries
+
+    def wait_for(self, match, timeout=None, cancelEvent=None):
+        # like the original inbox scan, the newest matching message wins
+        deliveries = self.wait_for_all(match, timeout=timeout, cancelEvent=cancelEvent, newestOnly=True)
+        if len(deliveries) == 0:
+            return None
+        return deliveries[-1]
+
+    def ack(self, delivery, sessionID=None):
+        pass
+
+    def releaseSession(self, sessionID, completed=True):
+        # the session is over; its emails may be archived or deleted according to the retention policy
+        pass
+
+    def flushRetention(self, force=False):
+        return 0
+
+    def getMailboxKey(self):
+        # transports with the same key read the same messages
+        return ("transport", id(self))
+
+def remainingTime(deadline):
+    if deadline == None:
+        return None
+    return deadline - time.monotonic()
+
+# servers where test+senderA@ and test+receiverB@ are the test@ mailbox; elsewhere they may be different mailboxes
+PLUS_ADDRESSING_SERVERS = ("imap.gmail.com",)
+
+def canonicalAccount(address, plusAddressing=True):
+    # test+senderA@gmail.com and test+receiverB@gmail.com both end up in the test@gmail.com mailbox
+    if address == None or not "@" in address or not plusAddressing:
+        return address
+    localPart, domain = address.rsplit("@", 1)
+    return "{0}@{1}".format(localPart.split("+", 1)[0].lower(), domain.lower())
+
+class MailTransport(PakeTransport):
+
+    def __init__(self, username, password, smtpHost="smtp.gmail.com", smtpPort=465, imapServer="imap.gmail.com", mailbox="inbox", retentionPolicy=None, smtpSecurity=SECURITY_SSL, imapPort=None, imapSecurity=SECURITY_SSL, sslContext=None, plusAddressing=None):
+        self.username = username
+        self.password = password
+
+        self.smtpHost = smtpHost
+        self.smtpPort = smtpPort
+        self.smtpSecurity = smtpSecurity
+
+        self.imapServer = imapServer
+        self.imapPort = imapPort
+        self.imapSecurity = imapSecurity
+        self.mailbox = mailbox
+        self.imapPool = getImapConnectionPool()
+
+        # used for both servers; None verifies against the system CAs
+        self.sslContext = sslContext
+
+        # whether "+tag" addresses share one mailbox (and one shared reader); None decides by server
+        if plusAddressing == None:
+            plusAddressing = imapServer in PLUS_ADDRESSING_SERVERS
+        self.plusAddressing = plusAddressing
+
+        # what becomes of consumed PAKE emails, see MailboxRetentionPolicy
+        if retentionPolicy == None:
+            retentionPolicy = MailboxRetentionPolicy()
+        self.retentionPolicy = retentionPolicy
+
+        self.useIdle = True
+        self.idleInterval = 60
+        self.pollInterval = 1.0
+        self.maxPollInterval = 30.0
+        # one backoff state per waiting thread, as a transport can be shared between clients
+        self.pollState = threading.local()
+
+    def getSmtpSender(self):
+        return getSmtpSender(self.smtpHost, self.smtpPort, self.username, self.password, security=self.smtpSecurity, sslContext=self.sslContext)
+
+    def send(self, message):
+        self.getSmtpSender().send(message)
+
+    def send_many(self, messages):
+        # submitted back to back over the account's shared SMTP session
+        return self.getSmtpSender().send_many(messages)
+
+    def getImapAddress(self):
+        if self.imapPort == None:
+            return self.imapServer
+        return "{0}:{1}".format(self.imapServer, self.imapPort)
+
+    def getScanner(self):
+        return getMailboxScanner(self.getImapAddress(), self.username, self.mailbox)
+
+    def getMailboxKey(self):
+        return ("imap", self.getImapAddress(), canonicalAccount(self.username, plusAddressing=self.plusAddressing), self.mailbox.lower())
+
+    def getJanitor(self):
+        return getMailboxJanitor(self.getImapAddress(), self.username, self.mailbox)
+
+    def execute(self, operation):
+        return self.imapPool.execute(self.imapServer, self.username, self.password, operation, mailbox=self.mailbox, port=self.imapPort, security=self.imapSecurity, sslContext=self.sslContext)
+
+    def poll(self, pooled, match, newestOnly=False):
+        scanner = self.getScanner()
+
+        # pending \Seen flags and archive moves ride along with the poll, on the same connection
+        janitor = self.getJanitor()
+        if janitor.pendingCount() > 0:
+            janitor.flush(pooled, batchSize=self.retentionPolicy.batchSize)
+
+        matchedMessages = []
+        # only UIDs above the persisted high-water mark are searched, and only their headers are downloaded
+        for scannedMessage in scanner.scan(pooled, criteria=PAKE_SEARCH_CRITERIA):
+            result = match(scannedMessage.headers)
+            if result == DISCARD:
+                scanner.consume(scannedMessage.uid)
+                janitor.discard(scannedMessage.uid, self.retentionPolicy)
+            elif result:
+                matchedMessages.append(scannedMessage)
+
+        if newestOnly:
+            matchedMessages = matchedMessages[-1:]
+
+        # only the attachment parts of the selected messages are downloaded
+        deliveries = []
+        for scannedMessage in matchedMessages:
+            attachments = scanner.fetchAttachments(pooled, scannedMessage)
+            deliveries.append(PakeDelivery(scannedMessage.uid, scannedMessage.headers, attachments))
+        return deliveries
+
+    def collect(self, match, newestOnly=False):
+        return self.execute(lambda pooled: self.poll(pooled, match, newestOnly=newestOnly))
+
+    def waitForChange(self, waitTime, cancelEvent=None):
+        if waitTime == None:
+            waitTime = self.idleInterval
+        waitTime = min(waitTime, self.idleInterval)
+
+        newMessages = None
+        if self.useIdle:
+            newMessages = self.execute(lambda pooled: pooled.idle(waitTime, cancelEvent=cancelEvent))
+            if newMessages == None:
+                logger.info("IMAP server %s does not support IDLE, falling back to polling.", self.imapServer)
+                self.useIdle = False
+
+        if newMessages == None:
+            # adaptive polling: exponential backoff with jitter
+            pollDelay = getattr(self.pollState, "delay", self.pollInterval)
+            PakeTransport.waitForChange(self, min(random.uniform(pollDelay / 2, pollDelay), waitTime), cancelEvent=cancelEvent)
+            self.pollState.delay = min(pollDelay * 2, self.maxPollInterval)
+
+    def wait_for_all(self, match, timeout=None, cancelEvent=None, newestOnly=False):
+        # the backoff starts over for every wait
+        self.pollState.delay = self.pollInterval
+        return PakeTransport.wait_for_all(self, match, timeout=timeout, cancelEvent=cancelEvent, newestOnly=newestOnly)
+
+    def ack(self, delivery, sessionID=None):
+        self.getScanner().consume(delivery.ref)
+        self.getJanitor().consume(delivery.ref, sessionID, self.retentionPolicy)
+
+    def releaseSession(self, sessionID, completed=True):
+        janitor = self.getJanitor()
+        janitor.releaseSession(sessionID, completed, self.retentionPolicy)
+        if janitor.pendingCount() >= self.retentionPolicy.batchSize:
+            self.flushRetention()
+
+    def flushRetention(self, force=False):
+        janitor = self.getJanitor()
+        if janitor.pendingCount(force=force) == 0:
+            return 0
+        return self.execute(lambda pooled: janitor.flush(pooled, batchSize=self.retentionPolicy.batchSize, force=force))
+
+class MemoryMailbox:
+
+    def __init__(self):
+        self.messages = OrderedDict()
+        self.nextRef = 0
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def deliver(self, message):
+        with self.condition:
+            self.nextRef += 1
+            self.version += 1
+            self.messages[self.nextRef] = message
+            self.condition.notify_all()
+
+_memoryMailboxes = dict()
+_memoryMailboxesLock = threading.Lock()
+
+def getMemoryMailbox(name="default"):
+    with _memoryMailboxesLock:
+        memoryMailbox = _memoryMailboxes.get(name)
+        if memoryMailbox == None:
+            memoryMailbox = MemoryMailbox()
+            _memoryMailboxes[name] = memoryMailbox
+    return memoryMailbox
+
+class MemoryTransport(PakeTransport):
+
+    def __init__(self, memoryMailbox=None, serialize=True, checkInterval=0.5):
+        if memoryMailbox == None:
+            memoryMailbox = getMemoryMailbox()
+        self.memoryMailbox = memoryMailbox
+
+        # serializing keeps MIME encoding and parsing in the measured path
+        self.serialize = serialize
+        self.checkInterval = checkInterval
+
+    def send(self, message):
+        if self.serialize:
+            data = message.as_bytes()
+            getTracer().count("bytes_sent", len(data))
+            message = email.message_from_bytes(data)
+        self.memoryMailbox.deliver(message)
+
+    def collect(self, match, newestOnly=False):
+        deliveries = []
+        with self.memoryMailbox.condition:
+            for ref, message in list(self.memoryMailbox.messages.items()):
+                result = match(message)
+                if result == DISCARD:
+                    del self.memoryMailbox.messages[ref]
+                elif result:
+                    deliveries.append((ref, message))
+
+        if newestOnly:
+            deliveries = deliveries[-1:]
+
+        return [PakeDelivery(ref, message, extractAttachments(message)) for ref, message in deliveries]
+
+    def getMailboxKey(self):
+        return ("memory", id(self.memoryMailbox))
+
+    def wait_for_all(self, match, timeout=None, cancelEvent=None, newestOnly=False):
+        deadline = None
+        if timeout != None:
+            deadline = time.monotonic() + timeout
+
+        memoryMailbox = self.memoryMailbox
+        with memoryMailbox.condition:
+            seenVersion = memoryMailbox.version
+            deliveries = self.collect(match, newestOnly=newestOnly)
+            while len(deliveries) == 0:
+                if cancelEvent != None and cancelEvent.is_set():
+                    break
+
+                waitTime = self.checkInterval
+                if deadline != None:
+                    waitTime = min(waitTime, remainingTime(deadline))
+                    if waitTime <= 0:
+                        break
+
+                # only rescan once something was delivered
+                if memoryMailbox.condition.wait_for(lambda: memoryMailbox.version != seenVersion, waitTime):
+                    seenVersion = memoryMailbox.version
+                    deliveries = self.collect(match, newestOnly=newestOnly)
+
+        return deliveries
+
+    def ack(self, delivery, sessionID=None):
+        with self.memoryMailbox.condition:
+            self.memoryMailbox.messages.pop(delivery.ref, None)
+
+class MaildirTransport(PakeTransport):
+
+    def __init__(self, path, pollInterval=0.05):
+        self.path = os.path.abspath(path)
+        # mailbox.Maildir only creates tmp, new and cur along with a missing folder, not in an existing empty one
+        for subfolder in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(self.path, subfolder), exist_ok=True)
+        self.maildir = mailbox.Maildir(path, create=True)
+        self.pollInterval = pollInterval
+
+        self.headerCache = dict()
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.maildir.add(message)
+
+    def getMailboxKey(self):
+        return ("maildir", self.path)
+
+    def readHeaders(self, key):
+        headers = self.headerCache.get(key)
+        if headers == None:
+            with self.maildir.get_file(key) as messageFile:
+                headers = email.parser.BytesHeaderParser().parse(messageFile)
+            self.headerCache[key] = headers
+        return headers
+
+    def collect(self, match, newestOnly=False):
+        with self.lock:
+            matchedKeys = []
+            for key in self.maildir.keys():
+                try:
+                    headers = self.readHeaders(key)
+                except (KeyError, OSError):
+                    # consumed by another reader in the meantime
+                    continue
+
+                result = match(headers)
+                if result == DISCARD:
+                    self.discard(key)
+                elif result:
+                    matchedKeys.append(key)
+
+            if newestOnly:
+                matchedKeys = matchedKeys[-1:]
+
+            deliveries = []
+            for key in matchedKeys:
+                try:
+                    with self.maildir.get_file(key) as messageFile:
+                        message = email.message_from_binary_file(messageFile)
+                except (KeyError, OSError):
+                    continue
+                deliveries.append(PakeDelivery(key, message, extractAttachments(message)))
+            return deliveries
+
+    def waitForChange(self, waitTime, cancelEvent=None):
+        if waitTime == None:
+            waitTime = self.pollInterval
+        PakeTransport.waitForChange(self, min(waitTime, self.pollInterval), cancelEvent=cancelEvent)
+
+    def discard(self, key):
+        self.headerCache.pop(key, None)
+        self.maildir.discard(key)
+
+    def ack(self, delivery, sessionID=None):
+        with self.lock:
+            self.discard(delivery.ref)
+
+class MailboxSubscription:
+
+    def __init__(self, key, match):
+        self.key = key
+        self.match = match
+
+        self.delivery = None
+        self.closed = False
+        self.event = threading.Event()
+
+    def done(self):
+        return self.delivery != None or self.closed
+
+    def accept(self, delivery):
+        # the event is set once the delivery has been acked
+        self.delivery = delivery
+
+class ClaimedRefs:
+
+    def __init__(self, maxRefs=10000):
+        # recently handed out deliveries of one mailbox, shared by all of its readers
+        self.refs = OrderedDict()
+        self.maxRefs = maxRefs
+        self.lock = threading.Lock()
+
+    def __contains__(self, ref):
+        with self.lock:
+            return ref in self.refs
+
+    def add(self, ref):
+        # false if the delivery was already handed out
+        with self.lock:
+            if ref in self.refs:
+                return False
+            self.refs[ref] = True
+            while len(self.refs) > self.maxRefs:
+                self.refs.popitem(last=False)
+        return True
+
+_claimedRefs = dict()
+_claimedRefsLock = threading.Lock()
+
+def getClaimedRefs(mailboxKey):
+    with _claimedRefsLock:
+        claimedRefs = _claimedRefs.get(mailboxKey)
+        if claimedRefs == None:
+            claimedRefs = ClaimedRefs()
+            _claimedRefs[mailboxKey] = claimedRefs
+    return claimedRefs
+
+class MailboxReader:
+
+    def __init__(self, transport, classify, pollTimeout):
+        # polls with the first transport of the mailbox, on behalf of every co-located client
+        self.transport = transport
+
+        # classify(headers) lists the subscription keys a message could be meant for, most specific first
+        self.classify = classify
+        self.pollTimeout = pollTimeout
+
+        # subscription key -> list of subscriptions, each with match(headers), done() and accept(delivery)
+        self.waiters = dict()
+        self.lock = threading.Lock()
+
+        # so that overlapping polls, threaded or async, never hand a delivery out twice
+        self.claimedRefs = getClaimedRefs(transport.getMailboxKey())
+
+    def reserve(self, delivery, subscription):
+        # hands the delivery over unless the subscription is done or the delivery already went to another one
+        with self.lock:
+            if subscription.done() or not self.claimedRefs.add(delivery.ref):
+                return False
+            subscription.accept(delivery)
+        return True
+
+    def findWaiter(self, headers, pop=False):
+        with self.lock:
+            for key in self.classify(headers):
+                for subscription in self.waiters.get(key, []):
+                    if subscription.done():
+                        continue
+                    result = subscription.match(headers)
+                    if result == DISCARD:
+                        return DISCARD
+                    if result:
+                        if pop:
+                            self.waiters[key].remove(subscription)
+                        return subscription
+        return None
+
+    def matchWaiting(self, headers):
+        subscription = self.findWaiter(headers)
+        if subscription == DISCARD:
+            return DISCARD
+        return subscription != None
+
+    def matchKey(self, key, match):
+        # a poll outside the reader must route by key before matching, as the reader does
+        def matchKeyHeaders(headers):
+            if not key in self.classify(headers):
+                return False
+            return match(headers)
+        return matchKeyHeaders
+
+class SharedMailboxReader(MailboxReader):
+
+    def __init__(self, transport, classify, pollTimeout=5.0):
+        MailboxReader.__init__(self, transport, classify, pollTimeout)
+
+        self.readerThread = None
+        # cuts the current poll short once nobody waits anymore
+        self.wakeEvent = threading.Event()
+
+    def claim(self, delivery, subscription):
+        if not self.reserve(delivery, subscription):
+            return False
+        self.transport.ack(delivery)
+        subscription.event.set()
+        return True
+
+    def subscribe(self, subscription):
+        with self.lock:
+            self.waiters.setdefault(subscription.key, []).append(subscription)
+            if self.readerThread == None:
+                self.readerThread = threading.Thread(target=self.readMailbox, daemon=True)
+                self.readerThread.start()
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscription.closed = True
+            subscriptions = self.waiters.get(subscription.key, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if len(subscriptions) == 0:
+                self.waiters.pop(subscription.key, None)
+            if len(self.waiters) == 0:
+                self.wakeEvent.set()
+
+    def wait_for(self, key, match, timeout=None, cancelEvent=None, checkInterval=0.5):
+        deadline = None
+        if timeout != None:
+            deadline = time.monotonic() + timeout
+
+        subscription = MailboxSubscription(key, match)
+        self.subscribe(subscription)
+
+        # the running poll only wakes up for new deliveries, so look for one that is already there
+        for delivery in reversed(self.transport.collect(self.matchKey(key, match))):
+            if self.claim(delivery, subscription):
+                break
+
+        while not subscription.event.is_set():
+            if cancelEvent != None and cancelEvent.is_set():
+                break
+
+            waitTime = checkInterval
+            if deadline != None:
+                waitTime = min(waitTime, remainingTime(deadline))
+                if waitTime <= 0:
+                    break
+            subscription.event.wait(waitTime)
+
+        self.unsubscribe(subscription)
+        # claimed in the meantime counts as delivered
+        return subscription.delivery
+
+    def readMailbox(self):
+        # a single poller per mailbox, whatever the number of co-located clients
+        while True:
+            with self.lock:
+                if len(self.waiters) == 0:
+                    self.readerThread = None
+                    return
+                self.wakeEvent.clear()
+
+            try:
+                deliveries = self.transport.wait_for_all(self.matchWaiting, timeout=self.pollTimeout, cancelEvent=self.wakeEvent)
+            except Exception as e:
+                logger.warning("Shared mailbox reader failed to poll: %s", e)
+                self.wakeEvent.wait(self.pollTimeout)
+                continue
+
+            for delivery in deliveries:
+                if delivery.ref in self.claimedRefs:
+                    continue
+                subscription = self.findWaiter(delivery.headers)
+                if subscription != None and subscription != DISCARD:
+                    self.claim(delivery, subscription)
+
+_sharedMailboxReaders = dict()
+_sharedMailboxReadersLock = threading.Lock()
+
+def getSharedMailboxReader(transport, classify):
+    key = transport.getMailboxKey()
+    with _sharedMailboxReadersLock:
+        reader = _sharedMailboxReaders.get(key)
+        if reader == None:
+            reader = SharedMailboxReader(transport, classify)
+            _sharedMailboxReaders[key] = reader
+    return reader